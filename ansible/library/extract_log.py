@@ -76,6 +76,7 @@ EXAMPLES = '''
 import os
 import gzip
 import re
+import shutil
 import sys
 from datetime import datetime
 from ansible.module_utils.basic import *
@@ -83,22 +84,54 @@ from ansible.module_utils.basic import *
 from pprint import pprint
 
 
-def extract_lines(directory, filename, target_string):
+MONTHS = dict((name, number) for number, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], 1))
+
+# Timestamps recognized by the fast path of convert_date(), e.g.
+# 'Oct 18 10:11:12.123456' in syslog and '2018-10-18.10:11:12.123456' in sairedis.rec
+SYSLOG_DATE_RE = re.compile(r'([A-Za-z]{3}) {1,2}(\d{1,2}) (\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?(?![\d.])')
+REC_DATE_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})\.(\d{2}):(\d{2}):(\d{2})\.(\d{6})')
+
+# Parsed timestamps with one second resolution, by timestamp string
+date_cache = {}
+DATE_CACHE_SIZE = 100000
+
+
+def open_log_file(directory, filename):
     path = os.path.join(directory, filename)
-    file = None
     if 'gz' in path:
-        file = gzip.GzipFile(path)
+        return gzip.GzipFile(path)
     else:
-        file = open(path)
-    result = None
-    with file:
-        # This might be a gunzip file or logrotate issue, there has
-        # been '\x00's in front of the log entry timestamp which
-        # messes up with the comparator.
-        # Prehandle lines to remove these sub-strings
-        result = [(filename, line.replace('\x00', '')) for line in file if target_string in line and 'nsible' not in line]
-
-    return result
+        return open(path)
+
+
+def find_latest_line(directory, filename, target_string):
+    """Scans a log file for lines with @target_string, keeping only the latest
+    of them by date in line. Returns a tuple (line, offset), where offset is the
+    position of the line in the (uncompressed) file, or None if no line was found"""
+
+    latest = None
+    latest_key = None
+    offset = 0
+    # Lines are ordered from older to newer by the sort key: lines of older rotated
+    # files (with greater number in the filename) go first, lines of the same file
+    # are ordered by date in line
+    generation = -extract_number(filename)
+    with open_log_file(directory, filename) as file:
+        for line in file:
+            if target_string in line and 'nsible' not in line:
+                # This might be a gunzip file or logrotate issue, there has
+                # been '\x00's in front of the log entry timestamp which
+                # messes up with the date parsing.
+                # Prehandle lines to remove these sub-strings
+                cleaned_line = line.replace('\x00', '')
+                key = (generation, convert_date(cleaned_line))
+                if latest is None or key > latest_key:
+                    latest = (cleaned_line, offset)
+                    latest_key = key
+            offset += len(line)
+
+    return latest
 
 def extract_number(s):
     """Extracts number from string, if not number found returns 0"""
@@ -109,7 +142,46 @@ def extract_number(s):
         return int(ns[0])
 
 
+def cached_datetime(key, *fields):
+    dt = date_cache.get(key)
+    if dt is None:
+        if len(date_cache) >= DATE_CACHE_SIZE:
+            date_cache.clear()
+        dt = datetime(*fields)
+        date_cache[key] = dt
+    return dt
+
+
 def convert_date(s):
+    """Parses timestamp at the beginning of the log line. Timestamps in the
+    formats used by syslog and sairedis.rec are parsed by a fast path, lines of
+    the same second share parsed datetime. Other timestamps are parsed by strptime"""
+
+    m = SYSLOG_DATE_RE.match(s)
+    if m is not None:
+        month = MONTHS.get(m.group(1).lower())
+        if month is not None:
+            try:
+                dt = cached_datetime(m.group(0)[:m.end(5)], 1900, month,
+                                     int(m.group(2)), int(m.group(3)), int(m.group(4)), int(m.group(5)))
+            except ValueError:
+                return convert_date_strptime(s)
+            if m.group(6):
+                dt = dt.replace(microsecond=int(m.group(6).ljust(6, '0')))
+            return dt
+
+    m = REC_DATE_RE.match(s)
+    if m is not None:
+        try:
+            dt = cached_datetime(m.group(0)[:m.end(6)], *map(int, m.groups()[:6]))
+        except ValueError:
+            return convert_date_strptime(s)
+        return dt.replace(microsecond=int(m.group(7)))
+
+    return convert_date_strptime(s)
+
+
+def convert_date_strptime(s):
     dt = None
     re_result = re.findall(r'^\S{3}\s{1,2}\d{1,2} \d{2}:\d{2}:\d{2}\.?\d*', s)
     if len(re_result) > 0:
@@ -126,72 +198,30 @@ def convert_date(s):
     return dt
 
 
-def comparator(l, r):
-    nl = extract_number(l[0])
-    nr = extract_number(r[0])
-    if nl == nr:
-        dl = convert_date(l[1])
-        dr = convert_date(r[1])
-        if dl == dr:
-            return 0
-        elif dl < dr:
-            return -1
-        else:
-            return 1
-    elif nl > nr:
-        return -1
-    else:
-        return 1
-
-
-def filename_comparator(l, r):
-    """Compares log filenames, assumes file with greater number is
-    older, e.g syslog.2 is older than syslog.1. This is how logrotate is currently configured.
-    Returns 0 if log files l and r are the same,
-    1 if log file l is older then r and -1 if l is newer then r"""
-
-    nl = extract_number(l)
-    nr = extract_number(r)
-    if nl == nr:
-        return 0
-    elif nl > nr:
-        return 1
-    else:
-        return -1
-
-
 def list_files(directory, prefixname):
     """Returns a sorted list(sort order is from newer to older)
-    of files in @directory starting with @prefixname
-    (Comparator used is @filename_comparator)"""
+    of files in @directory starting with @prefixname.
+    Assumes file with greater number is older, e.g syslog.2 is older than syslog.1.
+    This is how logrotate is currently configured."""
 
     return sorted([filename for filename in os.listdir(directory)
-        if filename.startswith(prefixname)], cmp=filename_comparator)
+        if filename.startswith(prefixname)], key=extract_number)
 
 
 def extract_latest_line_with_string(directory, filenames, start_string):
     """Extracts latest line with string @start_string. Assumes @filenames are sorted
-    and first file in @filenames is the newest log file"""
+    and first file in @filenames is the newest log file.
+    Returns a tuple (filename, line, offset of the line in the file)"""
 
-    target_lines = []
     for filename in filenames:
-        extracted_lines = extract_lines(directory, filename, start_string)
-        if extracted_lines:
-            # found lines are the lates since we start from the newest file
-            # assignt to target_lines and break the loop
-            target_lines = extracted_lines
-            break
+        latest = find_latest_line(directory, filename, start_string)
+        if latest is not None:
+            # found line is the latest since we start from the newest file,
+            # older files don't need to be read
+            line, offset = latest
+            return filename, line, offset
 
-    # find the latest line from traget_lines comparing by date in line
-    target = target_lines[0] if len(target_lines) > 0 else None
-    for line in target_lines:
-        if comparator(line, target) > 0:
-            target = line
-
-    if target is None:
-        raise Exception("{} was not found in {}".format(start_string, directory))
-
-    return target
+    raise Exception("{} was not found in {}".format(start_string, directory))
 
 
 def calculate_files_to_copy(filenames, file_with_latest_line):
@@ -199,29 +229,24 @@ def calculate_files_to_copy(filenames, file_with_latest_line):
     return files_to_copy
 
 
-def combine_logs_and_save(directory, filenames, start_string, target_filename):
-    do_copy = False
+def combine_logs_and_save(directory, filenames, start_offset, target_filename):
+    """Writes @filenames content to @target_filename in the rotation order, starting
+    from @start_offset in the oldest file. Files are streamed, gzipped files are
+    decompressed on the fly"""
+
     with open(target_filename, 'w') as fp:
-        for filename in reversed(filenames):
-            path = os.path.join(directory, filename)
-            file = None
-            if 'gz' in path:
-                file = gzip.GzipFile(path)
-            else:
-                file = open(path)
-            with file:
-                for line in file:
-                    if line == start_string:
-                        do_copy = True
-                    if do_copy:
-                        fp.write(line)
+        for index, filename in enumerate(reversed(filenames)):
+            with open_log_file(directory, filename) as file:
+                if index == 0:
+                    file.seek(start_offset)
+                shutil.copyfileobj(file, fp)
 
 
 def extract_log(directory, prefixname, target_string, target_filename):
     filenames = list_files(directory, prefixname)
-    file_with_latest_line, latest_line = extract_latest_line_with_string(directory, filenames, target_string)
+    file_with_latest_line, latest_line, offset = extract_latest_line_with_string(directory, filenames, target_string)
     files_to_copy = calculate_files_to_copy(filenames, file_with_latest_line)
-    combine_logs_and_save(directory, files_to_copy, latest_line, target_filename)
+    combine_logs_and_save(directory, files_to_copy, offset, target_filename)
 
 
 def main():
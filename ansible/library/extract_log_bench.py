@@ -0,0 +1,136 @@
+#!/usr/bin/python
+"""
+Benchmark of the latest line search of extract_log.py.
+
+A log file of synthetic candidate lines, all containing the start string, is
+searched for the latest of them twice: with the cmp-style comparator loop
+extract_log used before find_latest_line() and its sort key, and with
+find_latest_line(). convert_date() is timed alone against the strptime parser
+as well. Both paths must find the same line and parse every timestamp the same:
+
+python extract_log_bench.py [--lines 200000] [--format syslog|rec] [--sequential]
+
+--format selects syslog or sairedis.rec timestamps, --sequential makes the
+timestamps increase like in a real log instead of being random.
+
+extract_log.py imports ansible.module_utils.basic, so ansible must be
+importable.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import extract_log
+
+
+START_STRING = 'extract_log_bench start'
+LOG_FILENAME = 'syslog.1'
+
+
+def old_extract_lines(directory, filename, target_string):
+    """extract_lines() as it was before find_latest_line()"""
+    with extract_log.open_log_file(directory, filename) as file:
+        return [(filename, line.replace('\x00', '')) for line in file if target_string in line and 'nsible' not in line]
+
+
+def old_comparator(l, r):
+    nl = extract_log.extract_number(l[0])
+    nr = extract_log.extract_number(r[0])
+    if nl == nr:
+        dl = extract_log.convert_date_strptime(l[1])
+        dr = extract_log.convert_date_strptime(r[1])
+        if dl == dr:
+            return 0
+        elif dl < dr:
+            return -1
+        else:
+            return 1
+    elif nl > nr:
+        return -1
+    else:
+        return 1
+
+
+def old_find_latest_line(directory, filename, target_string):
+    target_lines = old_extract_lines(directory, filename, target_string)
+    target = target_lines[0] if len(target_lines) > 0 else None
+    for line in target_lines:
+        if old_comparator(line, target) > 0:
+            target = line
+
+    return target[1]
+
+
+def generate_lines(count, log_format, sequential):
+    rnd = random.Random(0)
+    start = datetime(1900, 1, 1) if log_format == 'syslog' else datetime(2018, 1, 1)
+    lines = []
+    for i in xrange(count):
+        if sequential:
+            dt = start + timedelta(microseconds=i * 2500)
+        else:
+            dt = start + timedelta(days=rnd.randint(0, 364), seconds=rnd.randint(0, 86399), microseconds=rnd.randint(0, 999999))
+        if log_format == 'syslog':
+            timestamp = '%s %2d %s' % (dt.strftime('%b'), dt.day, dt.strftime('%H:%M:%S'))
+            # syslog timestamps don't always have the fractional part
+            if i % 10:
+                timestamp += '.%06d' % dt.microsecond
+            lines.append('%s sonic NOTICE root: %s %d\n' % (timestamp, START_STRING, i))
+        else:
+            lines.append('%s|c|%s %d\n' % (dt.strftime('%Y-%m-%d.%H:%M:%S.%f'), START_STRING, i))
+
+    return lines
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='extract_log latest line search benchmark')
+    parser.add_argument('--lines', type=int, default=200000, help='number of candidate lines')
+    parser.add_argument('--format', choices=['syslog', 'rec'], default='syslog', help='timestamp format of the lines')
+    parser.add_argument('--sequential', action='store_true', help='increasing timestamps instead of random ones')
+    args = parser.parse_args()
+
+    lines = generate_lines(args.lines, args.format, args.sequential)
+    work_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(work_dir, LOG_FILENAME), 'w') as log_file:
+            log_file.writelines(lines)
+
+        old_time, old_line = timed(old_find_latest_line, work_dir, LOG_FILENAME, START_STRING)
+        extract_log.date_cache.clear()
+        new_time, (new_line, _) = timed(extract_log.find_latest_line, work_dir, LOG_FILENAME, START_STRING)
+    finally:
+        shutil.rmtree(work_dir)
+
+    old_parse_time, old_dates = timed(lambda: [extract_log.convert_date_strptime(line) for line in lines])
+    extract_log.date_cache.clear()
+    new_parse_time, new_dates = timed(lambda: [extract_log.convert_date(line) for line in lines])
+
+    print "%d candidate lines, %s timestamps, %s" % (args.lines, args.format, 'sequential' if args.sequential else 'random')
+    print "latest line search: comparator loop %.3f seconds, sort key %.3f seconds" % (old_time, new_time)
+    print "convert_date:       strptime %.3f seconds, fast path %.3f seconds" % (old_parse_time, new_parse_time)
+
+    if old_line != new_line:
+        print "ERROR: the latest lines differ:\n  %s  %s" % (old_line, new_line)
+        return 1
+    if old_dates != new_dates:
+        diff = sum(1 for old, new in zip(old_dates, new_dates) if old != new)
+        print "ERROR: %d timestamps are parsed differently" % diff
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
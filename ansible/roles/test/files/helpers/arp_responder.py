@@ -1,14 +1,110 @@
 import binascii
+import ctypes
+import ctypes.util
+import errno
 import socket
 import struct
 import select
 import json
 import argparse
+import os
 import os.path
+import sys
+import time
 from fcntl import ioctl
 from pprint import pprint
 
 
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = 0x20
+
+SO_ATTACH_FILTER = 26
+
+# Classic BPF opcodes
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_W_LEN = 0x80
+BPF_JEQ_K = 0x15
+BPF_JGT_K = 0x25
+BPF_RET_K = 0x06
+
+MAX_FILTER_IPS = 256    # Longer lists aren't matched by the filter, to keep it cheap for every frame
+
+CONTROL_SOCKET = '/tmp/arp_responder.sock'
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+
+
+def mmsg_vector(buf, slot_size, count):
+    # struct mmsghdr array, every message points to its own slot of the buffer
+    base = ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+    iovecs = (iovec * count)()
+    messages = (mmsghdr * count)()
+    for i in xrange(count):
+        iovecs[i].iov_base = base + i * slot_size
+        iovecs[i].iov_len = slot_size
+        messages[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        messages[i].msg_hdr.msg_iovlen = 1
+
+    return iovecs, messages
+
+
+def arp_request_filter(ips=None, max_len=60):
+    """
+    Returns classic BPF program (list of (code, jt, jf, k)) which accepts ARP requests
+    not longer than max_len. If ips (packed addresses) is given, only requests
+    for these target addresses are accepted.
+    """
+    program = [
+        (BPF_LD_W_LEN,  0, 0, 0),
+        (BPF_JGT_K,     0, 1, max_len),
+        (BPF_RET_K,     0, 0, 0),
+        (BPF_LD_H_ABS,  0, 0, 12),          # ether type
+        (BPF_JEQ_K,     1, 0, 0x0806),
+        (BPF_RET_K,     0, 0, 0),
+        (BPF_LD_H_ABS,  0, 0, 20),          # arp operation
+        (BPF_JEQ_K,     1, 0, 1),           # request
+        (BPF_RET_K,     0, 0, 0),
+    ]
+    if ips is not None and len(ips) <= MAX_FILTER_IPS:
+        program.append((BPF_LD_W_ABS, 0, 0, 38))    # target ip
+        for ip in ips:
+            program.append((BPF_JEQ_K, 0, 1, struct.unpack('!I', ip)[0]))
+            program.append((BPF_RET_K, 0, 0, 0xffff))
+        program.append((BPF_RET_K, 0, 0, 0))
+    else:
+        program.append((BPF_RET_K, 0, 0, 0xffff))
+
+    return program
+
+def attach_filter(sock, program):
+    code = ''.join(struct.pack('=HBBI', *insn) for insn in program)
+    code_buffer = ctypes.create_string_buffer(code, len(code))
+    fprog = struct.pack('HP', len(program), ctypes.addressof(code_buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
 def hexdump(data):
     print " ".join("%02x" % ord(d) for d in data)
 
@@ -25,9 +121,12 @@ def get_mac(iff):
 
 
 class Interface(object):
-    ETH_P_ALL = 0x03
-    RCV_TIMEOUT = 1000
-    RCV_SIZE = 4096
+    ETH_P_ARP = 0x0806
+    BATCH_SIZE = 64     # Frames received or sent by one syscall
+    SLOT_SIZE = 64      # Enough for ARP frame, longer frames are truncated
+    SEND_TIMEOUT = 0.01
+    SEND_ATTEMPTS = 10  # Wedged interface must not stall the other ones, the rest of the batch is dropped
+    RCV_BUF_SIZE = 1 << 22  # Absorb ARP storms
 
     def __init__(self, iface):
         self.iface = iface
@@ -38,19 +137,63 @@ class Interface(object):
         if self.socket:
             self.socket.close()
 
-    def bind(self):
-        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(self.ETH_P_ALL))
-        self.socket.bind((self.iface, 0))
-        self.socket.settimeout(self.RCV_TIMEOUT)
+    def bind(self, ips=None):
+        """
+        Opens the socket, which gets only ARP requests (for packed addresses ips, if given).
+        """
+        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(self.ETH_P_ARP))
+        self.set_filter(ips)
+        self.socket.bind((self.iface, self.ETH_P_ARP))
+        self.socket.setblocking(0)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCV_BUF_SIZE)
+        # Preallocated receive and send batches, see recv_batch() and send_batch()
+        self.rx = bytearray(self.BATCH_SIZE * self.SLOT_SIZE)
+        self.rx_iovecs, self.rx_messages = mmsg_vector(self.rx, self.SLOT_SIZE, self.BATCH_SIZE)
+        self.tx = bytearray(self.BATCH_SIZE * self.SLOT_SIZE)
+        self.tx_iovecs, self.tx_messages = mmsg_vector(self.tx, self.SLOT_SIZE, self.BATCH_SIZE)
+
+    def set_filter(self, ips=None):
+        attach_filter(self.socket, arp_request_filter(ips, ARPResponder.ARP_PKT_LEN))
 
     def handler(self):
         return self.socket.fileno()
 
-    def recv(self):
-        return self.socket.recv(self.RCV_SIZE)
-
-    def send(self, data):
-        self.socket.send(data)
+    def recv_batch(self):
+        """
+        Receives up to BATCH_SIZE frames into self.rx slots without blocking.
+        Returns list of the frame lengths, the lengths are not truncated to SLOT_SIZE.
+        """
+        count = libc.recvmmsg(self.handler(), self.rx_messages, self.BATCH_SIZE, MSG_DONTWAIT | MSG_TRUNC, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+
+        return [self.rx_messages[i].msg_len for i in xrange(count)]
+
+    def send_batch(self, lengths):
+        """
+        Sends the frames from self.tx slots, lengths is a list of their lengths.
+        Returns the number of the sent frames, the frames which the interface didn't take
+        in SEND_ATTEMPTS attempts are dropped.
+        """
+        for i, length in enumerate(lengths):
+            self.tx_iovecs[i].iov_len = length
+        first = 0
+        attempts = 0
+        while first < len(lengths) and attempts < self.SEND_ATTEMPTS:
+            sent = libc.sendmmsg(self.handler(), ctypes.byref(self.tx_messages[first]), len(lengths) - first, 0)
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.ENOBUFS, errno.EINTR):
+                    attempts += 1
+                    select.select([], [self.handler()], [], self.SEND_TIMEOUT)
+                    continue
+                raise OSError(err, os.strerror(err))
+            first += sent
+
+        return first
 
     def mac(self):
         return self.mac_address
@@ -62,57 +205,226 @@ class Interface(object):
 class Poller(object):
     def __init__(self, interfaces, responder):
         self.responder = responder
-        self.mapping = {}
+        self.epoll = select.epoll()
+        self.mapping = {}   # handler -> callback
         for interface in interfaces:
-            self.mapping[interface.handler()] = interface 
+            self.add_interface(interface)
+
+    def add_interface(self, interface):
+        self.add(interface.handler(), lambda: self.responder.action(interface))
+
+    def add(self, handler, callback):
+        self.mapping[handler] = callback
+        self.epoll.register(handler, select.EPOLLIN)
+
+    def remove(self, handler):
+        self.epoll.unregister(handler)
+        del self.mapping[handler]
 
     def poll(self):
-        handlers = self.mapping.keys()
         while True:
-            (rdlist, _, _) = select.select(handlers, [], [])
-            for handler in rdlist:
-                self.responder.action(self.mapping[handler])
+            try:
+                events = self.epoll.poll()
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for handler, _ in events:
+                if handler in self.mapping:
+                    self.mapping[handler]()
+
+
+class ControlServer(object):
+    """
+    Unix socket to change the responder table at runtime. Requests and replies are json lines:
+    {"add": [[iface, ip, mac], ...]}    mac is hex string, null means mac of the interface.
+                                        iface may be <iface>@<vlan> to set the vlan of the interface.
+    {"remove": [[iface, ip], ...]}
+    {"load": <the same dictionary as --conf file>}  replaces the whole table
+    Reply is {"status": "ok", "entries": <number of entries>} or {"status": "error", "error": <message>}.
+    """
+    RCV_SIZE = 65536
+
+    def __init__(self, path, poller, responder, interfaces, extended):
+        self.poller = poller
+        self.responder = responder
+        self.interfaces = dict((interface.name(), interface) for interface in interfaces)
+        self.extended = extended
+        self.buffers = {}   # connection handler -> (connection, received data)
+
+        # A socket left by a responder which is gone, a running one is refused by main()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(8)
+        self.poller.add(self.socket.fileno(), self.accept)
+
+    def accept(self):
+        conn, _ = self.socket.accept()
+        self.buffers[conn.fileno()] = (conn, '')
+        self.poller.add(conn.fileno(), lambda: self.read(conn))
+
+    def read(self, conn):
+        handler = conn.fileno()
+        try:
+            data = conn.recv(self.RCV_SIZE)
+            if not data:
+                self.close(conn)
+                return
+
+            data = self.buffers[handler][1] + data
+            lines = data.split('\n')
+            self.buffers[handler] = (conn, lines[-1])
+            for line in lines[:-1]:
+                if line.strip():
+                    conn.sendall(json.dumps(self.execute(line)) + '\n')
+        except socket.error:
+            # The client is gone (e.g. killed --reload), the responder must keep running
+            self.close(conn)
+
+    def close(self, conn):
+        handler = conn.fileno()
+        self.poller.remove(handler)
+        del self.buffers[handler]
+        conn.close()
+
+    def execute(self, line):
+        try:
+            request = json.loads(line)
+            changed = set()
+            if 'load' in request:
+                ip_sets = generate_ip_sets(request['load'], self.extended)
+                changed.update(self.responder.ip_sets.keys())
+                changed.update(ip_sets.keys())
+                self.responder.load(ip_sets)
+            for iface_spec, ip, mac in request.get('add', []):
+                iface, vlan_id = parse_iface(iface_spec)
+                mac = binascii.unhexlify(str(mac)) if mac is not None else get_mac(iface)
+                self.responder.add(iface, str(ip), mac, vlan_id)
+                changed.add(iface)
+            for iface_spec, ip in request.get('remove', []):
+                iface, _ = parse_iface(iface_spec)
+                self.responder.remove(iface, str(ip))
+                changed.add(iface)
+            for iface in changed:
+                self.update_interface(iface)
+        except Exception as e:
+            return {'status': 'error', 'error': repr(e)}
+
+        return {'status': 'ok', 'entries': self.responder.entries()}
+
+    def update_interface(self, iface):
+        ips = self.responder.packed_ips(iface)
+        interface = self.interfaces.get(iface)
+        if interface is None:
+            if not ips:
+                return
+            interface = Interface(iface)
+            interface.bind(ips)
+            self.interfaces[iface] = interface
+            self.poller.add_interface(interface)
+        else:
+            interface.set_filter(ips)
 
 
 class ARPResponder(object):
     ARP_PKT_LEN = 60
     ARP_OP_REQUEST = 1
+    ARP_OP_OFFSET = 20
+    ARP_SENDER_MAC_OFFSET = 6   # Ethernet source address is used, as before
+    ARP_SENDER_IP_OFFSET = 28
+    ARP_TARGET_IP_OFFSET = 38
+    REQUEST_OP = '\x00\x01'
+
     def __init__(self, ip_sets):
         self.arp_chunk = binascii.unhexlify('08060001080006040002') # defines a part of the packet for ARP Reply
         self.arp_pad = binascii.unhexlify('00' * 18)
 
-        self.ip_sets = ip_sets
+        self.load(ip_sets)
 
         return
 
-    def action(self, interface):
-        data = interface.recv()
-        if len(data) > self.ARP_PKT_LEN:
-            return
+    def load(self, ip_sets):
+        self.ip_sets = ip_sets
 
-        remote_mac, remote_ip, request_ip, op_type = self.extract_arp_info(data)
+        # Reply templates: interface name -> request ip (packed) -> reply with zero remote mac and ip
+        self.templates = {}
+        for iface in ip_sets:
+            self.generate_templates(iface)
+
+    def generate_templates(self, iface):
+        self.templates[iface] = {}
+        for ip, mac in self.ip_sets[iface].items():
+            if ip != 'vlan':
+                self.templates[iface][socket.inet_aton(ip)] = self.generate_template(iface, ip, mac)
+
+    def generate_template(self, iface, ip, mac):
+        vlan_id = self.ip_sets[iface].get('vlan')
+        return bytearray(self.generate_arp_reply(mac, '\x00' * 6, socket.inet_aton(ip), '\x00' * 4, vlan_id))
+
+    def add(self, iface, ip, mac, vlan_id=None):
+        """
+        Adds or updates the entry. vlan_id (packed) sets the vlan of the interface, None keeps it.
+        """
+        ip_set = self.ip_sets.setdefault(iface, {})
+        ip_set[ip] = mac
+        if vlan_id is not None and ip_set.get('vlan') != vlan_id:
+            ip_set['vlan'] = vlan_id
+            self.generate_templates(iface)
+        else:
+            self.templates.setdefault(iface, {})[socket.inet_aton(ip)] = self.generate_template(iface, ip, mac)
 
-        # Don't send ARP response if the ARP op code is not request
-        if op_type != self.ARP_OP_REQUEST:
-            return
+    def remove(self, iface, ip):
+        if ip in self.ip_sets.get(iface, {}):
+            del self.ip_sets[iface][ip]
+            del self.templates[iface][socket.inet_aton(ip)]
 
-        request_ip_str = socket.inet_ntoa(request_ip)
-        if request_ip_str not in self.ip_sets[interface.name()]:
-            return
+    def packed_ips(self, iface):
+        return self.templates.get(iface, {}).keys()
 
-        if 'vlan' in self.ip_sets[interface.name()]:
-            vlan_id = self.ip_sets[interface.name()]['vlan']
-        else:
-            vlan_id = None
+    def entries(self):
+        return sum(len(templates) for templates in self.templates.values())
+
+    def action(self, interface):
+        """
+        Answers the batch of the received ARP requests. Replies are copied from the templates
+        into the send slots and only the requester mac and ip are patched in.
+        """
+        lengths = interface.recv_batch()
+        if not lengths:
+            return
 
-        arp_reply = self.generate_arp_reply(self.ip_sets[interface.name()][request_ip_str], remote_mac, request_ip, remote_ip, vlan_id)
-        interface.send(arp_reply)
+        templates = self.templates.get(interface.name(), {})
+        rx = interface.rx
+        tx = interface.tx
+        slot_size = interface.SLOT_SIZE
+        replies = []
+        for i, length in enumerate(lengths):
+            if length > self.ARP_PKT_LEN:
+                continue
+            offset = i * slot_size
+            if rx[offset + self.ARP_OP_OFFSET:offset + self.ARP_OP_OFFSET + 2] != self.REQUEST_OP:
+                continue
+            template = templates.get(str(rx[offset + self.ARP_TARGET_IP_OFFSET:offset + self.ARP_TARGET_IP_OFFSET + 4]))
+            if template is None:
+                continue
+
+            remote_mac = rx[offset + self.ARP_SENDER_MAC_OFFSET:offset + self.ARP_SENDER_MAC_OFFSET + 6]
+            remote_ip = rx[offset + self.ARP_SENDER_IP_OFFSET:offset + self.ARP_SENDER_IP_OFFSET + 4]
+            reply = len(replies) * slot_size
+            # template layout: remote mac, ..., remote mac, remote ip, padding
+            tail = len(template) - len(self.arp_pad) - 10
+            tx[reply:reply + len(template)] = template
+            tx[reply:reply + 6] = remote_mac
+            tx[reply + tail:reply + tail + 6] = remote_mac
+            tx[reply + tail + 6:reply + tail + 10] = remote_ip
+            replies.append(len(template))
+
+        if replies:
+            interface.send_batch(replies)
 
         return
-        
-    def extract_arp_info(self, data):
-        # remote_mac, remote_ip, request_ip, op_type
-        return data[6:12], data[28:32], data[38:42], (ord(data[20]) * 256 + ord(data[21]))
 
     def generate_arp_reply(self, local_mac, remote_mac, local_ip, remote_ip, vlan_id):
         eth_hdr = remote_mac + local_mac
@@ -122,10 +434,84 @@ class ARPResponder(object):
 
         return eth_hdr + self.arp_chunk + local_mac + local_ip + remote_mac + remote_ip + self.arp_pad
 
+def parse_iface(iface):
+    """
+    Returns (interface name, packed vlan or None) for <iface>[@<vlan>].
+    """
+    vlan_id = None
+    if iface.find('@') != -1:
+        iface, vlan = iface.split('@')
+        vlan_id = binascii.unhexlify(format(int(vlan), 'x').zfill(4))
+
+    return str(iface), vlan_id
+
+def generate_ip_sets(data, extended):
+    # generate ip_sets. every ip address will have it's own uniq mac address
+    ip_sets = {}
+    for iface_spec, ip_dict in data.items():
+        iface, vlan_id = parse_iface(iface_spec)
+        ip_sets[iface] = {}
+        if extended:
+            for ip, mac in ip_dict.items():
+                ip_sets[iface][str(ip)] = binascii.unhexlify(str(mac))
+        else:
+            for ip in ip_dict:
+                ip_sets[iface][str(ip)] = get_mac(iface)
+        if vlan_id is not None:
+            ip_sets[iface]['vlan'] = vlan_id
+
+    return ip_sets
+
+def control_socket_in_use(path):
+    """
+    Returns True if a running responder accepts connections on the control socket.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        conn.close()
+
+def control(request, path=CONTROL_SOCKET, timeout=10):
+    """
+    Sends the request to the running responder and returns its reply.
+    Waits up to timeout seconds for the responder to start listening.
+    """
+    deadline = time.time() + timeout
+    while True:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(path)
+            break
+        except socket.error:
+            conn.close()
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+    try:
+        conn.sendall(json.dumps(request) + '\n')
+        data = ''
+        while not data.endswith('\n'):
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        conn.close()
+
+    return json.loads(data)
+
 def parse_args():
     parser = argparse.ArgumentParser(description='ARP autoresponder')
     parser.add_argument('--conf', '-c', type=str, dest='conf', default='/tmp/from_t1.json', help='path to json file with configuration')
     parser.add_argument('--extended', '-e', action='store_true', dest='extended', default=False, help='enable extended mode')
+    parser.add_argument('--control', type=str, dest='control', default=CONTROL_SOCKET, help='path to the control unix socket')
+    parser.add_argument('--reload', action='store_true', dest='reload', default=False,
+                        help='load the configuration into the running responder instead of starting a new one')
     args = parser.parse_args()
 
     return args
@@ -140,35 +526,29 @@ def main():
     with open(args.conf) as fp:
         data = json.load(fp)
 
-    # generate ip_sets. every ip address will have it's own uniq mac address
-    ip_sets = {}
-    counter = 0
-    for iface, ip_dict in data.items():
-        vlan = None
-        if iface.find('@') != -1:
-            iface, vlan = iface.split('@')
-            vlan_tag = format(int(vlan), 'x')
-            vlan_tag = vlan_tag.zfill(4)
-        ip_sets[str(iface)] = {}
-        if args.extended:
-            for ip, mac in ip_dict.items():
-                ip_sets[str(iface)][str(ip)] = binascii.unhexlify(str(mac))
-                counter += 1
-        else:
-            for ip in ip_dict:
-                ip_sets[str(iface)][str(ip)] = get_mac(str(iface))
-        if vlan is not None:
-            ip_sets[str(iface)]['vlan'] = binascii.unhexlify(vlan_tag)
+    if args.reload:
+        reply = control({'load': data}, args.control)
+        print reply
+        if reply.get('status') != 'ok':
+            sys.exit(1)
+        return
+
+    if control_socket_in_use(args.control):
+        print "Another responder is running with control socket %s, use --reload or --control" % args.control
+        sys.exit(1)
+
+    ip_sets = generate_ip_sets(data, args.extended)
 
     ifaces = []
     for iface_name in ip_sets.keys():
         iface = Interface(iface_name)
-        iface.bind()
+        iface.bind([socket.inet_aton(ip) for ip in ip_sets[iface_name] if ip != 'vlan'])
         ifaces.append(iface)
 
     resp = ARPResponder(ip_sets)
 
     p = Poller(ifaces, resp)
+    ControlServer(args.control, p, resp, ifaces, args.extended)
     p.poll()
 
     return
@@ -0,0 +1,182 @@
+"""
+Throughput benchmark of arp_responder.py over veth pairs.
+
+The script creates veth pairs (arpb<N>a <-> arpb<N>b), starts the responder on
+the 'b' ends, floods ARP requests for the configured addresses into the 'a' ends
+and counts the replies which come back. Must be run as root:
+
+python arp_responder_bench.py [--pairs 4] [--hosts 1000] [--requests 100000] [--noise 0] [--responder arp_responder.py]
+
+--noise N interleaves N data plane (UDP) frames with every request, and the
+CPU time used by the responder is reported.
+"""
+
+import argparse
+import json
+import os
+import random
+import select
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+ETH_P_ALL = 0x03
+ARP_REQUEST = 1
+ARP_REPLY = 2
+
+
+def arp_request(src_mac, src_ip, dst_ip):
+    eth_hdr = '\xff' * 6 + src_mac + '\x08\x06'
+    arp = struct.pack('!HHBBH', 1, 0x0800, 6, 4, ARP_REQUEST) + src_mac + src_ip + '\x00' * 6 + dst_ip
+    return eth_hdr + arp + '\x00' * 18
+
+
+def udp_frame(src_mac, size=512):
+    eth_hdr = '\x02\x00\x00\x00\x00\xff' + src_mac + '\x08\x00'
+    ip_hdr = struct.pack('!BBHHHBBH4s4s', 0x45, 0, size - 14, 0, 0, 64, 17, 0, socket.inet_aton('10.255.0.1'), socket.inet_aton('10.255.0.2'))
+    return eth_hdr + ip_hdr + struct.pack('!HHHH', 1234, 5000, size - 34, 0) + '\x00' * (size - 42)
+
+
+def cpu_time(pid):
+    with open('/proc/%d/stat' % pid) as fp:
+        fields = fp.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def create_pairs(count):
+    pairs = []
+    for i in xrange(count):
+        a, b = 'arpb%da' % i, 'arpb%db' % i
+        subprocess.check_call(['ip', 'link', 'add', a, 'type', 'veth', 'peer', 'name', b])
+        subprocess.check_call(['ip', 'link', 'set', a, 'up'])
+        subprocess.check_call(['ip', 'link', 'set', b, 'up'])
+        # Keep the kernel from answering on its own
+        subprocess.check_call(['ip', 'link', 'set', b, 'arp', 'off'])
+        pairs.append((a, b))
+
+    return pairs
+
+
+def remove_pairs(pairs):
+    for a, _ in pairs:
+        subprocess.call(['ip', 'link', 'del', a])
+
+
+class Receiver(threading.Thread):
+    def __init__(self, ifaces):
+        super(Receiver, self).__init__()
+        self.daemon = True
+        self.sockets = []
+        for iface in ifaces:
+            s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+            s.bind((iface, 0))
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+            s.setblocking(0)
+            self.sockets.append(s)
+        self.replies = 0
+        self.last_reply = None
+        self.stopped = False
+
+    def run(self):
+        epoll = select.epoll()
+        mapping = {}
+        for s in self.sockets:
+            epoll.register(s.fileno(), select.EPOLLIN)
+            mapping[s.fileno()] = s
+        while not self.stopped:
+            for fd, _ in epoll.poll(0.1):
+                s = mapping[fd]
+                while True:
+                    try:
+                        data, address = s.recvfrom(4096)
+                    except socket.error:
+                        break
+                    if address[2] == socket.PACKET_OUTGOING:
+                        continue
+                    if data[12:14] == '\x08\x06' and data[20:22] == '\x00\x02':
+                        self.replies += 1
+                        self.last_reply = time.time()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ARP responder throughput benchmark')
+    parser.add_argument('--pairs', type=int, default=4, help='number of veth pairs')
+    parser.add_argument('--hosts', type=int, default=1000, help='number of addresses per interface')
+    parser.add_argument('--requests', type=int, default=100000, help='number of ARP requests to send')
+    parser.add_argument('--noise', type=int, default=0, help='number of data plane frames sent with every request')
+    parser.add_argument('--responder', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arp_responder.py'),
+                        help='responder script to benchmark')
+    args = parser.parse_args()
+
+    pairs = create_pairs(args.pairs)
+    responder = None
+    conf = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    try:
+        hosts = {}
+        for n, (_, b) in enumerate(pairs):
+            hosts[b] = ['10.%d.%d.%d' % (n, i // 250, i % 250 + 1) for i in xrange(args.hosts)]
+        json.dump(hosts, conf)
+        conf.close()
+
+        command = [sys.executable, args.responder, '-c', conf.name]
+        # A private control socket, the responder of the test may be running
+        if '--control' in subprocess.check_output([sys.executable, args.responder, '--help']):
+            command += ['--control', conf.name + '.sock']
+        responder = subprocess.Popen(command)
+        time.sleep(1)
+
+        receiver = Receiver([a for a, _ in pairs])
+        receiver.start()
+
+        senders = []
+        for n, (a, b) in enumerate(pairs):
+            s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+            s.bind((a, 0))
+            src_mac = struct.pack('!BBBBBB', 0x02, 0, 0, 0, 0, n)
+            frames = [arp_request(src_mac, socket.inet_aton('10.%d.255.254' % n), socket.inet_aton(ip)) for ip in hosts[b]]
+            senders.append((s, frames, udp_frame(src_mac)))
+
+        start_cpu = cpu_time(responder.pid)
+        start = time.time()
+        for i in xrange(args.requests):
+            s, frames, noise = senders[i % len(senders)]
+            for frame in [random.choice(frames)] + [noise] * args.noise:
+                while True:
+                    try:
+                        s.send(frame)
+                        break
+                    except socket.error:
+                        time.sleep(0.0001)
+        sent_time = time.time() - start
+
+        # Wait until the replies stop coming
+        while True:
+            last = receiver.last_reply
+            time.sleep(1)
+            if receiver.last_reply == last:
+                break
+        receiver.stopped = True
+        elapsed = (last or start) - start
+        responder_cpu = cpu_time(responder.pid) - start_cpu
+
+        print "Sent %d requests in %.3f seconds (%.0f/s)" % (args.requests, sent_time, args.requests / sent_time)
+        print "Received %d replies (%.1f%%) in %.3f seconds (%.0f/s)" % \
+            (receiver.replies, 100.0 * receiver.replies / args.requests, elapsed, receiver.replies / elapsed if elapsed else 0)
+        print "Responder used %.3f seconds of CPU" % responder_cpu
+    finally:
+        if responder is not None:
+            responder.kill()
+            responder.wait()
+        os.unlink(conf.name)
+        if os.path.exists(conf.name + '.sock'):
+            os.unlink(conf.name + '.sock')
+        remove_pairs(pairs)
+
+
+if __name__ == '__main__':
+    main()
@@ -64,23 +64,34 @@ from operator import itemgetter
 import scapy.all as scapyall
 import itertools
 
-from arista import Arista
+from arista import Arista, PeerPoller
 import sad_path as sp
+from ring_capture import RingCapture, tcp_ports_filter
+from raw_sender import RawSender, monotonic
+from reboot_analysis import FLOW_SPORT, FLOW_DPORT, FlowAnalysis, flow_payload_id, read_pcap, write_pcap
 
 
 class StateMachine():
     def __init__(self, init_state='init'):
         self.state_lock = threading.RLock()
+        self.state_cond = threading.Condition(self.state_lock) # Notified on every state change
         self.state_time = {} # Recording last time when entering a state
+        self.state_monotonic = {} # The same, by the monotonic clock
         self.state      = None
         self.flooding   = False
+        # Wall clock times are derived from the monotonic clock, so they don't jump with the system time
+        self.start_time      = datetime.datetime.now()
+        self.start_monotonic = monotonic()
         self.set(init_state)
 
 
     def set(self, state):
-        with self.state_lock:
-            self.state             = state
-            self.state_time[state] = datetime.datetime.now()
+        with self.state_cond:
+            now = monotonic()
+            self.state                  = state
+            self.state_monotonic[state] = now
+            self.state_time[state]      = self.start_time + datetime.timedelta(seconds = now - self.start_monotonic)
+            self.state_cond.notify_all()
 
 
     def get(self):
@@ -89,12 +100,29 @@ class StateMachine():
         return cur_state
 
 
+    def wait(self, predicate):
+        """
+        This method blocks until predicate(state) is true and returns the state.
+        It wakes up immediately when the state is changed.
+        """
+        with self.state_cond:
+            while not predicate(self.state):
+                self.state_cond.wait()
+            return self.state
+
+
     def get_state_time(self, state):
         with self.state_lock:
             time = self.state_time[state]
         return time
 
 
+    def get_state_monotonic(self, state):
+        with self.state_lock:
+            time = self.state_monotonic[state]
+        return time
+
+
     def set_flooding(self, flooding):
         with self.state_lock:
             self.flooding = flooding
@@ -146,6 +174,8 @@ class ReloadTest(BaseTest):
         self.check_param('preboot_oper', None, required = False) # preboot sad path to inject before warm-reboot
         self.check_param('allow_vlan_flooding', False, required = False)
         self.check_param('sniff_time_incr', 60, required = False)
+        self.check_param('send_batch_size', 1, required = False) # how many overdue packets the sender may send by one sendmmsg call
+        self.check_param('peer_poll_workers', 16, required = False) # how many peers are polled at the same time
         if not self.test_params['preboot_oper'] or self.test_params['preboot_oper'] == 'None':
             self.test_params['preboot_oper'] = None
 
@@ -176,6 +206,9 @@ class ReloadTest(BaseTest):
         #   Improve this interval to gain more precision of disruptions.
         self.send_interval = 0.0035
         self.packets_to_send = min(int(self.time_to_listen / (self.send_interval + 0.0015)), 45000) # How many packets to be sent in send_in_background method
+        self.capture = None             # RingCapture of sniff_in_background, self.packets are used when it is not available.
+        self.packets = None
+        self.send_times = None          # Actual send time of every packet of self.packets_list, set by send_in_background method.
 
         # Thread pool for background watching operations
         self.pool = ThreadPool(processes=3)
@@ -301,6 +334,7 @@ class ReloadTest(BaseTest):
         filename = "/tmp/from_t1.json" if self.preboot_oper is None else "/tmp/from_t1_%s.json" % self.preboot_oper
         with open(filename, "w") as fp:
             json.dump(dump, fp)
+        self.arp_responder_conf_file = filename
 
     def get_peer_dev_info(self):
         content = self.read_json('peer_dev_info')
@@ -451,7 +485,12 @@ class ReloadTest(BaseTest):
             self.dataplane.start_pcap(filename)
 
         self.log("Enabling arp_responder")
-        self.cmd(["supervisorctl", "restart", "arp_responder"])
+        self.cmd(["supervisorctl", "start", "arp_responder"])
+        # Load the new hosts into the running arp_responder, restart it only if that doesn't work
+        _, stderr, return_code = self.cmd(["python", "/opt/arp_responder.py", "-e", "-c", self.arp_responder_conf_file, "--reload"])
+        if return_code != 0:
+            self.log("Can't reload arp_responder configuration: %s. Restarting it" % stderr.strip())
+            self.cmd(["supervisorctl", "restart", "arp_responder"])
 
         return
 
@@ -640,13 +679,9 @@ class ReloadTest(BaseTest):
         upper_replies = []
         routing_always = False
 
-        self.ssh_jobs = []
-        for addr in self.ssh_targets:
-            q = Queue.Queue()
-            thr = threading.Thread(target=self.peer_state_check, kwargs={'ip': addr, 'queue': q})
-            thr.setDaemon(True)
-            self.ssh_jobs.append((thr, q))
-            thr.start()
+        self.peer_poller = PeerPoller([Arista(addr, None, self.test_params) for addr in self.ssh_targets],
+                                      self.test_params['peer_poll_workers'], self.TIMEOUT, self.peer_state_check)
+        self.peer_poller.start()
 
         thr = threading.Thread(target=self.reboot_dut)
         thr.setDaemon(True)
@@ -666,7 +701,7 @@ class ReloadTest(BaseTest):
             self.watcher_is_running.clear()             # By default its required to wait for the Watcher started.
             # Give watch thread some time to wind up
             watcher = self.pool.apply_async(self.reachability_watcher)
-            time.sleep(5)
+            self.watcher_is_running.wait(timeout = 5)   # Wait for the first round of the Watcher.
 
             self.log("Check that device is alive and pinging")
             self.fails['dut'].add("DUT is not ready for test")
@@ -749,19 +784,9 @@ class ReloadTest(BaseTest):
 
             # wait until all bgp session are established
             self.log("Wait until bgp routing is up on all devices")
-            for _, q in self.ssh_jobs:
-                q.put('quit')
+            self.peer_poller.quit()
 
-            def wait_for_ssh_threads():
-                while any(thr.is_alive() for thr, _ in self.ssh_jobs):
-                    for _, q in self.ssh_jobs:
-                        q.put('go')
-                    time.sleep(self.TIMEOUT)
-
-                for thr, _ in self.ssh_jobs:
-                    thr.join()
-
-            self.timeout(wait_for_ssh_threads, self.task_timeout, "SSH threads haven't finished for %d seconds" % self.task_timeout)
+            self.timeout(self.peer_poller.join, self.task_timeout, "SSH threads haven't finished for %d seconds" % self.task_timeout)
 
             self.log("Data plane works again. Start time: %s" % str(no_routing_stop))
             self.log("")
@@ -904,25 +929,17 @@ class ReloadTest(BaseTest):
 
         return stdout, stderr, return_code
 
-    def peer_state_check(self, ip, queue):
-        ssh = Arista(ip, queue, self.test_params)
-        self.fails[ip], self.info[ip], self.cli_info[ip], self.logs_info[ip] = ssh.run()
+    def peer_state_check(self, ip, result, error):
+        if error is not None:
+            self.fails[ip], self.info[ip] = set(["Peer state polling failed: %s" % repr(error)]), set()
+            return
+        self.fails[ip], self.info[ip], self.cli_info[ip], self.logs_info[ip] = result
 
     def wait_until_cpu_port_down(self):
-        while True:
-            for _, q in self.ssh_jobs:
-                q.put('go')
-            if self.cpu_state.get() == 'down':
-                break
-            time.sleep(self.TIMEOUT)
+        self.cpu_state.wait(lambda state: state == 'down')
 
     def wait_until_cpu_port_up(self):
-        while True:
-            for _, q in self.ssh_jobs:
-                q.put('go')
-            if self.cpu_state.get() == 'up':
-                break
-            time.sleep(self.TIMEOUT)
+        self.cpu_state.wait(lambda state: state == 'up')
 
     def apply_filter_all_ports(self, filter_expression):
         for p in self.dataplane.ports.values():
@@ -932,11 +949,16 @@ class ReloadTest(BaseTest):
     def send_in_background(self, packets_list = None, interval = None):
         """
         This method sends predefined list of packets with predefined interval.
+        All packets are serialised to RawSender buffer before the sniffer starts,
+        then RawSender sends them directly to the dataplane port sockets at deadlines
+        taken from the monotonic clock. Actual send time of every packet is saved to self.send_times.
         """
         if not interval:
             interval = self.send_interval
         if not packets_list:
             packets_list = self.packets_list
+        frames = [(self.dataplane.ports[testutils.port_to_tuple(port)].get_packet_source().socket, packet) for port, packet in packets_list]
+        sender = RawSender(frames, interval, self.test_params['send_batch_size'])
         self.sniffer_started.wait(timeout=10)
         with self.dataplane_io_lock:
             # While running fast data plane sender thread there are two reasons for filter to be applied
@@ -946,36 +968,63 @@ class ReloadTest(BaseTest):
             self.apply_filter_all_ports('not (arp and ether src {}) and not tcp'.format(self.test_params['dut_mac']))
             sender_start = datetime.datetime.now()
             self.log("Sender started at %s" % str(sender_start))
-            for entry in packets_list:
-                time.sleep(interval)
-                testutils.send_packet(self, *entry)
+            time.sleep(interval)
+            sending_time = sender.run()
+            self.send_times = sender.send_times
             self.log("Sender has been running for %s" % str(datetime.datetime.now() - sender_start))
+            self.log("Sender sent %d packets, average interval %.6f seconds, the largest delay from schedule %.6f seconds" % \
+                (len(frames), sending_time / max(len(frames) - 1, 1), sender.max_lag))
             # Remove filter
             self.apply_filter_all_ports('')
 
     def sniff_in_background(self, wait = None):
         """
         This function listens on all ports, in both directions, for the TCP src=1234 dst=5000 packets, until timeout.
-        Once found, all packets are dumped to local pcap file,
-        and all packets are saved to self.packets as scapy type.
-        The native scapy.snif() is used as a background thread, to allow delayed start for the send_in_background().
+        The packets are captured by RingCapture (AF_PACKET TPACKET_V3 ring with kernel BPF filter),
+        which records the fields needed by examine_flow() and streams all packets to local pcap file.
+        If the ring can't be created, the native scapy.sniff() is used and all packets are saved to self.packets as scapy type.
+        The capture runs as a background thread, to allow delayed start for the send_in_background().
         """
         if not wait:
             wait = self.time_to_listen + self.test_params['sniff_time_incr']
         sniffer_start = datetime.datetime.now()
         self.log("Sniffer started at %s" % str(sniffer_start))
-        sniff_filter = "tcp and tcp dst port 5000 and tcp src port 1234 and not icmp"
-        scapy_sniffer = threading.Thread(target=self.scapy_sniff, kwargs={'wait': wait, 'sniff_filter': sniff_filter})
-        scapy_sniffer.start()
-        time.sleep(2)               # Let the scapy sniff initialize completely.
+        try:
+            self.capture = RingCapture(lambda frame: flow_payload_id(frame, self.packets_to_send),
+                                       bpf_filter=tcp_ports_filter(FLOW_SPORT, FLOW_DPORT),
+                                       capacity=4 * self.packets_to_send,
+                                       pcap_file=self.get_capture_filename())
+        except EnvironmentError as e:
+            self.log("Ring capture is not available (%s), fallback to scapy sniff" % str(e))
+            self.capture = None
+        if self.capture is not None:
+            sniffer = threading.Thread(target=self.capture.run, args=(wait,))
+        else:
+            sniff_filter = "tcp and tcp dst port 5000 and tcp src port 1234 and not icmp"
+            sniffer = threading.Thread(target=self.scapy_sniff, kwargs={'wait': wait, 'sniff_filter': sniff_filter})
+        sniffer.start()
+        if self.capture is None:
+            time.sleep(2)           # Let the scapy sniff initialize completely.
         self.sniffer_started.set()  # Unblock waiter for the send_in_background.
-        scapy_sniffer.join()
+        sniffer.join()
         self.log("Sniffer has been running for %s" % str(datetime.datetime.now() - sniffer_start))
+        if self.capture is not None:
+            packets, drops = self.capture.statistics()
+            self.log("Sniffer captured %d packets, %d packets were dropped" % (packets, drops))
+            self.capture.close()
         self.sniffer_started.clear()
 
+    def get_capture_filename(self):
+        return "/tmp/capture_%s.pcap" % self.preboot_oper if self.preboot_oper is not None else "/tmp/capture.pcap"
+
     def save_sniffed_packets(self):
-        filename = "/tmp/capture_%s.pcap" % self.preboot_oper if self.preboot_oper is not None else "/tmp/capture.pcap"
-        if self.packets:
+        filename = self.get_capture_filename()
+        if self.capture is not None:
+            if self.capture.count:
+                self.log("Pcap file dumped to %s" % filename)
+            else:
+                self.log("Pcap file is empty.")
+        elif self.packets:
             scapyall.wrpcap(filename, self.packets)
             self.log("Pcap file dumped to %s" % filename)
         else:
@@ -1000,139 +1049,64 @@ class ReloadTest(BaseTest):
         self.sniff_thr.join()
         self.sender_thr.join()
 
-    def check_tcp_payload(self, packet):
-        """
-        This method is used by examine_flow() method.
-        It returns True if a packet is not corrupted and has a valid TCP sequential TCP Payload, as created by generate_bidirectional() method'.
-        """
-        try:
-            int(str(packet[scapyall.TCP].payload)) in range(self.packets_to_send)
-            return True
-        except Exception as err:
-            return False
-
-    def no_flood(self, packet):
-        """
-        This method filters packets which are unique (i.e. no floods).
-        """
-        if (not int(str(packet[scapyall.TCP].payload)) in self.unique_id) and (packet[scapyall.Ether].src == self.dut_mac):
-            # This is a unique (no flooded) received packet.
-            self.unique_id.append(int(str(packet[scapyall.TCP].payload)))
-            return True
-        elif packet[scapyall.Ether].dst == self.dut_mac:
-            # This is a sent packet.
-            return True
-        else:
-            return False
-
     def examine_flow(self, filename = None):
         """
-        This method examines pcap file (if given), or self.packets scapy file.
+        This method examines pcap file (if given), or the records of self.capture, or self.packets scapy file.
         The method compares TCP payloads of the packets one by one (assuming all payloads are consecutive integers),
         and the losses if found - are treated as disruptions in Dataplane forwarding.
         All disruptions are saved to self.lost_packets dictionary, in format:
         disrupt_start_id = (missing_packets_count, disrupt_time, disrupt_start_timestamp, disrupt_stop_timestamp)
+        The analysis is done by reboot_analysis.FlowAnalysis, which is shared with the offline replay.
         """
+        analysis = FlowAnalysis(self.dut_mac, self.packets_to_send, self.log)
         if filename:
-            all_packets = scapyall.rdpcap(filename)
+            frames = lambda: read_pcap(filename, self.log)
+            records = analysis.frame_records(frames())
+        elif self.capture is not None:
+            frames = lambda: read_pcap(self.capture.pcap_file, self.log)
+            records = self.capture.records()
         elif self.packets:
-            all_packets = self.packets
+            frames = lambda: ((packet.time, str(packet)) for packet in self.packets)
+            records = analysis.frame_records(frames())
         else:
             self.log("Filename and self.packets are not defined.")
             self.fails['dut'].add("Filename and self.packets are not defined")
             return None
         # Filter out packets and remove floods:
-        self.unique_id = list()     # This list will contain all unique Payload ID, to filter out received floods.
-        filtered_packets = [ pkt for pkt in all_packets if
-            scapyall.TCP in pkt and
-            not scapyall.ICMP in pkt and
-            pkt[scapyall.TCP].sport == 1234 and
-            pkt[scapyall.TCP].dport == 5000 and
-            self.check_tcp_payload(pkt) and
-            self.no_flood(pkt)
-            ]
-        # Re-arrange packets, if delayed, by Payload ID and Timestamp:
-        packets = sorted(filtered_packets, key = lambda packet: (int(str(packet[scapyall.TCP].payload)), packet.time ))
-        self.lost_packets = dict()
+        analysis.extract(records)
         self.max_disrupt, self.total_disruption = 0, 0
-        sent_packets = dict()
         self.fails['dut'].add("Sniffer failed to capture any traffic")
-        self.assertTrue(packets, "Sniffer failed to capture any traffic")
+        self.assertTrue(analysis.order, "Sniffer failed to capture any traffic")
         self.fails['dut'].clear()
-        if packets:
-            prev_payload, prev_time = 0, 0
-            sent_payload = 0
-            received_counter = 0    # Counts packets from dut.
-            self.disruption_start, self.disruption_stop = None, None
-            for packet in packets:
-                if packet[scapyall.Ether].dst == self.dut_mac:
-                    # This is a sent packet - keep track of it as payload_id:timestamp.
-                    sent_payload = int(str(packet[scapyall.TCP].payload))
-                    sent_packets[sent_payload] = packet.time
-                    continue
-                if packet[scapyall.Ether].src == self.dut_mac:
-                    # This is a received packet.
-                    received_time = packet.time
-                    received_payload = int(str(packet[scapyall.TCP].payload))
-                    received_counter += 1
-                if not (received_payload and received_time):
-                    # This is the first valid received packet.
-                    prev_payload = received_payload
-                    prev_time = received_time
-                    continue
-                if received_payload - prev_payload > 1:
-                    # Packets in a row are missing, a disruption.
-                    lost_id = (received_payload -1) - prev_payload # How many packets lost in a row.
-                    disrupt = (sent_packets[received_payload] - sent_packets[prev_payload + 1]) # How long disrupt lasted.
-                    # Add disrupt to the dict:
-                    self.lost_packets[prev_payload] = (lost_id, disrupt, received_time - disrupt, received_time)
-                    self.log("Disruption between packet ID %d and %d. For %.4f " % (prev_payload, received_payload, disrupt))
-                    if not self.disruption_start:
-                        self.disruption_start = datetime.datetime.fromtimestamp(prev_time)
-                    self.disruption_stop = datetime.datetime.fromtimestamp(received_time)
-                prev_payload = received_payload
-                prev_time = received_time
+        analysis.find_disruptions()
+        self.lost_packets = analysis.lost_packets
+        self.disruption_start, self.disruption_stop = analysis.disruption_start, analysis.disruption_stop
+        received_counter = analysis.received_counter
         self.fails['dut'].add("Sniffer failed to filter any traffic from DUT")
         self.assertTrue(received_counter, "Sniffer failed to filter any traffic from DUT")
         self.fails['dut'].clear()
         if self.lost_packets:
-            self.disrupts_count = len(self.lost_packets) # Total disrupt counter.
-            # Find the longest loss with the longest time:
-            max_disrupt_from_id, (self.max_lost_id, self.max_disrupt_time, self.no_routing_start, self.no_routing_stop) = \
-                max(self.lost_packets.items(), key = lambda item:item[1][0:2])
-            self.total_disrupt_packets = sum([item[0] for item in self.lost_packets.values()])
-            self.total_disrupt_time = sum([item[1] for item in self.lost_packets.values()])
+            self.disrupts_count, self.max_lost_id, self.max_disrupt_time, self.no_routing_start, self.no_routing_stop, \
+                self.total_disrupt_packets, self.total_disrupt_time = analysis.summary()
             self.log("Disruptions happen between %s and %s after the reboot." % \
                 (str(self.disruption_start - self.reboot_start), str(self.disruption_stop - self.reboot_start)))
         else:
             self.log("Gaps in forwarding not found.")
         self.log("Total incoming packets captured %d" % received_counter)
-        if packets:
-            filename = '/tmp/capture_filtered.pcap' if self.preboot_oper is None else "/tmp/capture_filtered_%s.pcap" % self.preboot_oper
-            scapyall.wrpcap(filename, packets)
-            self.log("Filtered pcap dumped to %s" % filename)
+        filtered_filename = '/tmp/capture_filtered.pcap' if self.preboot_oper is None else "/tmp/capture_filtered_%s.pcap" % self.preboot_oper
+        write_pcap(filtered_filename, analysis.filtered_frames(frames()))
+        self.log("Filtered pcap dumped to %s" % filtered_filename)
 
     def check_forwarding_stop(self):
         self.asic_start_recording_vlan_reachability()
 
-        while True:
-            state = self.asic_state.get()
-            for _, q in self.ssh_jobs:
-                q.put('go')
-            if state == 'down':
-                break
-            time.sleep(self.TIMEOUT)
-
+        state = self.asic_state.wait(lambda state: state == 'down')
 
         self.asic_stop_recording_vlan_reachability()
         return self.asic_state.get_state_time(state), self.get_asic_vlan_reachability()
 
     def check_forwarding_resume(self):
-        while True:
-            state = self.asic_state.get()
-            if state != 'down':
-                break
-            time.sleep(self.TIMEOUT)
+        state = self.asic_state.wait(lambda state: state != 'down')
 
         return self.asic_state.get_state_time(state), self.get_asic_vlan_reachability()
 
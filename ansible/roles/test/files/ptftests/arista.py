@@ -33,6 +33,8 @@ from operator import itemgetter
 import scapy.all as scapyall
 import enum
 
+from reboot_analysis import PEER_METRICS, SampleStore, series_status
+
 class Arista(object):
     DEBUG = False
     def __init__(self, ip, queue, test_params, login='admin', password='123456'):
@@ -48,6 +50,16 @@ class Arista(object):
         self.info = set()
         self.min_bgp_gr_timeout = int(test_params['min_bgp_gr_timeout'])
         self.reboot_type = test_params['reboot_type']
+        self.device_clock = True    # Timestamp samples by 'show clock' of the device
+
+        # Polling state, see start(), poll() and finish()
+        self.store = None
+        self.raw_store = None
+        self.run_once = False
+        self.log_first_line = None
+        self.quit_enabled = False
+        self.v4_routing_ok = False
+        self.v6_routing_ok = False
 
     def __del__(self):
         self.disconnect()
@@ -85,6 +97,33 @@ class Arista(object):
 
         return input_buffer
 
+    def do_cmds(self, cmds, prompt = None):
+        """
+        Sends all the commands in one round trip and returns the list of their outputs,
+        every output is the same as do_cmd() would return for the command.
+        """
+        if prompt == None:
+            prompt = self.arista_prompt
+
+        self.shell.send(''.join(cmd + '\n' for cmd in cmds))
+
+        prompt_re = re.compile(prompt)
+        input_buffer = ''
+        ends = []
+        while len(ends) < len(cmds):
+            input_buffer += self.shell.recv(16384)
+            ends = [m.end() for m in prompt_re.finditer(input_buffer)]
+
+        ends = ends[:len(cmds)]
+        return [input_buffer[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+    def parse_clock(self, output):
+        data = "\n".join(output.split("\r\n")[1:-1])
+        try:
+            return float(json.loads(data, strict=False)['utcTime'])
+        except (ValueError, KeyError, TypeError):
+            return None
+
     def disconnect(self):
         if self.conn is not None:
             self.conn.close()
@@ -93,65 +132,80 @@ class Arista(object):
         return
 
     def run(self):
-        data = {}
-        debug_data = {}
-        run_once = False
-        log_first_line = None
-        quit_enabled = False
-        v4_routing_ok = False
-        v6_routing_ok = False
-        routing_works = True
-        self.connect()
+        self.start()
 
-        cur_time = time.time()
-        sample = {}
-        samples = {}
-        portchannel_output = self.do_cmd("show interfaces po1 | json")
-        portchannel_output = "\n".join(portchannel_output.split("\r\n")[1:-1])
-        sample["po_changetime"] = json.loads(portchannel_output, strict=False)['interfaces']['Port-Channel1']['lastStatusChangeTimestamp']
-        samples[cur_time] = sample
-
-        while not (quit_enabled and v4_routing_ok and v6_routing_ok):
+        while not self.is_done():
             cmd = self.queue.get()
             if cmd == 'quit':
-                quit_enabled = True
+                self.quit_enabled = True
                 continue
+            self.poll()
+
+        return self.finish()
+
+    def start(self):
+        self.connect()
+
+        clock_output, portchannel_output = self.do_cmds(["show clock | json", "show interfaces po1 | json"])
+        cur_time = self.parse_clock(clock_output)
+        if cur_time is None:
+            self.device_clock = False
+            cur_time = time.time()
+        # Samples are streamed to disk for troubleshooting, only the state changes are kept in memory
+        self.store = SampleStore(PEER_METRICS, "/tmp/%s.samples" % self.ip)
+        if self.DEBUG:
+            self.raw_store = SampleStore((), "/tmp/%s.raw" % self.ip)
+        self.store.append(cur_time, {'po_changetime': self.parse_po_changetime(portchannel_output)})
+
+    def is_done(self):
+        return self.quit_enabled and self.v4_routing_ok and self.v6_routing_ok
+
+    def poll(self):
+        """
+        Takes one sample of the peer state. All the commands are sent in one round trip,
+        and the sample is timestamped by the device clock.
+        """
+        cmds = ['show lacp neighbor', 'show ip bgp neighbors', 'show ip route bgp | json', 'show ipv6 route bgp | json', 'show interfaces po1 | json']
+        if self.device_clock:
+            cmds.append('show clock | json')
+        outputs = self.do_cmds(cmds)
+        lacp_output, bgp_neig_output, bgp_route_v4_output, bgp_route_v6_output, portchannel_output = outputs[:5]
+
+        cur_time = self.parse_clock(outputs[5]) if self.device_clock else None
+        if cur_time is None:
             cur_time = time.time()
-            info = {}
-            debug_info = {}
-            lacp_output = self.do_cmd('show lacp neighbor')
-            info['lacp'] = self.parse_lacp(lacp_output)
-            bgp_neig_output = self.do_cmd('show ip bgp neighbors')
-            info['bgp_neig'] = self.parse_bgp_neighbor(bgp_neig_output)
-
-            bgp_route_v4_output = self.do_cmd('show ip route bgp | json')
-            v4_routing_ok = self.parse_bgp_route(bgp_route_v4_output, self.v4_routes)
-            info['bgp_route_v4'] = v4_routing_ok
-
-            bgp_route_v6_output = self.do_cmd("show ipv6 route bgp | json")
-            v6_routing_ok = self.parse_bgp_route(bgp_route_v6_output, self.v6_routes)
-            info["bgp_route_v6"] = v6_routing_ok
-
-            portchannel_output = self.do_cmd("show interfaces po1 | json")
-            portchannel_output = "\n".join(portchannel_output.split("\r\n")[1:-1])
-            sample["po_changetime"] = json.loads(portchannel_output, strict=False)['interfaces']['Port-Channel1']['lastStatusChangeTimestamp']
-
-            if not run_once:
-                self.ipv4_gr_enabled, self.ipv6_gr_enabled, self.gr_timeout = self.parse_bgp_neighbor_once(bgp_neig_output)
-                if self.gr_timeout is not None:
-                    log_first_line = "session_begins_%f" % cur_time
-                    self.do_cmd("send log message %s" % log_first_line)
-                    run_once = True
-
-            data[cur_time] = info
-            samples[cur_time] = sample
-            if self.DEBUG:
-                debug_data[cur_time] = {
-                    'show lacp neighbor' : lacp_output,
-                    'show ip bgp neighbors' : bgp_neig_output,
-                    'show ip route bgp' : bgp_route_v4_output,
-                    'show ipv6 route bgp' : bgp_route_v6_output,
-                }
+        info = {}
+        info['lacp'] = self.parse_lacp(lacp_output)
+        info['bgp_neig'] = self.parse_bgp_neighbor(bgp_neig_output)
+        info['bgp_gr_timer_ok'] = self.check_gr_timer(info['bgp_neig'])
+
+        self.v4_routing_ok = self.parse_bgp_route(bgp_route_v4_output, self.v4_routes)
+        info['bgp_route_v4'] = self.v4_routing_ok
+
+        self.v6_routing_ok = self.parse_bgp_route(bgp_route_v6_output, self.v6_routes)
+        info["bgp_route_v6"] = self.v6_routing_ok
+
+        info['po_changetime'] = self.parse_po_changetime(portchannel_output)
+
+        if not self.run_once:
+            self.ipv4_gr_enabled, self.ipv6_gr_enabled, self.gr_timeout = self.parse_bgp_neighbor_once(bgp_neig_output)
+            if self.gr_timeout is not None:
+                self.log_first_line = "session_begins_%f" % cur_time
+                self.do_cmd("send log message %s" % self.log_first_line)
+                self.run_once = True
+
+        self.store.append(cur_time, info)
+        if self.DEBUG:
+            self.raw_store.append(cur_time, {
+                'show lacp neighbor' : lacp_output,
+                'show ip bgp neighbors' : bgp_neig_output,
+                'show ip route bgp' : bgp_route_v4_output,
+                'show ipv6 route bgp' : bgp_route_v6_output,
+            })
+
+    def finish(self):
+        store = self.store
+        log_first_line = self.log_first_line
 
         attempts = 60
         log_present = False
@@ -171,23 +225,19 @@ class Arista(object):
 
         self.disconnect()
 
-        # save data for troubleshooting
-        with open("/tmp/%s.data.pickle" % self.ip, "w") as fp:
-            pickle.dump(data, fp)
-
-        # save debug data for troubleshooting
+        # samples are already saved for troubleshooting
+        store.close()
         if self.DEBUG:
-            with open("/tmp/%s.raw.pickle" % self.ip, "w") as fp:
-                pickle.dump(debug_data, fp)
+            self.raw_store.close()
             with open("/tmp/%s.logging" % self.ip, "w") as fp:
                 fp.write("\n".join(log_lines))
 
-        self.check_gr_peer_status(data)
+        self.check_gr_peer_status(store)
         cli_data = {}
-        cli_data['lacp']   = self.check_series_status(data, "lacp",         "LACP session")
-        cli_data['bgp_v4'] = self.check_series_status(data, "bgp_route_v4", "BGP v4 routes")
-        cli_data['bgp_v6'] = self.check_series_status(data, "bgp_route_v6", "BGP v6 routes")
-        cli_data['po']     = self.check_change_time(samples, "po_changetime", "PortChannel interface")
+        cli_data['lacp']   = self.check_series_status(store, "lacp",         "LACP session")
+        cli_data['bgp_v4'] = self.check_series_status(store, "bgp_route_v4", "BGP v4 routes")
+        cli_data['bgp_v6'] = self.check_series_status(store, "bgp_route_v6", "BGP v6 routes")
+        cli_data['po']     = self.check_change_time(store, "po_changetime", "PortChannel interface")
 
         route_timeout             = log_data['route_timeout']
         cli_data['route_timeout'] = route_timeout
@@ -287,6 +337,10 @@ class Arista(object):
 
         return result
 
+    def parse_po_changetime(self, output):
+        data = "\n".join(output.split("\r\n")[1:-1])
+        return json.loads(data, strict=False)['interfaces']['Port-Channel1']['lastStatusChangeTimestamp']
+
     def parse_lacp(self, output):
         return output.find('Bundled') != -1
 
@@ -432,62 +486,29 @@ class Arista(object):
         if self.gr_timeout < 120: # bgp graceful restart timeout less then 120 seconds
             self.fails.add("bgp graceful restart timeout is less then 120 seconds")
 
-        for when, other in sorted(output.items(), key = lambda x : x[0]):
-            gr_active, timer = other['bgp_neig']
-            # wnen it's False, it's ok, wnen it's True, check that inactivity timer not less then self.min_bgp_gr_timeout seconds
-            if gr_active and datetime.datetime.strptime(timer, '%H:%M:%S') < datetime.datetime(1900, 1, 1, second = self.min_bgp_gr_timeout):
-                self.fails.add("graceful restart timer is almost finished. Less then %d seconds left" % self.min_bgp_gr_timeout)
+        if False in output.states['bgp_gr_timer_ok']:
+            self.fails.add("graceful restart timer is almost finished. Less then %d seconds left" % self.min_bgp_gr_timeout)
 
-    def check_series_status(self, output, entity, what):
-        # find how long anything was down
-        # Input parameter is a dictionary when:status
-        # constraints:
-        # entity must be down just once
-        # entity must be up when the test starts
-        # entity must be up when the test stops
-
-        sorted_keys = sorted(output.keys())
-        if not output[sorted_keys[0]][entity]:
-            self.fails.add("%s must be up when the test starts" % what)
-            return 0, 0
-        if not output[sorted_keys[-1]][entity]:
-            self.fails.add("%s must be up when the test stops" % what)
-            return 0, 0
+    def check_gr_timer(self, bgp_neig):
+        gr_active, timer = bgp_neig
+        # wnen it's False, it's ok, wnen it's True, check that inactivity timer not less then self.min_bgp_gr_timeout seconds
+        return not (gr_active and datetime.datetime.strptime(timer, '%H:%M:%S') < datetime.datetime(1900, 1, 1, second = self.min_bgp_gr_timeout))
 
-        start = sorted_keys[0]
-        cur_state = True
-        res = defaultdict(list)
-        for when in sorted_keys[1:]:
-            if cur_state != output[when][entity]:
-                res[cur_state].append(when - start)
-                start = when
-                cur_state = output[when][entity]
-        res[cur_state].append(when - start)
-
-        is_down_count = len(res[False])
-
-        if is_down_count > 1:
-            self.info.add("%s must be down just for once" % what)
-
-        return is_down_count, sum(res[False]) # summary_downtime
+    def check_series_status(self, output, entity, what):
+        return series_status(output, entity, what, self.fails, self.info)
 
     def check_change_time(self, output, entity, what):
         # find last changing time updated, if no update, the entity is never changed
-        # Input parameter is a dictionary when:last_changing_time
+        # Input parameter is a SampleStore with metric entity: last_changing_time
         # constraints:
-        # the dictionary `output` cannot be empty
-        sorted_keys = sorted(output.keys())
-        if not output:
+        # the metric cannot be empty
+        transitions = output.transitions(entity)
+        if not transitions:
             self.fails.add("%s cannot be empty" % what)
             return 0, 0
 
-        start = sorted_keys[0]
-        prev_time = output[start]
-        change_count = 0
-        for when in sorted_keys[1:]:
-            if prev_time != output[when][entity]:
-                prev_time = output[when][entity]
-                change_count += 1
+        # the first sample is the initial state
+        change_count = len(transitions) - 1
 
         if change_count > 0:
             self.info.add("%s state changed %d times" % (what, change_count))
@@ -495,3 +516,70 @@ class Arista(object):
         # Note: the first item is a placeholder
         return 0, change_count
 
+
+class PeerPoller(object):
+    """
+    Polls the state of all the peers from a bounded pool of workers.
+    Every interval each peer, which isn't busy with the previous poll, is polled once more.
+    After quit() a peer is finished as soon as its routes are up, then on_finish(ip, result, error) is called
+    with result of Arista.finish() or with the error which stopped the polling of the peer.
+    """
+    def __init__(self, peers, workers, interval, on_finish):
+        self.peers = peers
+        self.interval = interval
+        self.on_finish = on_finish
+        self.pool = ThreadPool(processes=max(1, min(workers, len(peers))))
+        self.lock = threading.Lock()
+        self.busy = set()
+        self.finished = set()
+        self.all_finished = threading.Event()
+        if not peers:
+            self.all_finished.set()
+        self.ticker = threading.Thread(target=self.tick)
+        self.ticker.setDaemon(True)
+
+    def start(self):
+        for peer in self.peers:
+            self.submit(peer, peer.start)
+        self.ticker.start()
+
+    def submit(self, peer, func):
+        with self.lock:
+            if peer.ip in self.busy or peer.ip in self.finished:
+                return
+            self.busy.add(peer.ip)
+        self.pool.apply_async(self.work, (peer, func))
+
+    def work(self, peer, func):
+        result, error = None, None
+        try:
+            func()
+            if peer.is_done():
+                result = peer.finish()
+        except Exception as e:
+            error = e
+        done = result is not None or error is not None
+        if done:
+            self.on_finish(peer.ip, result, error)
+        with self.lock:
+            self.busy.discard(peer.ip)
+            if done:
+                self.finished.add(peer.ip)
+                if len(self.finished) == len(self.peers):
+                    self.all_finished.set()
+
+    def tick(self):
+        while not self.all_finished.wait(self.interval):
+            for peer in self.peers:
+                self.submit(peer, peer.poll)
+
+    def quit(self):
+        for peer in self.peers:
+            peer.quit_enabled = True
+
+    def is_alive(self):
+        return not self.all_finished.is_set()
+
+    def join(self, timeout=None):
+        self.all_finished.wait(timeout)
+        return not self.is_alive()
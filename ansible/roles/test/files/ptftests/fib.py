@@ -1,6 +1,5 @@
 import re
-from ipaddress import ip_address, ip_network
-from lpm import LpmDict
+from lpm import LpmDict, parse_prefix, int_to_ip
 
 # These subnets are excluded from FIB test
 # reference: RFC 5735 Special Use IPv4 Addresses
@@ -51,26 +50,31 @@ class Fib():
         for ip in EXCLUDE_IPV6_PREFIXES:
             self._ipv6_lpm_dict[ip] = self.NextHop()
 
-        # filter out empty lines and lines starting with '#'
-        pattern = re.compile("^#.*$|^[ \t]*$")
+        # routes usually share a small number of next hops,
+        # so the same NextHop instance is used for the same next hop string
+        next_hops = {}
 
         with open(file_path, 'r') as f:
-            for line in f.readlines():
-                if pattern.match(line): continue
+            for line in f:
+                # filter out empty lines and lines starting with '#'
+                if line.startswith('#') or not line.strip(): continue
                 entry = line.split(' ', 1)
-                prefix = ip_network(unicode(entry[0]))
-                next_hop = self.NextHop(entry[1])
-                if prefix.version is 4:
-                    self._ipv4_lpm_dict[str(prefix)] = next_hop
-                elif prefix.version is 6:
-                    self._ipv6_lpm_dict[str(prefix)] = next_hop
+                ipv4, first, _, prefixlen = parse_prefix(entry[0])
+                next_hop = next_hops.get(entry[1])
+                if next_hop is None:
+                    next_hop = next_hops[entry[1]] = self.NextHop(entry[1])
+                prefix = int_to_ip(first, ipv4) + '/' + str(prefixlen)
+                if ipv4:
+                    self._ipv4_lpm_dict[prefix] = next_hop
+                else:
+                    self._ipv6_lpm_dict[prefix] = next_hop
 
     def __getitem__(self, ip):
-        ip = ip_address(unicode(ip))
-        if ip.version is 4:
-            return self._ipv4_lpm_dict[str(ip)]
-        elif ip.version is 6:
-            return self._ipv6_lpm_dict[str(ip)]
+        ip = str(ip)
+        if ':' in ip:
+            return self._ipv6_lpm_dict[ip]
+        else:
+            return self._ipv4_lpm_dict[ip]
 
     def ipv4_ranges(self):
         return self._ipv4_lpm_dict.ranges()
@@ -0,0 +1,229 @@
+"""
+Benchmark of loading the FIB of the FIB test.
+
+A synthetic fib_info file is generated and loaded once by Fib and LpmDict as
+they were before range boundaries became ints (kept below as OldFib and
+OldLpmDict) and once by the current fib.Fib. Each load runs in its own process,
+so that its peak memory can be reported. Ranges, their lengths, first and
+random IPs and the LPM results of both must be the same:
+
+python fib_bench.py [--prefixes 500000] [--ipv6 10] [--fib fib_info.txt]
+
+--ipv6 is the part of the generated prefixes which are IPv6, in percent. --fib
+loads an existing fib_info file instead of a generated one.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from ipaddress import ip_address, ip_network
+from SubnetTree import SubnetTree
+
+import fib
+
+
+IPV4_PREFIX_LENGTHS = [8, 16, 20, 22, 24, 24, 24, 25, 28, 32]
+IPV6_PREFIX_LENGTHS = [48, 56, 64, 64, 128]
+NEXT_HOPS = ['[%d]' % port for port in range(32)] + ['[0 1] [4 5] [16 17] [20 21]', '[24 25] [26 27]']
+
+
+class OldLpmDict():
+    """lpm.LpmDict as it was before range boundaries became ints"""
+    class IpInterval:
+        def __init__(self, s, e):
+            assert s <= e
+            self._start = s
+            self._end = e
+
+        def length(self):
+            return int(self._end) - int(self._start)
+
+        def get_first_ip(self):
+            return str(self._start)
+
+        def get_random_ip(self):
+            diff = self.length()
+            return str(self._start + random.randint(0, diff))
+
+        def __str__(self):
+            return str(self._start) + ' - ' + str(self._end)
+
+    def __init__(self, ipv4=True):
+        self._ipv4 = ipv4
+        self._prefix_set = set()
+        self._subnet_tree = SubnetTree()
+        self._boundaries = { ip_address(u'0.0.0.0') : 1} if ipv4 else { ip_address(u'::') : 1}
+
+    def __setitem__(self, key, value):
+        prefix = ip_network(unicode(key))
+        if prefix.prefixlen and key not in self._prefix_set:
+            boundary = prefix[0]
+            self._boundaries[boundary] = self._boundaries.get(boundary, 0) + 1
+            if prefix[-1] != ip_address(u'255.255.255.255') and prefix[-1] != ip_address(u'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff'):
+                next_boundary = prefix[-1] + 1
+                self._boundaries[next_boundary] = self._boundaries.get(next_boundary, 0) + 1
+            self._prefix_set.add(key)
+        self._subnet_tree.__setitem__(key, value)
+
+    def __getitem__(self, key):
+        return self._subnet_tree[key]
+
+    def ranges(self):
+        sorted_boundaries = sorted(self._boundaries.keys())
+        ranges = []
+        for index, boundary in enumerate(sorted_boundaries):
+            if index != len(sorted_boundaries) - 1:
+                interval = self.IpInterval(sorted_boundaries[index], sorted_boundaries[index + 1] - 1)
+            else:
+                if self._ipv4:
+                    interval = self.IpInterval(sorted_boundaries[index], ip_address(u'255.255.255.255'))
+                else:
+                    interval = self.IpInterval(sorted_boundaries[index], ip_address(u'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff'))
+            ranges.append(interval)
+        return ranges
+
+
+class OldFib():
+    """fib.Fib as it was before range boundaries became ints"""
+    class NextHop():
+        def __init__(self, next_hop = ''):
+            self._next_hop = []
+            matches = re.findall('\[([\s\d]+)\]', next_hop)
+            for match in matches:
+                self._next_hop.append([int(s) for s in match.split()])
+
+        def __str__(self):
+            return str(self._next_hop)
+
+    def __init__(self, file_path):
+        self._ipv4_lpm_dict = OldLpmDict()
+        for ip in fib.EXCLUDE_IPV4_PREFIXES:
+            self._ipv4_lpm_dict[ip] = self.NextHop()
+
+        self._ipv6_lpm_dict = OldLpmDict(ipv4=False)
+        for ip in fib.EXCLUDE_IPV6_PREFIXES:
+            self._ipv6_lpm_dict[ip] = self.NextHop()
+
+        pattern = re.compile("^#.*$|^[ \t]*$")
+
+        with open(file_path, 'r') as f:
+            for line in f.readlines():
+                if pattern.match(line): continue
+                entry = line.split(' ', 1)
+                prefix = ip_network(unicode(entry[0]))
+                next_hop = self.NextHop(entry[1])
+                if prefix.version is 4:
+                    self._ipv4_lpm_dict[str(prefix)] = next_hop
+                elif prefix.version is 6:
+                    self._ipv6_lpm_dict[str(prefix)] = next_hop
+
+    def __getitem__(self, ip):
+        ip = ip_address(unicode(ip))
+        if ip.version is 4:
+            return self._ipv4_lpm_dict[str(ip)]
+        elif ip.version is 6:
+            return self._ipv6_lpm_dict[str(ip)]
+
+    def ipv4_ranges(self):
+        return self._ipv4_lpm_dict.ranges()
+
+    def ipv6_ranges(self):
+        return self._ipv6_lpm_dict.ranges()
+
+
+def generate_fib(path, count, ipv6_percent):
+    rnd = random.Random(0)
+    with open(path, 'w') as fib_file:
+        fib_file.write('# synthetic fib\n0.0.0.0/0 [0 1] [4 5] [16 17] [20 21]\n\n')
+        for _ in xrange(count):
+            if rnd.randint(0, 99) >= ipv6_percent:
+                length = rnd.choice(IPV4_PREFIX_LENGTHS)
+                address = rnd.getrandbits(32) & ~((1 << (32 - length)) - 1)
+                prefix = '%d.%d.%d.%d/%d' % (address >> 24, (address >> 16) & 255, (address >> 8) & 255, address & 255, length)
+            else:
+                length = rnd.choice(IPV6_PREFIX_LENGTHS)
+                address = (0x20c0 << 112 | rnd.getrandbits(112)) & ~((1 << (128 - length)) - 1)
+                digits = '%032x' % address
+                prefix = ':'.join(digits[i:i + 4] for i in range(0, 32, 4)) + '/%d' % length
+            fib_file.write('%s %s\n' % (prefix, rnd.choice(NEXT_HOPS)))
+
+
+def load_worker(method, fib_path):
+    """loads the fib with one of the implementations and prints the results of the process as json"""
+    fib_class = OldFib if method == 'old' else fib.Fib
+
+    start = time.time()
+    loaded = fib_class(fib_path)
+    load_time = time.time() - start
+
+    start = time.time()
+    ipv4_ranges = loaded.ipv4_ranges()
+    ipv6_ranges = loaded.ipv6_ranges()
+    ranges_time = time.time() - start
+
+    random.seed(1)
+    digest = hashlib.sha1()
+    for interval in ipv4_ranges + ipv6_ranges:
+        first_ip = interval.get_first_ip()
+        digest.update('%s %d %s %s\n' % (interval, interval.length(), loaded[first_ip], interval.get_random_ip()))
+
+    print json.dumps({'load': load_time,
+                      'ranges': ranges_time,
+                      'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      'ipv4_ranges': len(ipv4_ranges),
+                      'ipv6_ranges': len(ipv6_ranges),
+                      'digest': digest.hexdigest()})
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FIB load benchmark')
+    parser.add_argument('--prefixes', type=int, default=500000, help='number of generated prefixes')
+    parser.add_argument('--ipv6', type=int, default=10, help='part of the generated prefixes which are IPv6, in percent')
+    parser.add_argument('--fib', help='load this fib_info file instead of a generated one')
+    parser.add_argument('--worker', choices=['old', 'new'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return load_worker(args.worker, args.fib)
+
+    work_dir = None
+    fib_path = args.fib
+    try:
+        if fib_path is None:
+            work_dir = tempfile.mkdtemp()
+            fib_path = os.path.join(work_dir, 'fib_info.txt')
+            generate_fib(fib_path, args.prefixes, args.ipv6)
+            print "Generated %d prefixes, %d%% IPv6" % (args.prefixes, args.ipv6)
+
+        results = {}
+        for method in ('old', 'new'):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--worker', method, '--fib', fib_path])
+            results[method] = json.loads(output)
+            print "%s Fib: load %.1f seconds, ranges %.1f seconds, max RSS %dMB, %d IPv4 and %d IPv6 ranges" % \
+                (method, results[method]['load'], results[method]['ranges'], results[method]['max_rss'] // 1024,
+                 results[method]['ipv4_ranges'], results[method]['ipv6_ranges'])
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+
+    if results['old']['digest'] != results['new']['digest']:
+        print "ERROR: the ranges or LPM results differ"
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,10 +10,12 @@ Usage:          Examples of how to use log analyzer
 #---------------------------------------------------------------------
 # Global imports
 #---------------------------------------------------------------------
+import collections
 import ipaddress
 import logging
 import random
 import socket
+import struct
 import sys
 
 import ptf
@@ -26,6 +28,7 @@ from ptf.mask import Mask
 from ptf.testutils import *
 
 import fib
+from raw_sender import monotonic
 
 class FibTest(BaseTest):
     '''
@@ -61,6 +64,18 @@ class FibTest(BaseTest):
     DEFAULT_BALANCING_RANGE = 0.25
     BALANCING_TEST_TIMES = 10000
     DEFAULT_BALANCING_TEST_RATIO = 0.0001
+    DEFAULT_PIPELINE_WINDOW = 0
+    # Seconds after sending a probe after which it is considered lost
+    PIPELINE_TIMEOUT = 1
+
+    # Offsets of the fields patched in raw probe packets
+    ETH_HDR_LEN = 14
+    IPV4_HDR_LEN = 20
+    IPV4_CSUM_OFFSET = ETH_HDR_LEN + 10
+    IPV4_DST_OFFSET = ETH_HDR_LEN + 16
+    IPV6_DST_OFFSET = ETH_HDR_LEN + 24
+    IPV6_TCP_OFFSET = ETH_HDR_LEN + 40
+    TCP_CSUM_OFFSET = 16
 
     def __init__(self):
         '''
@@ -82,6 +97,8 @@ class FibTest(BaseTest):
            port
          - src_port: this list should include all enabled ports, both up links
                      and down links.
+         - pipeline_window: if set, route checks of the ranges are pipelined with up
+           to this number of packets in flight, see check_ip_routes_pipelined()
         TODO: Have a separate line in fib_info/file to indicate all UP ports
         '''
         self.dataplane = ptf.dataplane_instance
@@ -94,6 +111,7 @@ class FibTest(BaseTest):
 
         self.balancing_range = self.test_params.get('balancing_range', self.DEFAULT_BALANCING_RANGE)
         self.balancing_test_ratio = self.test_params.get('balancing_test_ratio', self.DEFAULT_BALANCING_TEST_RATIO)
+        self.pipeline_window = self.test_params.get('pipeline_window', self.DEFAULT_PIPELINE_WINDOW)
 
         # Provide the list of all UP interfaces with index in sequence order starting from 0
         if self.test_params['testbed_type'] == 't1' or self.test_params['testbed_type'] == 't1-lag':
@@ -116,6 +134,7 @@ class FibTest(BaseTest):
         else:
             ip_ranges = self.fib.ipv6_ranges()
 
+        probes = []
         for ip_range in ip_ranges:
 
             # Get the expected list of ports that would receive the packets
@@ -129,13 +148,19 @@ class FibTest(BaseTest):
             logging.info("Check IP range:" + str(ip_range) + " on " + str(exp_port_list) + "...")
 
             # Send a packet with the first IP in the range
-            self.check_ip_route(src_port, ip_range.get_first_ip(), exp_port_list, ipv4)
+            dst_ips = [ip_range.get_first_ip()]
             # Send a packet with the last IP in the range
             if ip_range.length() > 1:
-                self.check_ip_route(src_port, ip_range.get_last_ip(), exp_port_list, ipv4)
+                dst_ips.append(ip_range.get_last_ip())
             # Send a packet with a random IP in the range
             if ip_range.length() > 2:
-                self.check_ip_route(src_port, ip_range.get_random_ip(), exp_port_list, ipv4)
+                dst_ips.append(ip_range.get_random_ip())
+
+            if self.pipeline_window:
+                probes.extend((src_port, dst_ip, exp_port_list) for dst_ip in dst_ips)
+            else:
+                for dst_ip in dst_ips:
+                    self.check_ip_route(src_port, dst_ip, exp_port_list, ipv4)
 
             # Test traffic balancing across ECMP/LAG members
             if len(exp_port_list) > 1 and random.random() < self.balancing_test_ratio:
@@ -147,6 +172,177 @@ class FibTest(BaseTest):
                     hit_count_map[matched_index] = hit_count_map.get(matched_index, 0) + 1
                 self.check_balancing(self.fib[dst_ip].get_next_hop(), hit_count_map)
 
+        if probes:
+            self.check_ip_routes_pipelined(probes, ipv4)
+
+    def check_ip_routes_pipelined(self, probes, ipv4=True):
+        '''
+        @summary: Check routes by sending up to pipeline_window packets back-to-back
+        and matching the packets coming back from the switch by flow (destination IP
+        and TCP ports), instead of waiting for each packet before sending the next one.
+        Packets are patched copies of a single raw template built once.
+        A packet coming back is accepted when it is the routed probe (the same packet
+        as the one check_ip_route() expects, any destination MAC) and it came back on
+        one of the expected ports. A probe which isn't accepted within PIPELINE_TIMEOUT
+        after it was sent is lost.
+        @param probes: list of (src_port, dst_ip, exp_port_list)
+        '''
+        template = self.build_probe_template(ipv4)
+        exp_template = self.build_probe_template(ipv4, routed=True)
+        family = socket.AF_INET if ipv4 else socket.AF_INET6
+
+        # flow -> (src_port, dst_ip, exp_port_list, expected packet, deadline), in the order of sending
+        outstanding = collections.OrderedDict()
+        failed = []
+        next_probe = 0
+
+        self.dataplane.flush()
+        logging.info("Check %d routes with up to %d packets in flight..." % (len(probes), self.pipeline_window))
+
+        while next_probe < len(probes) or outstanding:
+            while next_probe < len(probes) and len(outstanding) < self.pipeline_window:
+                src_port, dst_ip, exp_port_list = probes[next_probe]
+                next_probe += 1
+
+                dst = socket.inet_pton(family, dst_ip)
+                while True:
+                    sport = random.randint(0, 65535)
+                    dport = random.randint(0, 65535)
+                    flow = (dst, struct.pack('!HH', sport, dport))
+                    if flow not in outstanding:
+                        break
+                exp_pkt = str(self.build_probe(exp_template, ipv4, dst, sport, dport))
+                send_packet(self, src_port, str(self.build_probe(template, ipv4, dst, sport, dport)))
+                outstanding[flow] = (src_port, dst_ip, exp_port_list, exp_pkt, monotonic() + self.PIPELINE_TIMEOUT)
+
+            # Probes are expired on every turn, unrelated packets keep coming back all the time
+            now = monotonic()
+            while outstanding:
+                flow, (src_port, dst_ip, exp_port_list, exp_pkt, deadline) = next(outstanding.iteritems())
+                if deadline > now:
+                    break
+                logging.error("Packet from port %d to %s wasn't received" % (src_port, dst_ip))
+                failed.append(dst_ip)
+                del outstanding[flow]
+
+            if not outstanding:
+                continue
+
+            result = dp_poll(self, device_number=0, timeout=deadline - now)
+            if not isinstance(result, self.dataplane.PollSuccess):
+                continue
+
+            pkt = str(result.packet)
+            flow = self.parse_probe_flow(pkt, ipv4)
+            if flow not in outstanding:
+                continue
+            src_port, dst_ip, exp_port_list, exp_pkt, _ = outstanding[flow]
+            # Destination MAC is not checked, the rest must be the packet check_ip_route() expects
+            if len(pkt) < len(exp_pkt) or pkt[6:len(exp_pkt)] != exp_pkt[6:]:
+                continue
+
+            del outstanding[flow]
+            if result.port not in exp_port_list:
+                logging.error("Packet from port %d to %s received at %d, expected one of %s"
+                              % (src_port, dst_ip, result.port, str(exp_port_list)))
+                failed.append(dst_ip)
+
+        assert not failed
+
+    def build_probe_template(self, ipv4=True, routed=False):
+        '''
+        @summary: Build raw packet for check_ip_routes_pipelined(). Destination IP and
+        TCP ports are zero and are patched in for each packet by build_probe().
+        @param routed: build the packet expected to come back from the switch instead
+        of the one sent to it, see check_ipv4_route() and check_ipv6_route()
+        '''
+        if routed:
+            eth = {'eth_src': self.router_mac}
+        else:
+            eth = {'eth_dst': self.router_mac, 'eth_src': self.dataplane.get_mac(0, 0)}
+
+        if ipv4:
+            pkt = simple_tcp_packet(
+                                pktlen=self.pktlen,
+                                ip_src="10.0.0.1",
+                                ip_dst="0.0.0.0",
+                                tcp_sport=0,
+                                tcp_dport=0,
+                                ip_ttl=63 if routed else 64,
+                                **eth)
+        else:
+            pkt = simple_tcpv6_packet(
+                                pktlen=self.pktlen,
+                                ipv6_dst="::",
+                                ipv6_src="2000::1",
+                                tcp_sport=0,
+                                tcp_dport=0,
+                                ipv6_hlim=63 if routed else 64,
+                                **eth)
+
+        return bytearray(str(pkt))
+
+    def build_probe(self, template, ipv4, dst, sport, dport):
+        '''
+        @summary: Patch a copy of the template with destination IP and TCP ports.
+        @param dst: packed destination IP
+        '''
+        pkt = bytearray(template)
+
+        if ipv4:
+            pkt[self.IPV4_DST_OFFSET:self.IPV4_DST_OFFSET + 4] = dst
+            # IPv4 header checksum is recalculated, it covers just 20 bytes
+            pkt[self.IPV4_CSUM_OFFSET:self.IPV4_CSUM_OFFSET + 2] = '\0\0'
+            header = pkt[self.ETH_HDR_LEN:self.ETH_HDR_LEN + self.IPV4_HDR_LEN]
+            struct.pack_into('!H', pkt, self.IPV4_CSUM_OFFSET, self.checksum(header))
+            tcp_offset = self.ETH_HDR_LEN + self.IPV4_HDR_LEN
+        else:
+            pkt[self.IPV6_DST_OFFSET:self.IPV6_DST_OFFSET + 16] = dst
+            tcp_offset = self.IPV6_TCP_OFFSET
+
+        struct.pack_into('!HH', pkt, tcp_offset, sport, dport)
+
+        # TCP checksum covers destination IP (pseudo header) and ports which are zero
+        # in the template, so it is updated incrementally by adding them (RFC 1624)
+        csum = struct.unpack_from('!H', pkt, tcp_offset + self.TCP_CSUM_OFFSET)[0]
+        words = struct.unpack('!%dH' % (len(dst) / 2), dst) + (sport, dport)
+        struct.pack_into('!H', pkt, tcp_offset + self.TCP_CSUM_OFFSET, self.checksum(words, ~csum & 0xffff))
+
+        return pkt
+
+    @staticmethod
+    def checksum(data, initial=0):
+        '''
+        @summary: Internet checksum of data (bytes or list of 16-bit words)
+        '''
+        if not isinstance(data, tuple):
+            data = struct.unpack('!%dH' % (len(data) / 2), str(data))
+        total = initial + sum(data)
+        while total >> 16:
+            total = (total & 0xffff) + (total >> 16)
+        return ~total & 0xffff
+
+    def parse_probe_flow(self, pkt, ipv4=True):
+        '''
+        @summary: Extract the flow (destination IP and TCP ports) from a received raw packet
+        @return: flow, None if the packet is not TCP
+        '''
+        ethertype = pkt[12:14]
+        if ipv4 and ethertype == '\x08\x00' and len(pkt) >= self.ETH_HDR_LEN + self.IPV4_HDR_LEN:
+            if ord(pkt[self.ETH_HDR_LEN + 9]) != socket.IPPROTO_TCP:
+                return None
+            tcp_offset = self.ETH_HDR_LEN + (ord(pkt[self.ETH_HDR_LEN]) & 0xf) * 4
+            dst = pkt[self.IPV4_DST_OFFSET:self.IPV4_DST_OFFSET + 4]
+        elif not ipv4 and ethertype == '\x86\xdd' and len(pkt) >= self.IPV6_TCP_OFFSET:
+            if ord(pkt[self.ETH_HDR_LEN + 6]) != socket.IPPROTO_TCP:
+                return None
+            tcp_offset = self.IPV6_TCP_OFFSET
+            dst = pkt[self.IPV6_DST_OFFSET:self.IPV6_DST_OFFSET + 16]
+        else:
+            return None
+
+        return dst, pkt[tcp_offset:tcp_offset + 4]
+
     def check_ip_route(self, src_port, dst_ip_addr, dst_port_list, ipv4=True):
         if ipv4:
             (matched_index, received) = self.check_ipv4_route(src_port, dst_ip_addr, dst_port_list)
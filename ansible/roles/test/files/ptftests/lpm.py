@@ -1,8 +1,48 @@
 import random
+import socket
+import struct
 
-from ipaddress import ip_address, ip_network
+from binascii import hexlify
+from ipaddress import ip_address, IPv6Address
 from SubnetTree import SubnetTree
 
+IPV4_MAX = (1 << 32) - 1
+IPV6_MAX = (1 << 128) - 1
+
+def parse_prefix(prefix):
+    '''
+    Parse an IPv4 or IPv6 prefix string ('192.168.0.0/24', '20c0:a800::/64',
+    or an address without length) into a tuple of
+    (ipv4, first address as int, last address as int, prefix length).
+    Raises ValueError if the prefix is malformed or has host bits set.
+    '''
+    address, _, length = prefix.partition('/')
+    try:
+        if ':' in address:
+            ipv4 = False
+            bits = 128
+            value = int(hexlify(socket.inet_pton(socket.AF_INET6, address)), 16)
+        else:
+            ipv4 = True
+            bits = 32
+            value = struct.unpack('!I', socket.inet_pton(socket.AF_INET, address))[0]
+    except socket.error:
+        raise ValueError('%s does not appear to be an IPv4 or IPv6 network' % prefix)
+
+    length = int(length) if length else bits
+    if length < 0 or length > bits:
+        raise ValueError('%s has invalid prefix length' % prefix)
+    host_mask = (1 << (bits - length)) - 1
+    if value & host_mask:
+        raise ValueError('%s has host bits set' % prefix)
+
+    return ipv4, value, value | host_mask, length
+
+def int_to_ip(value, ipv4=True):
+    if ipv4:
+        return socket.inet_ntoa(struct.pack('!I', value))
+    return str(IPv6Address(value))
+
 '''
 LpmDict is a class used in FIB test for LPM and IP segmentation.
 
@@ -24,52 +64,57 @@ To achieve the LPM functionality, use the LpmDict as a dictionary and use
 Please check the test_lpm.py file to see the details of how this class works.
 '''
 class LpmDict():
-    class IpInterval:
-        def __init__(self, s):
-            self._start = s
-            self._end = s
-
-        def __init__(self, s, e):
+    '''
+    IP addresses are kept as ints: boundaries of the ranges are counted in a
+    dict keyed by int and sorted only when ranges() is called. IpInterval
+    converts its ints to strings only when an IP is requested from it.
+    '''
+    class IpInterval(object):
+        __slots__ = ('_start', '_end', '_ipv4')
+
+        def __init__(self, s, e, ipv4=True):
             assert s <= e
             self._start = s
             self._end = e
+            self._ipv4 = ipv4
 
         # __len__ has hard limit on returning long int
         def length(self):
-            return int(self._end) - int(self._start)
+            return self._end - self._start
 
         def contains(self, ip):
+            if not isinstance(ip, (int, long)):
+                ip = int(ip_address(unicode(ip)))
             return ip >= self._start and ip <= self._end
 
         def get_first_ip(self):
-            return str(self._start)
+            return int_to_ip(self._start, self._ipv4)
 
         def get_last_ip(self):
-            return str(self._end)
+            return int_to_ip(self._end, self._ipv4)
 
         def get_random_ip(self):
             diff = self.length()
-            return str(self._start + random.randint(0, diff))
+            return int_to_ip(self._start + random.randint(0, diff), self._ipv4)
 
         def __str__(self):
-            return str(self._start) + ' - ' + str(self._end)
+            return self.get_first_ip() + ' - ' + self.get_last_ip()
 
     def __init__(self, ipv4=True):
         self._ipv4 = ipv4
+        self._max_ip = IPV4_MAX if ipv4 else IPV6_MAX
         self._prefix_set = set()
         self._subnet_tree = SubnetTree()
         # 0.0.0.0 is a non-routable meta-address that needs to be skipped
-        self._boundaries = { ip_address(u'0.0.0.0') : 1} if ipv4 else { ip_address(u'::') : 1}
+        self._boundaries = { 0 : 1 }
 
     def __setitem__(self, key, value):
-        prefix = ip_network(unicode(key))
+        _, first, last, prefixlen = parse_prefix(key)
         # add the current key to self._prefix_set only when it is not the default route and it is not a duplicate key
-        if prefix.prefixlen and key not in self._prefix_set:
-            boundary = prefix[0]
-            self._boundaries[boundary] = self._boundaries.get(boundary, 0) + 1
-            if prefix[-1] != ip_address(u'255.255.255.255') and prefix[-1] != ip_address(u'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff'):
-                next_boundary = prefix[-1] + 1
-                self._boundaries[next_boundary] = self._boundaries.get(next_boundary, 0) + 1
+        if prefixlen and key not in self._prefix_set:
+            self._boundaries[first] = self._boundaries.get(first, 0) + 1
+            if last != self._max_ip:
+                self._boundaries[last + 1] = self._boundaries.get(last + 1, 0) + 1
             self._prefix_set.add(key)
         self._subnet_tree.__setitem__(key, value)
 
@@ -78,9 +123,9 @@ class LpmDict():
 
     def __delitem__(self, key):
         if '/0' not in key:
-            prefix = ip_network(unicode(key))
-            boundary = prefix[0]
-            next_boundary = prefix[-1] + 1
+            _, first, last, _ = parse_prefix(key)
+            boundary = first
+            next_boundary = last + 1
             self._boundaries[boundary] = self._boundaries.get(boundary) - 1
             if not self._boundaries[boundary]:
                 del self._boundaries[boundary]
@@ -91,15 +136,6 @@ class LpmDict():
         self._subnet_tree.__delitem__(key)
 
     def ranges(self):
-        sorted_boundaries = sorted(self._boundaries.keys())
-        ranges = []
-        for index, boundary in enumerate(sorted_boundaries):
-            if index != len(sorted_boundaries) - 1:
-                interval = self.IpInterval(sorted_boundaries[index], sorted_boundaries[index + 1] - 1)
-            else:
-                if self._ipv4:
-                    interval = self.IpInterval(sorted_boundaries[index], ip_address(u'255.255.255.255'))
-                else:
-                    interval = self.IpInterval(sorted_boundaries[index], ip_address(u'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff'))
-            ranges.append(interval)
-        return ranges
+        sorted_boundaries = sorted(self._boundaries)
+        ends = [boundary - 1 for boundary in sorted_boundaries[1:]] + [self._max_ip]
+        return [self.IpInterval(start, end, self._ipv4) for start, end in zip(sorted_boundaries, ends)]
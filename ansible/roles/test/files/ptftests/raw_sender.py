@@ -0,0 +1,135 @@
+"""
+Paced sender of precomputed raw frames.
+
+All frames are serialised once into a single contiguous buffer, and
+struct mmsghdr/iovec descriptors pointing into it are prepared up front,
+so sending a frame is a single sendmmsg() call without building any
+python object. Frames are emitted at deadlines start + i * interval,
+computed from the monotonic clock: the sender sleeps while the deadline
+is far away and busy-waits for the rest. When the sender is behind the
+schedule, all due frames for the same socket are sent by one sendmmsg()
+call (up to batch_size). The wall clock time of every send is recorded.
+"""
+
+import array
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import time
+
+
+CLOCK_MONOTONIC = 1
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+libc.clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+
+
+def monotonic():
+    """
+    Returns CLOCK_MONOTONIC time in seconds.
+    """
+    ts = timespec()
+    if libc.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+class RawSender(object):
+    SPIN_TIME = 0.0002      # Busy-wait this long before the deadline, sleep before that
+    RETRY_TIMEOUT = 0.01    # Wait for the socket to become writable, when its queue is full
+
+    def __init__(self, frames, interval, batch_size=1):
+        """
+        frames is a list of (socket, raw frame). The sockets must be bound to their interfaces.
+        """
+        self.interval = interval
+        self.batch_size = batch_size
+        self.fds = array.array('i', (sock.fileno() for sock, _ in frames))
+
+        data = ''.join(frame for _, frame in frames)
+        self.buffer = ctypes.create_string_buffer(data, len(data))
+        self.iovecs = (iovec * len(frames))()
+        self.messages = (mmsghdr * len(frames))()
+        base = ctypes.addressof(self.buffer)
+        offset = 0
+        for i, (_, frame) in enumerate(frames):
+            self.iovecs[i].iov_base = base + offset
+            self.iovecs[i].iov_len = len(frame)
+            self.messages[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.messages[i].msg_hdr.msg_iovlen = 1
+            offset += len(frame)
+
+        self.send_times = array.array('d', [0.0]) * len(frames)
+        self.max_lag = 0.0      # The latest send relative to its deadline
+
+    def send(self, first, count):
+        """
+        Sends count frames starting from first, all of them through the same socket.
+        """
+        while count > 0:
+            sent = libc.sendmmsg(self.fds[first], ctypes.byref(self.messages[first]), count, 0)
+            if sent < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.ENOBUFS, errno.EINTR):
+                    select.select([], [self.fds[first]], [], self.RETRY_TIMEOUT)
+                    continue
+                raise OSError(err, os.strerror(err))
+            now = time.time()
+            for i in xrange(first, first + sent):
+                self.send_times[i] = now
+            first += sent
+            count -= sent
+
+    def run(self):
+        """
+        Sends all the frames, the first one immediately.
+        Returns number of seconds the sending took.
+        """
+        total = len(self.fds)
+        start = monotonic()
+        i = 0
+        while i < total:
+            deadline = start + i * self.interval
+            now = monotonic()
+            if deadline - now > self.SPIN_TIME:
+                time.sleep(deadline - now - self.SPIN_TIME)
+            while now < deadline:
+                now = monotonic()
+            self.max_lag = max(self.max_lag, now - deadline)
+            # Take all the frames which are already due, for the same socket
+            count = 1
+            while count < self.batch_size and i + count < total and \
+                    self.fds[i + count] == self.fds[i] and start + (i + count) * self.interval <= now:
+                count += 1
+            self.send(i, count)
+            i += count
+
+        return monotonic() - start
@@ -0,0 +1,456 @@
+"""
+Analysis of the data collected by advanced-reboot test.
+
+The module doesn't depend on ptf, so the same code is used by the test itself
+and by the offline replay, which regenerates the downtime report from the saved
+capture files and /tmp/<ip>.samples peer samples:
+
+python reboot_analysis.py --dut-mac 4c:76:25:f5:48:80 [--reboot-start <unix time>] \
+    [--peer /tmp/10.0.0.1.samples ...] /tmp/capture.pcap [/tmp/capture.1.pcap ...]
+
+Capture files are streamed record by record, without scapy dissection.
+"""
+
+import argparse
+import array
+import binascii
+import datetime
+import glob
+import itertools
+import json
+import os
+import pickle
+import socket
+import struct
+import sys
+
+
+FLOW_SPORT = 1234
+FLOW_DPORT = 5000
+FLOW_SENT = 0
+FLOW_RECEIVED = 1
+
+PCAP_FORMATS = {
+    '\xd4\xc3\xb2\xa1': ('<', 1000000.0),
+    '\xa1\xb2\xc3\xd4': ('>', 1000000.0),
+    '\x4d\x3c\xb2\xa1': ('<', 1000000000.0),
+    '\xa1\xb2\x3c\x4d': ('>', 1000000000.0),
+}
+PCAP_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD = struct.Struct('<IIII')
+
+# Metrics of the peer samples, which are kept by SampleStore
+PEER_METRICS = ('lacp', 'bgp_route_v4', 'bgp_route_v6', 'bgp_gr_timer_ok', 'po_changetime')
+
+
+def flow_payload_id(frame, packets_to_send=None):
+    """
+    Parses raw ethernet frame and returns the integer TCP payload, as created by ReloadTest.generate_bidirectional(),
+    or None if the frame doesn't belong to the test flow (not IPv4 TCP 1234 -> 5000, fragment or corrupted payload).
+    """
+    offset = 12
+    ether_type = frame[offset:offset + 2]
+    if ether_type == '\x81\x00':
+        offset += 4
+        ether_type = frame[offset:offset + 2]
+    offset += 2
+    if ether_type != '\x08\x00' or len(frame) < offset + 20:
+        return None
+    ver_ihl, ip_len, frag, proto = struct.unpack_from('!BxH2xHxB', frame, offset)
+    if ver_ihl >> 4 != 4 or proto != socket.IPPROTO_TCP or frag & 0x3fff:
+        return None
+    tcp_offset = offset + (ver_ihl & 0x0f) * 4
+    if len(frame) < tcp_offset + 20:
+        return None
+    sport, dport, data_offset = struct.unpack_from('!HH8xB', frame, tcp_offset)
+    if sport != FLOW_SPORT or dport != FLOW_DPORT:
+        return None
+    try:
+        payload_id = int(frame[tcp_offset + (data_offset >> 4) * 4:offset + ip_len])
+    except ValueError:
+        return None
+    if payload_id < 0 or (packets_to_send is not None and payload_id >= packets_to_send):
+        return None
+    return payload_id
+
+
+def read_pcap(filename, log=None):
+    """
+    Yields (timestamp, raw frame) for every record of pcap file.
+    Files of unknown format (e.g. pcapng) are read by scapy.
+    """
+    with open(filename, 'rb') as pcap:
+        magic = pcap.read(24)[:4]
+        if magic not in PCAP_FORMATS:
+            if log is not None:
+                log("Unknown pcap format of %s, fallback to scapy" % filename)
+            import scapy.all as scapyall
+            for packet in scapyall.rdpcap(filename):
+                yield packet.time, str(packet)
+            return
+        endian, resolution = PCAP_FORMATS[magic]
+        record_header = struct.Struct(endian + 'IIII')
+        while True:
+            header = pcap.read(record_header.size)
+            if len(header) < record_header.size:
+                break
+            sec, frac, caplen, _ = record_header.unpack(header)
+            frame = pcap.read(caplen)
+            yield sec + frac / resolution, frame
+
+
+def read_pcaps(filenames, log=None):
+    return itertools.chain.from_iterable(read_pcap(filename, log) for filename in filenames)
+
+
+def write_pcap(filename, frames):
+    """
+    Dumps (timestamp, raw frame) pairs to pcap file, without building scapy packets.
+    """
+    with open(filename, 'wb') as pcap:
+        pcap.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for timestamp, frame in frames:
+            sec = int(timestamp)
+            usec = int(round((timestamp - sec) * 1000000))
+            if usec >= 1000000:
+                sec, usec = sec + 1, usec - 1000000
+            pcap.write(PCAP_RECORD.pack(sec, usec, len(frame), len(frame)))
+            pcap.write(frame)
+
+
+class FlowAnalysis(object):
+    """
+    Finds dataplane disruptions in the bidirectional flow of ReloadTest.
+    All disruptions are saved to self.lost_packets dictionary, in format:
+    disrupt_start_id = (missing_packets_count, disrupt_time, disrupt_start_timestamp, disrupt_stop_timestamp)
+    """
+    def __init__(self, dut_mac, packets_to_send=None, log=None):
+        self.dut_mac = binascii.unhexlify(dut_mac.replace(':', ''))
+        self.packets_to_send = packets_to_send
+        self.log = log if log is not None else lambda message: None
+
+        self.ids = array.array('l')
+        self.times = array.array('d')
+        self.directions = array.array('b')
+        self.positions = array.array('l')
+        self.order = []
+        self.lost_packets = dict()
+        self.received_counter = 0
+        self.disruption_start, self.disruption_stop = None, None
+
+    def frame_records(self, frames):
+        """
+        Turns (timestamp, raw frame) pairs into the records of extract() method.
+        """
+        for timestamp, frame in frames:
+            yield timestamp, frame[0:6], frame[6:12], flow_payload_id(frame, self.packets_to_send)
+
+    def extract(self, records):
+        """
+        Makes a single pass over the captured (timestamp, dst mac, src mac, payload id) records
+        and stores the test flow packets column-wise:
+        payload id, timestamp, direction (FLOW_SENT or FLOW_RECEIVED) and the record number in the capture.
+        Received floods (the same payload id from DUT more than once) are filtered out.
+        The packets are re-arranged, if delayed, by Payload ID and Timestamp into self.order.
+        """
+        dut_mac = self.dut_mac
+        received_ids = set()    # This set will contain all unique Payload ID, to filter out received floods.
+        for position, (timestamp, dst_mac, src_mac, payload_id) in enumerate(records):
+            if payload_id is None or payload_id < 0:
+                continue
+            if src_mac == dut_mac and payload_id not in received_ids:
+                # This is a unique (no flooded) received packet.
+                received_ids.add(payload_id)
+                direction = FLOW_RECEIVED
+            elif dst_mac == dut_mac:
+                # This is a sent packet.
+                direction = FLOW_SENT
+            else:
+                continue
+            self.ids.append(payload_id)
+            self.times.append(timestamp)
+            self.directions.append(direction)
+            self.positions.append(position)
+
+        ids, times = self.ids, self.times
+        self.order = sorted(xrange(len(ids)), key = lambda i: (ids[i], times[i]))
+
+    def find_disruptions(self):
+        """
+        Compares TCP payloads of the received packets one by one (assuming all payloads are consecutive integers),
+        and the losses if found - are treated as disruptions in Dataplane forwarding.
+        """
+        ids, times, directions = self.ids, self.times, self.directions
+        # Sent packets are kept as payload_id:timestamp, the last one in order wins.
+        sent_packets = dict((ids[i], times[i]) for i in self.order if directions[i] == FLOW_SENT)
+        received = [i for i in self.order if directions[i] == FLOW_RECEIVED]
+        self.received_counter = len(received)    # Counts packets from dut.
+        received_ids = array.array('l', (ids[i] for i in received))
+        received_times = array.array('d', (times[i] for i in received))
+        self.lost_packets = dict()
+        self.disruption_start, self.disruption_stop = None, None
+        # Every received packet is compared with the previous one, the first one with payload 0 at time 0.
+        prev_ids = itertools.chain([0], received_ids)
+        prev_times = itertools.chain([0], received_times)
+        for prev_payload, prev_time, received_payload, received_time in itertools.izip(prev_ids, prev_times, received_ids, received_times):
+            if received_payload - prev_payload > 1 and received_time:
+                # Packets in a row are missing, a disruption.
+                lost_id = (received_payload -1) - prev_payload # How many packets lost in a row.
+                disrupt = (sent_packets[received_payload] - sent_packets[prev_payload + 1]) # How long disrupt lasted.
+                # Add disrupt to the dict:
+                self.lost_packets[prev_payload] = (lost_id, disrupt, received_time - disrupt, received_time)
+                self.log("Disruption between packet ID %d and %d. For %.4f " % (prev_payload, received_payload, disrupt))
+                if not self.disruption_start:
+                    self.disruption_start = datetime.datetime.fromtimestamp(prev_time)
+                self.disruption_stop = datetime.datetime.fromtimestamp(received_time)
+
+    def summary(self):
+        """
+        Returns (disrupts_count, max_lost_id, max_disrupt_time, no_routing_start, no_routing_stop,
+        total_disrupt_packets, total_disrupt_time) of the longest loss with the longest time.
+        """
+        max_disrupt_from_id, (max_lost_id, max_disrupt_time, no_routing_start, no_routing_stop) = \
+            max(self.lost_packets.items(), key = lambda item:item[1][0:2])
+        total_disrupt_packets = sum([item[0] for item in self.lost_packets.values()])
+        total_disrupt_time = sum([item[1] for item in self.lost_packets.values()])
+
+        return len(self.lost_packets), max_lost_id, max_disrupt_time, no_routing_start, no_routing_stop, \
+            total_disrupt_packets, total_disrupt_time
+
+    def filtered_frames(self, frames):
+        """
+        Takes (timestamp, raw frame) pairs of the examined capture once again,
+        and yields the test flow packets in self.order.
+        """
+        wanted = set(self.positions)
+        kept = dict((position, frame) for position, (_, frame) in enumerate(frames) if position in wanted)
+        for i in self.order:
+            yield self.times[i], kept[self.positions[i]]
+
+
+class SampleStore(object):
+    """
+    Append-only columnar store of the peer samples.
+
+    Only transitions are kept in memory: for every metric an array of the timestamps
+    when its state changed and the list of the states, plus the time of the last sample.
+    So the memory doesn't depend on the number of samples, and the queries are linear
+    in the number of transitions. Every sample is streamed to the file as a json line
+    [timestamp, {name: value}], including the values which aren't metrics.
+    """
+
+    def __init__(self, metrics, filename=None):
+        self.metrics = tuple(metrics)
+        self.times = dict((metric, array.array('d')) for metric in self.metrics)
+        self.states = dict((metric, []) for metric in self.metrics)
+        self.last_times = {}
+        self.count = 0
+        self.fp = open(filename, 'w') if filename is not None else None
+
+    @classmethod
+    def load(cls, filename, metrics):
+        """
+        Restores the store from a file written by append().
+        """
+        store = cls(metrics)
+        with open(filename) as fp:
+            for line in fp:
+                if line.strip():
+                    timestamp, values = json.loads(line)
+                    store.append(timestamp, values)
+        return store
+
+    def append(self, timestamp, values):
+        """
+        Records the sample. values is a dict name:value, metrics missing from it are left intact.
+        Samples must be appended in time order.
+        """
+        for metric in self.metrics:
+            if metric not in values:
+                continue
+            value = values[metric]
+            states = self.states[metric]
+            if not states or states[-1] != value:
+                self.times[metric].append(timestamp)
+                states.append(value)
+            self.last_times[metric] = timestamp
+        self.count += 1
+        if self.fp is not None:
+            self.fp.write(json.dumps([timestamp, values]) + '\n')
+            self.fp.flush()
+
+    def transitions(self, metric):
+        """
+        Returns [(timestamp, state)]. The first item is the first sample of the metric.
+        """
+        return zip(self.times[metric], self.states[metric])
+
+    def intervals(self, metric):
+        """
+        Yields (state, start, end) for every interval, when the metric kept its state.
+        The last interval ends with the last sample of the metric.
+        """
+        times = self.times[metric]
+        states = self.states[metric]
+        for i, state in enumerate(states):
+            end = times[i + 1] if i + 1 < len(times) else self.last_times[metric]
+            yield state, times[i], end
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+def series_status(store, entity, what, fails, info):
+    # find how long anything was down
+    # Input parameter is a SampleStore with boolean metric entity
+    # constraints:
+    # entity must be down just once
+    # entity must be up when the test starts
+    # entity must be up when the test stops
+
+    states = store.states[entity]
+    if not states:
+        fails.add("%s cannot be empty" % what)
+        return 0, 0
+    if not states[0]:
+        fails.add("%s must be up when the test starts" % what)
+        return 0, 0
+    if not states[-1]:
+        fails.add("%s must be up when the test stops" % what)
+        return 0, 0
+
+    downtimes = [end - start for state, start, end in store.intervals(entity) if not state]
+    is_down_count = len(downtimes)
+
+    if is_down_count > 1:
+        info.add("%s must be down just for once" % what)
+
+    return is_down_count, sum(downtimes) # summary_downtime
+
+
+def load_peer_samples(filename):
+    """
+    Returns (ip, SampleStore) from /tmp/<ip>.samples file, or from /tmp/<ip>.data.pickle
+    saved by the previous versions of the test.
+    """
+    name = os.path.basename(filename)
+    if name.endswith('.data.pickle'):
+        store = SampleStore(PEER_METRICS)
+        with open(filename) as fp:
+            data = pickle.load(fp)
+        for when in sorted(data):
+            store.append(when, data[when])
+        return name[:-len('.data.pickle')], store
+
+    if name.endswith('.samples'):
+        name = name[:-len('.samples')]
+    return name, SampleStore.load(filename, PEER_METRICS)
+
+
+def replay_peers(filenames, fails, info):
+    """
+    Returns ip:{'lacp', 'bgp_v4', 'bgp_v6'} statuses from the saved /tmp/<ip>.samples peer samples.
+    """
+    cli_info = {}
+    for filename in filenames:
+        ip, store = load_peer_samples(filename)
+        if store.count == 0:
+            fails.add("%s: no peer samples in %s" % (ip, filename))
+            continue
+        cli_info[ip] = {
+            'lacp':   series_status(store, "lacp",         "LACP session", fails, info),
+            'bgp_v4': series_status(store, "bgp_route_v4", "BGP v4 routes", fails, info),
+            'bgp_v6': series_status(store, "bgp_route_v6", "BGP v6 routes", fails, info),
+        }
+
+    return cli_info
+
+
+def log(message):
+    sys.stdout.write(message + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Regenerate advanced-reboot downtime report from saved capture files and peer samples')
+    parser.add_argument('captures', nargs='+', help='pcap files in capture order')
+    parser.add_argument('--dut-mac', required=True, help='DUT mac address')
+    parser.add_argument('--peer', action='append', dest='peers', help='saved peer samples file, may be repeated, default: /tmp/*.samples')
+    parser.add_argument('--reboot-start', type=float, help='unix time of the reboot, default: the first captured packet')
+    parser.add_argument('--reboot-limit', type=float, default=30, help='expected downtime limit in seconds')
+    parser.add_argument('--packets-to-send', type=int, help='number of packets in the flow')
+    parser.add_argument('--filtered', help='dump the filtered flow to this pcap file')
+    args = parser.parse_args()
+
+    fails = set()
+    info = set()
+    analysis = FlowAnalysis(args.dut_mac, args.packets_to_send, log)
+    analysis.extract(analysis.frame_records(read_pcaps(args.captures, log)))
+    if not analysis.order:
+        fails.add("Sniffer failed to capture any traffic")
+    analysis.find_disruptions()
+    if not analysis.received_counter:
+        fails.add("Sniffer failed to filter any traffic from DUT")
+
+    if args.reboot_start is not None:
+        reboot_start = datetime.datetime.fromtimestamp(args.reboot_start)
+    elif analysis.times:
+        reboot_start = datetime.datetime.fromtimestamp(min(analysis.times))
+    else:
+        reboot_start = datetime.datetime.fromtimestamp(0)
+
+    if analysis.lost_packets:
+        disrupts_count, max_lost_id, max_disrupt_time, no_routing_start, no_routing_stop, total_disrupt_packets, total_disrupt_time = \
+            analysis.summary()
+        no_routing_start = datetime.datetime.fromtimestamp(no_routing_start)
+        no_routing_stop = datetime.datetime.fromtimestamp(no_routing_stop)
+        log("Disruptions happen between %s and %s after the reboot." % \
+            (str(analysis.disruption_start - reboot_start), str(analysis.disruption_stop - reboot_start)))
+    else:
+        no_routing_start = no_routing_stop = reboot_start
+        log("Gaps in forwarding not found.")
+    log("Total incoming packets captured %d" % analysis.received_counter)
+
+    if args.filtered and analysis.order:
+        write_pcap(args.filtered, analysis.filtered_frames(read_pcaps(args.captures)))
+        log("Filtered pcap dumped to %s" % args.filtered)
+
+    if analysis.lost_packets:
+        log("The longest disruption lasted %.3f seconds. %d packet(s) lost." % (max_disrupt_time, max_lost_id))
+        log("Total disruptions count is %d. All disruptions lasted %.3f seconds. Total %d packet(s) lost" % \
+            (disrupts_count, total_disrupt_time, total_disrupt_packets))
+
+    peers = args.peers if args.peers is not None else sorted(glob.glob('/tmp/*.samples'))
+    cli_info = replay_peers(peers, fails, info)
+
+    log("=" * 50)
+    log("Report:")
+    log("=" * 50)
+    log("LACP/BGP were down for (extracted from cli):")
+    log("-" * 50)
+    for ip in sorted(cli_info.keys()):
+        log("    %s - lacp: %7.3f (%d) bgp v4: %7.3f (%d) bgp v6: %7.3f (%d)" \
+            % (ip, cli_info[ip]['lacp'][1],   cli_info[ip]['lacp'][0], \
+                   cli_info[ip]['bgp_v4'][1], cli_info[ip]['bgp_v4'][0], \
+                   cli_info[ip]['bgp_v6'][1], cli_info[ip]['bgp_v6'][0]))
+    log("-" * 50)
+    log("Summary:")
+    log("-" * 50)
+    log("Downtime was %s" % str(no_routing_stop - no_routing_start))
+    log("Reboot time was %s" % str(no_routing_stop - reboot_start))
+    log("Expected downtime is less then %s" % datetime.timedelta(seconds=args.reboot_limit))
+    if no_routing_stop - no_routing_start > datetime.timedelta(seconds=args.reboot_limit):
+        fails.add("Downtime must be less then %s seconds. It was %s" % (args.reboot_limit, str(no_routing_stop - no_routing_start)))
+
+    for entry in sorted(info):
+        log("INFO:%s" % entry)
+    for fail in sorted(fails):
+        log("FAILED:%s" % fail)
+    log("=" * 50)
+
+    return 1 if fails else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
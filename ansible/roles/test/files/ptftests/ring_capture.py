@@ -0,0 +1,207 @@
+"""
+Packet capture engine based on AF_PACKET socket with TPACKET_V3 (PACKET_MMAP) receive ring.
+
+The kernel fills ring blocks with the frames accepted by classic BPF filter,
+and the capture thread walks the blocks in place, without copying every frame
+into python object. For every frame only timestamp, destination/source MAC
+and the value returned by the parser callback are recorded into preallocated
+arrays. Optionally all accepted frames are streamed to pcap file.
+"""
+
+import array
+import ctypes
+import mmap
+import select
+import socket
+import struct
+import threading
+import time
+
+
+ETH_P_ALL = 0x0003
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+SO_ATTACH_FILTER = 26
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_block_desc: version, offset_to_priv, then struct tpacket_hdr_v1
+# block_status, num_pkts, offset_to_first_pkt
+BLOCK_HEADER = struct.Struct('=IIIII')
+BLOCK_STATUS_OFFSET = 8
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len, tp_status, tp_mac, tp_net
+PACKET_HEADER = struct.Struct('=IIIIIIHH')
+# struct tpacket_req3: block_size, block_nr, frame_size, frame_nr, retire_blk_tov, sizeof_priv, feature_req_word
+RING_REQUEST = struct.Struct('=IIIIIII')
+# struct tpacket_stats_v3: tp_packets, tp_drops, tp_freeze_q_cnt
+RING_STATISTICS = struct.Struct('=III')
+
+PCAP_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD = struct.Struct('<IIII')
+
+# Classic BPF opcodes
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LDX_B_MSH = 0xb1
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+
+
+def tcp_ports_filter(sport, dport, snaplen=0xffff):
+    """
+    Returns classic BPF program (list of (code, jt, jf, k)) which accepts
+    not fragmented IPv4 TCP frames with given source and destination ports.
+    It is equivalent of 'ip and tcp src port <sport> and tcp dst port <dport>'.
+    """
+    return [
+        (BPF_LD_H_ABS,  0, 0, 12),          # ether type
+        (BPF_JEQ_K,     0, 10, 0x0800),     # IPv4
+        (BPF_LD_B_ABS,  0, 0, 23),          # ip protocol
+        (BPF_JEQ_K,     0, 8, 6),           # TCP
+        (BPF_LD_H_ABS,  0, 0, 20),          # flags and fragment offset
+        (BPF_JSET_K,    6, 0, 0x1fff),      # not fragment
+        (BPF_LDX_B_MSH, 0, 0, 14),          # x = ip header length
+        (BPF_LD_H_IND,  0, 0, 14),          # tcp source port
+        (BPF_JEQ_K,     0, 3, sport),
+        (BPF_LD_H_IND,  0, 0, 16),          # tcp destination port
+        (BPF_JEQ_K,     0, 1, dport),
+        (BPF_RET_K,     0, 0, snaplen),
+        (BPF_RET_K,     0, 0, 0),
+    ]
+
+
+def attach_filter(sock, program):
+    """
+    Attaches classic BPF program (list of (code, jt, jf, k)) to the socket.
+    """
+    code = ''.join(struct.pack('=HBBI', *insn) for insn in program)
+    code_buffer = ctypes.create_string_buffer(code, len(code))
+    fprog = struct.pack('HP', len(program), ctypes.addressof(code_buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class RingCapture(object):
+    DEFAULT_BLOCK_SIZE = 1 << 20
+    DEFAULT_BLOCK_NR = 8
+    DEFAULT_FRAME_SIZE = 1 << 11
+    BLOCK_TIMEOUT_MS = 10
+    POLL_TIMEOUT_MS = 100
+
+    def __init__(self, parser, bpf_filter=None, iface=None, capacity=1 << 16, pcap_file=None,
+                 block_size=DEFAULT_BLOCK_SIZE, block_nr=DEFAULT_BLOCK_NR, frame_size=DEFAULT_FRAME_SIZE):
+        """
+        parser is called with every captured frame and its result is recorded as integer (-1 for None).
+        iface None means all interfaces. capacity is the initial size of the record arrays.
+        """
+        self.parser = parser
+        self.pcap_file = pcap_file
+        self.block_size = block_size
+        self.block_nr = block_nr
+
+        self.count = 0
+        self.times = array.array('d', [0.0]) * capacity
+        self.values = array.array('l', [-1]) * capacity
+        self.macs = bytearray(12 * capacity)        # dst and src MAC of every record
+
+        self.stopped = threading.Event()
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            if bpf_filter is not None:
+                attach_filter(self.sock, bpf_filter)
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            frame_nr = (block_size // frame_size) * block_nr
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                                 RING_REQUEST.pack(block_size, block_nr, frame_size, frame_nr, self.BLOCK_TIMEOUT_MS, 0, 0))
+            if iface is not None:
+                self.sock.bind((iface, ETH_P_ALL))
+            self.ring = mmap.mmap(self.sock.fileno(), block_size * block_nr, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        except:
+            self.sock.close()
+            raise
+
+    def grow(self):
+        size = len(self.times)
+        self.times.extend(array.array('d', [0.0]) * size)
+        self.values.extend(array.array('l', [-1]) * size)
+        self.macs.extend(bytearray(12 * size))
+
+    def record(self, timestamp, frame):
+        if self.count == len(self.times):
+            self.grow()
+        value = self.parser(frame)
+        self.times[self.count] = timestamp
+        self.values[self.count] = -1 if value is None else value
+        self.macs[12 * self.count:12 * self.count + 12] = frame[0:12]
+        self.count += 1
+
+    def read_block(self, block_offset, pcap):
+        ring = self.ring
+        _, _, _, num_pkts, offset = BLOCK_HEADER.unpack_from(ring, block_offset)
+        packet_offset = block_offset + offset
+        for _ in xrange(num_pkts):
+            next_offset, sec, nsec, snaplen, length, _, mac, _ = PACKET_HEADER.unpack_from(ring, packet_offset)
+            frame = ring[packet_offset + mac:packet_offset + mac + snaplen]
+            self.record(sec + nsec / 1000000000.0, frame)
+            if pcap is not None:
+                pcap.write(PCAP_RECORD.pack(sec, nsec // 1000, snaplen, length))
+                pcap.write(frame)
+            packet_offset += next_offset
+        # Return the block to the kernel
+        struct.pack_into('=I', ring, block_offset + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+
+    def run(self, timeout):
+        """
+        Captures until timeout (in seconds) expires or stop() is called.
+        """
+        pcap = None
+        if self.pcap_file is not None:
+            pcap = open(self.pcap_file, 'wb')
+            pcap.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 0xffff, 1))
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+        deadline = time.time() + timeout
+        block = 0
+        try:
+            while not self.stopped.is_set():
+                block_offset = block * self.block_size
+                status, = struct.unpack_from('=I', self.ring, block_offset + BLOCK_STATUS_OFFSET)
+                if status & TP_STATUS_USER:
+                    self.read_block(block_offset, pcap)
+                    block = (block + 1) % self.block_nr
+                    continue
+                if time.time() >= deadline:
+                    break
+                poller.poll(self.POLL_TIMEOUT_MS)
+        finally:
+            if pcap is not None:
+                pcap.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def statistics(self):
+        """
+        Returns (packets, drops) counted by the kernel since the last call.
+        """
+        packets, drops, _ = RING_STATISTICS.unpack(self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, RING_STATISTICS.size))
+        return packets, drops
+
+    def records(self):
+        """
+        Yields (timestamp, dst_mac, src_mac, value) for every captured frame.
+        """
+        macs = str(self.macs)
+        for i in xrange(self.count):
+            yield self.times[i], macs[12 * i:12 * i + 6], macs[12 * i + 6:12 * i + 12], self.values[i]
+
+    def close(self):
+        self.ring.close()
+        self.sock.close()
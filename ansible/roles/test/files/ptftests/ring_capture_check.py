@@ -0,0 +1,83 @@
+"""
+Check of the BPF program built by ring_capture.tcp_ports_filter().
+
+Crafted frames are sent on the loopback interface and the program is run by the
+kernel on a packet socket bound to it. Every frame must be accepted exactly when
+tcpdump's 'ip and tcp src port <sport> and tcp dst port <dport>' accepts it.
+The port numbers of some cases are the values left in the accumulator by the
+earlier checks, so that a wrong jump offset makes the program accept the frame.
+Must be run as root:
+
+python ring_capture_check.py
+"""
+
+import select
+import socket
+import sys
+
+import scapy.all as scapy
+
+from ring_capture import ETH_P_ALL, attach_filter, tcp_ports_filter
+
+
+IFACE = 'lo'
+RECV_TIMEOUT = 0.2
+
+
+def cases():
+    """
+    Yields (description, sport, dport, frame, accepted)
+    """
+    eth = scapy.Ether(src='02:00:00:00:00:01', dst='02:00:00:00:00:02')
+    ip = scapy.IP(src='10.0.0.1', dst='10.0.0.2')
+
+    yield 'matching IPv4 TCP', 1234, 5000, eth / ip / scapy.TCP(sport=1234, dport=5000), True
+    yield 'matching IPv4 TCP with IP options', 1234, 5000, \
+        eth / scapy.IP(src='10.0.0.1', dst='10.0.0.2', options=[scapy.IPOption('\x94\x04\x00\x00')]) / scapy.TCP(sport=1234, dport=5000), True
+    yield 'first fragment of matching IPv4 TCP', 1234, 5000, eth / scapy.IP(src='10.0.0.1', dst='10.0.0.2', flags='MF') / scapy.TCP(sport=1234, dport=5000), True
+    yield 'wrong source port', 1234, 5000, eth / ip / scapy.TCP(sport=1235, dport=5000), False
+    yield 'wrong destination port', 1234, 5000, eth / ip / scapy.TCP(sport=1234, dport=5001), False
+    yield 'swapped ports', 1234, 5000, eth / ip / scapy.TCP(sport=5000, dport=1234), False
+    # The accumulator holds the ether type, the protocol or the fragment field when these are rejected
+    yield 'IPv6 TCP', 1234, 0x86dd, eth / scapy.IPv6() / scapy.TCP(sport=1234, dport=0x86dd), False
+    yield 'IPv4 UDP', 1234, 17, eth / ip / scapy.UDP(sport=1234, dport=17), False
+    yield 'IPv4 TCP fragment', 1234, 0x0001, eth / scapy.IP(src='10.0.0.1', dst='10.0.0.2', frag=1, proto=6) / scapy.Raw(load='\x04\xd2\x00\x01' + '\x00' * 16), False
+
+
+def is_accepted(sport, dport, frame):
+    """
+    Sends the frame on IFACE and returns True if the filter passed it to the socket.
+    """
+    data = str(frame)
+    receiver = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    sender = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    try:
+        attach_filter(receiver, tcp_ports_filter(sport, dport))
+        receiver.bind((IFACE, ETH_P_ALL))
+        sender.bind((IFACE, 0))
+        sender.send(data)
+
+        # Loopback passes the frame to the socket twice: outgoing and incoming
+        while select.select([receiver], [], [], RECV_TIMEOUT)[0]:
+            if receiver.recv(65535) == data:
+                return True
+        return False
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def main():
+    failed = 0
+    for description, sport, dport, frame, accepted in cases():
+        result = is_accepted(sport, dport, frame)
+        print "%-40s sport %5d dport %5d: %s" % (description, sport, dport, 'accepted' if result else 'rejected')
+        if result != accepted:
+            print "ERROR: the frame must be %s" % ('accepted' if accepted else 'rejected')
+            failed += 1
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
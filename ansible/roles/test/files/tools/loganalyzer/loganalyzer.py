@@ -16,10 +16,19 @@ Usage:          Examples of how to use log analyzer
 #---------------------------------------------------------------------
 # Global imports
 #---------------------------------------------------------------------
+import os
 import sys
 import getopt
 import re
+import stat
+import sre_parse
+import sre_constants
 import csv
+import json
+import time
+import hashlib
+import tempfile
+import multiprocessing
 import pprint
 import logging
 import logging.handlers
@@ -31,6 +40,23 @@ from __builtin__ import True
 tokenizer = ','
 comment_key = '#'
 system_log_file = '/var/log/syslog'
+#-- Size of the chunk read at a time when walking a log file backwards
+reverse_read_block_size = 64 * 1024
+#-- Size of the chunk read at a time when following a log file
+follow_read_block_size = 64 * 1024
+#-- Interval in seconds between checks for new lines when following log files
+follow_poll_interval = 1
+#-- Default maximum duration in seconds of following log files
+follow_default_timeout = 6 * 60 * 60
+#-- Directory where start marker offsets are kept between init and analyze
+marker_index_dir = '/tmp'
+#-- Directory where expressions built from rule files are cached
+rule_cache_dir = '/tmp/loganalyzer.cache'
+#-- Must be changed whenever the way expressions are built from rule files changes
+rule_cache_version = 1
+
+#-- Analyzer and regexes of a worker process analyzing log files in parallel
+worker_context = None
 
 #-- List of ERROR codes to be returned by LogAnalyzer
 err_duplicate_start_marker = -1
@@ -39,6 +65,208 @@ err_no_end_marker = -3
 err_no_start_marker = -4
 err_invalid_string_format = -5
 err_invalid_input = -6
+err_follow_timeout = -7
+
+class LogMessageMatcher:
+    '''
+    @summary: Classifies log lines against 'match', 'ignore' and 'expect'
+              regex sets in a single pass per line.
+
+    Every alternative of the sets' expressions is reduced to a literal substring
+    which a line must contain for that alternative to match. A line is first
+    checked for presence of these literals, and the regex engine is only invoked
+    for the sets having a literal present in the line. Sets which can not be
+    reduced to literals (e.g. case insensitive ones) are always checked with
+    the regex engine.
+    '''
+
+    MATCH = 'match'
+    EXPECT = 'expect'
+
+    match_set = 1
+    ignore_set = 2
+    expect_set = 4
+
+    #-- Literals of already seen regexes, by (pattern, flags)
+    regex_literals = {}
+
+    def __init__(self, match_messages_regex, ignore_messages_regex, expect_messages_regex):
+        self.match_messages_regex = match_messages_regex
+        self.ignore_messages_regex = ignore_messages_regex
+        self.expect_messages_regex = expect_messages_regex
+
+        #-- Sets which are checked with the regex engine for every line
+        self.unfiltered_sets = 0
+        set_literals = {}
+
+        for set_bit, regex in ((self.match_set, match_messages_regex),
+                               (self.ignore_set, ignore_messages_regex),
+                               (self.expect_set, expect_messages_regex)):
+            if regex is None:
+                continue
+
+            literals = self.extract_literals(regex)
+            if literals is None:
+                self.unfiltered_sets |= set_bit
+                continue
+
+            for literal in literals:
+                set_literals[literal] = set_literals.get(literal, 0) | set_bit
+
+        #-- A literal containing another literal of the same sets adds nothing to the filter
+        self.literals = []
+        for literal, sets in set_literals.iteritems():
+            redundant = False
+            for other, other_sets in set_literals.iteritems():
+                if other != literal and other in literal and (other_sets & sets) == sets:
+                    redundant = True
+                    break
+            if not redundant:
+                self.literals.append((literal, sets))
+    #---------------------------------------------------------------------
+
+    @classmethod
+    def extract_literals(cls, regex):
+        '''
+        @summary: Get a set of literals, such that any string matching the regex
+                  contains at least one of them.
+
+        @param regex: Compiled regex.
+
+        @return: Set of literal strings, or None if the regex can not be
+                 reduced to literals.
+        '''
+
+        key = (regex.pattern, regex.flags)
+        if key not in cls.regex_literals:
+            cls.regex_literals[key] = cls.parse_literals(regex)
+
+        return cls.regex_literals[key]
+    #---------------------------------------------------------------------
+
+    @staticmethod
+    def parse_literals(regex):
+        '''
+        @summary: Parse the regex to get literals. See extract_literals().
+        '''
+
+        if (regex.flags & re.IGNORECASE) or not isinstance(regex.pattern, str):
+            return None
+
+        try:
+            parsed = sre_parse.parse(regex.pattern, regex.flags)
+        except sre_constants.error:
+            return None
+
+        items = list(parsed)
+        if len(items) == 1 and items[0][0] == sre_constants.BRANCH:
+            alternatives = items[0][1][1]
+        else:
+            alternatives = [items]
+
+        literals = set()
+        for alternative in alternatives:
+            #-- Longest run of consecutive literal characters is required by the alternative
+            longest = ''
+            current = []
+            for op, av in list(alternative) + [(None, None)]:
+                if op == sre_constants.LITERAL:
+                    current.append(chr(av))
+                    continue
+                if len(current) > len(longest):
+                    longest = ''.join(current)
+                current = []
+
+            if not longest:
+                return None
+            literals.add(longest)
+
+        #-- A line containing a literal contains any literal which is part of it,
+        #-- so only the shortest ones need to be looked for
+        reduced = []
+        for literal in sorted(literals, key=len):
+            if not any(other in literal for other in reduced):
+                reduced.append(literal)
+
+        return set(reduced)
+    #---------------------------------------------------------------------
+
+    def classify(self, line):
+        '''
+        @summary: Check the line against 'match', 'ignore' and 'expect' sets.
+
+        @param line: Log line.
+
+        @return: EXPECT if the line matches 'expect' set; otherwise MATCH if the
+                 line matches 'match' set and doesn't match 'ignore' set;
+                 otherwise None.
+        '''
+
+        candidate_sets = self.unfiltered_sets
+        for literal, sets in self.literals:
+            if literal in line:
+                candidate_sets |= sets
+
+        if not candidate_sets:
+            return None
+
+        if (candidate_sets & self.expect_set) and self.expect_messages_regex.search(line):
+            return self.EXPECT
+
+        if (candidate_sets & self.match_set) and self.match_messages_regex.search(line):
+            if not ((candidate_sets & self.ignore_set) and self.ignore_messages_regex.search(line)):
+                return self.MATCH
+
+        return None
+    #---------------------------------------------------------------------
+
+class LogFileFollower:
+    '''
+    @summary: Reads lines appended to a log file since the previous read,
+              starting from given offset. When the file is rotated or truncated
+              it is read again from the beginning.
+    '''
+
+    def __init__(self, log_file_path, offset):
+        self.log_file_path = log_file_path
+        self.offset = offset
+        self.inode = None
+        self.pending = ''
+    #---------------------------------------------------------------------
+
+    def read_lines(self):
+        '''
+        @summary: Generator yielding complete lines appended since the previous
+                  call. An incomplete last line is kept until it is completed.
+        '''
+
+        try:
+            stat = os.stat(self.log_file_path)
+        except OSError:
+            #-- The file is being rotated, new one will be picked up on next call
+            return
+
+        if self.inode is not None and (stat.st_ino != self.inode or stat.st_size < self.offset):
+            self.offset = 0
+            self.pending = ''
+        self.inode = stat.st_ino
+
+        if stat.st_size <= self.offset:
+            return
+
+        with open(self.log_file_path, 'rb') as log_file:
+            log_file.seek(self.offset)
+            while self.offset < stat.st_size:
+                data = log_file.read(min(follow_read_block_size, stat.st_size - self.offset))
+                if not data:
+                    break
+                self.offset += len(data)
+
+                lines = (self.pending + data).split('\n')
+                self.pending = lines.pop()
+                for line in lines:
+                    yield line + '\n'
+    #---------------------------------------------------------------------
 
 class LogAnalyzer:
     '''
@@ -82,6 +310,7 @@ class LogAnalyzer:
     def __init__(self, run_id, verbose):
         self.run_id = run_id
         self.verbose = verbose
+        self.marker_index = {}
     #---------------------------------------------------------------------
 
     def print_diagnostic_message(self, message):
@@ -128,6 +357,83 @@ class LogAnalyzer:
         return
     #---------------------------------------------------------------------
 
+    def get_marker_index_path(self):
+        return os.path.join(marker_index_dir, 'loganalyzer.' + self.run_id + '.index')
+    #---------------------------------------------------------------------
+
+    def save_marker_index(self, log_file_list):
+        '''
+        @summary: Record where the start marker is going to land in each log file,
+                  so that analysis can seek straight to it instead of scanning
+                  the whole file. Must be called before the start marker is placed.
+
+                  The recorded offset is the file size before the marker is
+                  written, so the marker is at or after it. The inode is recorded
+                  to detect that the file was rotated in between.
+
+        @param log_file_list : List of file paths, to be applied with start marker.
+        '''
+        marker_index = {}
+
+        for log_file in log_file_list:
+            if not len(log_file) or self.is_filename_stdin(log_file):
+                continue
+            try:
+                stat = os.stat(log_file)
+            except OSError:
+                continue
+            self.print_diagnostic_message('log file:%s, start marker offset %d, inode %d'
+                                          % (log_file, stat.st_size, stat.st_ino))
+            marker_index[os.path.abspath(log_file)] = {'offset' : stat.st_size, 'inode' : stat.st_ino}
+
+        with open(self.get_marker_index_path(), 'w') as index_file:
+            json.dump(marker_index, index_file)
+    #---------------------------------------------------------------------
+
+    def load_marker_index(self):
+        '''
+        @summary: Load start marker offsets recorded by save_marker_index().
+                  Missing or corrupted index is not an error, analysis falls back
+                  to scanning the log files.
+        '''
+        try:
+            with open(self.get_marker_index_path(), 'r') as index_file:
+                self.marker_index = json.load(index_file)
+        except (IOError, ValueError):
+            self.marker_index = {}
+    #---------------------------------------------------------------------
+
+    def remove_marker_index(self):
+        try:
+            os.remove(self.get_marker_index_path())
+        except OSError:
+            pass
+    #---------------------------------------------------------------------
+
+    def get_start_offset(self, log_file_path):
+        '''
+        @summary: Get offset in the log file at or after which the start marker
+                  was placed.
+
+        @return: Offset, or None if it is unknown or the file was rotated or
+                 truncated since the start marker was placed.
+        '''
+        entry = self.marker_index.get(os.path.abspath(log_file_path))
+        if entry is None:
+            return None
+
+        try:
+            stat = os.stat(log_file_path)
+        except OSError:
+            return None
+
+        if stat.st_ino != entry['inode'] or stat.st_size < entry['offset']:
+            self.print_diagnostic_message('log file:%s was rotated after start marker was placed' % log_file_path)
+            return None
+
+        return entry['offset']
+    #---------------------------------------------------------------------
+
     def error_to_regx(self, error_string):
         '''
         This method converts a (list of) strings to one regular expression.
@@ -161,6 +467,91 @@ class LogAnalyzer:
         return error_string
     #---------------------------------------------------------------------
 
+    def get_rule_cache_path(self, file_list):
+        '''
+        @summary: Get path of the cache entry of expressions built from given
+                  rule files. The entry is identified by the content of the files.
+
+        @return: Path, or None if some of the files can not be read.
+        '''
+
+        digest = hashlib.sha1(str(rule_cache_version))
+        try:
+            for filename in file_list:
+                with open(filename, 'rb') as rule_file:
+                    digest.update(rule_file.read())
+                digest.update('\0')
+        except IOError:
+            return None
+
+        return os.path.join(rule_cache_dir, digest.hexdigest() + '.json')
+    #---------------------------------------------------------------------
+
+    def is_rule_cache_dir_trusted(self):
+        '''
+        @summary: Check that the cache directory is a real directory, which is
+                  owned by us and can't be read or written by anyone else.
+        '''
+
+        try:
+            dir_stat = os.lstat(rule_cache_dir)
+        except OSError:
+            return False
+
+        return (stat.S_ISDIR(dir_stat.st_mode) and dir_stat.st_uid == os.getuid()
+                and stat.S_IMODE(dir_stat.st_mode) == 0700)
+    #---------------------------------------------------------------------
+
+    def load_rule_cache(self, cache_path):
+        '''
+        @summary: Load expressions and their literals from the cache.
+
+        @return: Tuple of list of expressions and set of literals (see
+                 LogMessageMatcher.extract_literals()), or None on cache miss.
+        '''
+
+        try:
+            #-- Don't trust the cache unless it was created by us
+            if not self.is_rule_cache_dir_trusted():
+                return None
+
+            with open(cache_path, 'r') as cache_file:
+                entry = json.load(cache_file)
+
+            messages_regex = [message.encode('utf-8') for message in entry['messages']]
+            literals = entry['literals']
+            if literals is not None:
+                literals = set(literal.encode('utf-8') for literal in literals)
+        except (OSError, IOError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+        return messages_regex, literals
+    #---------------------------------------------------------------------
+
+    def save_rule_cache(self, cache_path, messages_regex, literals):
+        tmp_path = None
+        try:
+            if not os.path.lexists(rule_cache_dir):
+                os.makedirs(rule_cache_dir, 0700)
+
+            #-- Never write into a directory somebody else could have prepared
+            if not self.is_rule_cache_dir_trusted():
+                self.print_diagnostic_message('not saving rule cache, %s is not a private directory' % rule_cache_dir)
+                return
+
+            #-- Write to a new temporary file first, so concurrent runs never see partial entry
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(cache_path) + '.', dir=rule_cache_dir)
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump({'messages' : messages_regex,
+                           'literals' : None if literals is None else sorted(literals)},
+                          cache_file)
+            os.rename(tmp_path, cache_path)
+        except (OSError, IOError, ValueError):
+            self.print_diagnostic_message('failed to save rule cache %s' % cache_path)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    #---------------------------------------------------------------------
+
     def create_msg_regex(self, file_lsit):
         '''
         @summary: This method reads input file containing list of regular expressions
@@ -176,6 +567,19 @@ class LogAnalyzer:
         if file_lsit is None or (0 == len(file_lsit)):
             return None
 
+        cache_path = self.get_rule_cache_path(file_lsit)
+        cached = self.load_rule_cache(cache_path) if cache_path else None
+        if cached is not None:
+            messages_regex, literals = cached
+            self.print_diagnostic_message('loaded %d expressions from cache %s' % (len(messages_regex), cache_path))
+
+            if (len(messages_regex)):
+                regex = re.compile('|'.join(messages_regex))
+                LogMessageMatcher.regex_literals[(regex.pattern, regex.flags)] = literals
+            else:
+                regex = None
+            return regex, messages_regex
+
         for filename in file_lsit:
             self.print_diagnostic_message('processing match file:%s' % filename)
             with open(filename, 'rb') as csvfile:
@@ -217,8 +621,14 @@ class LogAnalyzer:
 
         if (len(messages_regex)):
             regex = re.compile('|'.join(messages_regex))
+            literals = LogMessageMatcher.extract_literals(regex)
         else:
             regex = None
+            literals = None
+
+        if cache_path:
+            self.save_rule_cache(cache_path, messages_regex, literals)
+
         return regex, messages_regex
     #---------------------------------------------------------------------
 
@@ -243,11 +653,11 @@ class LogAnalyzer:
 
         ret_code = False
 
-        if ((match_messages_regex is not None) and (match_messages_regex.findall(str))):
+        if ((match_messages_regex is not None) and (match_messages_regex.search(str))):
             if (ignore_messages_regex is None):
                 ret_code = True
 
-            elif (not ignore_messages_regex.findall(str)):
+            elif (not ignore_messages_regex.search(str)):
                 self.print_diagnostic_message('matching line: %s' % str)
                 ret_code = True
 
@@ -261,11 +671,119 @@ class LogAnalyzer:
         '''
 
         ret_code = False
-        if (expect_messages_regex is not None) and (expect_messages_regex.findall(str)):
+        if (expect_messages_regex is not None) and (expect_messages_regex.search(str)):
             ret_code = True
 
         return ret_code
 
+    def reverse_readlines(self, log_file):
+        '''
+        @summary: Generator which yields lines of a seekable file starting from
+                  the last one. The file is read backwards in fixed size blocks,
+                  so only one block (plus a partial line) is held in memory,
+                  and reading stops as soon as the caller stops iterating.
+
+        @param log_file: File object opened in binary mode.
+        '''
+        log_file.seek(0, os.SEEK_END)
+        position = log_file.tell()
+        pending = ''
+
+        while position > 0:
+            read_size = min(reverse_read_block_size, position)
+            position -= read_size
+            log_file.seek(position)
+            buf = log_file.read(read_size) + pending
+
+            #-- A line is complete once the newline preceding it is in the buffer
+            end = len(buf)
+            while True:
+                newline = buf.rfind('\n', 0, end - 1)
+                if newline < 0:
+                    break
+                yield buf[newline + 1:end]
+                end = newline + 1
+            pending = buf[:end]
+
+        if pending:
+            yield pending
+    #---------------------------------------------------------------------
+
+    def analyze_file_from_offset(self, log_file_path, start_offset, match_messages_regex, ignore_messages_regex, expect_messages_regex):
+        '''
+        @summary: Analyze log file content between start and end markers, reading
+                  the file forward from the offset at which the start marker was
+                  placed. See analyze_file() for parameters description.
+
+        @param start_offset: Offset at or after which the start marker is located.
+
+        @return: Same as analyze_file(), or None if the start marker was not
+                 found after start_offset.
+        '''
+
+        self.print_diagnostic_message('analyzing file: %s from offset %d' % (log_file_path, start_offset))
+
+        in_analysis_range = False
+        matching_lines = []
+        expected_lines = []
+        found_start_marker = False
+        found_end_marker = False
+
+        start_marker = self.create_start_marker()
+        end_marker = self.create_end_marker()
+        matcher = LogMessageMatcher(match_messages_regex, ignore_messages_regex, expect_messages_regex)
+
+        with open(log_file_path, 'rb') as log_file:
+            log_file.seek(start_offset)
+
+            for line in log_file:
+                if line.find(end_marker) != -1:
+                    if (not found_start_marker):
+                        continue
+                    self.print_diagnostic_message('found end marker: %s' % end_marker)
+                    if (found_end_marker):
+                        print 'ERROR: duplicate end marker found'
+                        sys.exit(err_duplicate_end_marker)
+                    found_end_marker = True
+                    in_analysis_range = False
+                    continue
+
+                if line.find(start_marker) != -1 and 'nsible' not in line:
+                    self.print_diagnostic_message('found start marker: %s' % start_marker)
+                    if (found_end_marker):
+                        print 'ERROR: found start marker:%s without corresponding end marker' % line
+                        sys.exit(err_no_end_marker)
+
+                    #-- The latest start marker opens the analysis range
+                    found_start_marker = True
+                    in_analysis_range = True
+                    matching_lines = []
+                    expected_lines = []
+                    continue
+
+                if in_analysis_range:
+                    line_type = matcher.classify(line)
+                    if line_type == LogMessageMatcher.EXPECT:
+                        expected_lines.append(line)
+
+                    elif line_type == LogMessageMatcher.MATCH:
+                        self.print_diagnostic_message('matching line: %s' % line)
+                        matching_lines.append(line)
+
+        if (not found_start_marker):
+            return None
+
+        if (not found_end_marker):
+            print 'ERROR: end marker was not found'
+            sys.exit(err_no_end_marker)
+
+        #-- Keep the order analyze_file() returns lines in
+        matching_lines.reverse()
+        expected_lines.reverse()
+
+        return matching_lines, expected_lines
+    #---------------------------------------------------------------------
+
     def analyze_file(self, log_file_path, match_messages_regex, ignore_messages_regex, expect_messages_regex):
         '''
         @summary: Analyze input file content for messages matching input regex
@@ -290,6 +808,15 @@ class LogAnalyzer:
 
         self.print_diagnostic_message('analyzing file: %s'% log_file_path)
 
+        if not self.is_filename_stdin(log_file_path):
+            start_offset = self.get_start_offset(log_file_path)
+            if start_offset is not None:
+                result = self.analyze_file_from_offset(log_file_path, start_offset, match_messages_regex,
+                                                       ignore_messages_regex, expect_messages_regex)
+                if result is not None:
+                    return result
+                self.print_diagnostic_message('start marker not found after offset %d' % start_offset)
+
         #-- indicates whether log analyzer currently is in the log range between start
         #-- and end marker. see analyze_file method.
         in_analysis_range = False
@@ -300,13 +827,16 @@ class LogAnalyzer:
         found_end_marker = False
         if stdin_as_input:
             log_file = sys.stdin
+            rev_lines = reversed(log_file.readlines())
         else:
-            log_file = open(log_file_path, 'r')
+            log_file = open(log_file_path, 'rb')
+            rev_lines = self.reverse_readlines(log_file)
 
         start_marker = self.create_start_marker()
         end_marker = self.create_end_marker()
+        matcher = LogMessageMatcher(match_messages_regex, ignore_messages_regex, expect_messages_regex)
 
-        for rev_line in reversed(log_file.readlines()):
+        for rev_line in rev_lines:
             if stdin_as_input:
                 in_analysis_range = True
             else:
@@ -334,14 +864,18 @@ class LogAnalyzer:
                     break
 
             if in_analysis_range :
-                if self.line_is_expected(rev_line, expect_messages_regex):
+                line_type = matcher.classify(rev_line)
+                if line_type == LogMessageMatcher.EXPECT:
                     expected_lines.append(rev_line)
 
-                elif self.line_matches(rev_line, match_messages_regex, ignore_messages_regex):
+                elif line_type == LogMessageMatcher.MATCH:
+                    self.print_diagnostic_message('matching line: %s' % rev_line)
                     matching_lines.append(rev_line)
 
         # care about the markers only if input is not stdin
         if not stdin_as_input:
+            log_file.close()
+
             if (not found_start_marker):
                 print 'ERROR: start marker was not found'
                 sys.exit(err_no_start_marker)
@@ -353,7 +887,33 @@ class LogAnalyzer:
         return matching_lines, expected_lines
     #---------------------------------------------------------------------
 
-    def analyze_file_list(self, log_file_list, match_messages_regex, ignore_messages_regex, expect_messages_regex):
+    def analyze_file_list_in_parallel(self, log_file_list, jobs, match_messages_regex, ignore_messages_regex, expect_messages_regex):
+        '''
+        @summary: Analyze each of the input files in a separate worker process.
+            Regexes are passed to the workers once, when the worker is started.
+
+        @return: List of analyze_file() results, in the order of log_file_list.
+        '''
+
+        pool = multiprocessing.Pool(min(jobs, len(log_file_list)), init_analysis_worker,
+                                    (self.run_id, self.verbose, self.marker_index,
+                                     match_messages_regex, ignore_messages_regex, expect_messages_regex))
+        try:
+            worker_results = pool.map(analyze_file_in_worker, log_file_list)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = []
+        for exit_code, result in worker_results:
+            if exit_code is not None:
+                sys.exit(exit_code)
+            results.append(result)
+
+        return results
+    #---------------------------------------------------------------------
+
+    def analyze_file_list(self, log_file_list, match_messages_regex, ignore_messages_regex, expect_messages_regex, jobs=1):
         '''
         @summary: Analyze input files messages matching input regex expressions.
             See line_matches() for details on matching criteria.
@@ -369,15 +929,21 @@ class LogAnalyzer:
         @param expect_messages_regex:
             regex class instance containing messages that are expected to appear in logfile.
 
+        @param jobs: Number of files to analyze concurrently.
+
         @return: Returns map <file_name, list_of_matching_strings>
         '''
         res = {}
+        log_file_list = [log_file for log_file in log_file_list if len(log_file)]
 
-        for log_file in log_file_list:
-            if not len(log_file):
-                continue
-            match_strings, expect_strings = self.analyze_file(log_file, match_messages_regex, ignore_messages_regex, expect_messages_regex)
+        if jobs > 1 and len(log_file_list) > 1 and not any(map(self.is_filename_stdin, log_file_list)):
+            results = self.analyze_file_list_in_parallel(log_file_list, jobs, match_messages_regex,
+                                                         ignore_messages_regex, expect_messages_regex)
+        else:
+            results = [self.analyze_file(log_file, match_messages_regex, ignore_messages_regex, expect_messages_regex)
+                       for log_file in log_file_list]
 
+        for log_file, (match_strings, expect_strings) in zip(log_file_list, results):
             match_strings.reverse()
             expect_strings.reverse()
             res[log_file] = [ match_strings, expect_strings ]
@@ -385,14 +951,135 @@ class LogAnalyzer:
         return res
     #---------------------------------------------------------------------
 
+    def follow_file_list(self, log_file_list, match_messages_regex, ignore_messages_regex, expect_messages_regex, status_callback,
+                         timeout=follow_default_timeout):
+        '''
+        @summary: Analyze log files incrementally while they are being written.
+            Each file is followed from its start marker until its end marker
+            appears, new lines are analyzed as soon as they are appended.
+            See analyze_file_list() for parameters description.
+
+        @param status_callback: Called as status_callback(result, state) with
+            the result accumulated so far, each time new lines were read with
+            state 'running', and once more with state 'finished' when end
+            marker was found in all files or 'timeout' when it was not found
+            within timeout.
+
+        @param timeout: Maximum duration of following in seconds. An aborted or
+            crashed test never places the end marker, so following exits with
+            err_follow_timeout when the end marker is not found in time.
+
+        @return: Returns map <file_name, list_of_matching_strings>, same as
+            analyze_file_list()
+        '''
+
+        matcher = LogMessageMatcher(match_messages_regex, ignore_messages_regex, expect_messages_regex)
+        start_marker = self.create_start_marker()
+        end_marker = self.create_end_marker()
+
+        res = {}
+        followers = {}
+        in_analysis_range = {}
+        following = []
+        for log_file in log_file_list:
+            if not len(log_file) or log_file in followers:
+                continue
+            start_offset = self.get_start_offset(log_file)
+            self.print_diagnostic_message('following file: %s from offset %d' % (log_file, start_offset or 0))
+            followers[log_file] = LogFileFollower(log_file, start_offset or 0)
+            in_analysis_range[log_file] = False
+            res[log_file] = [[], []]
+            following.append(log_file)
+
+        deadline = time.time() + timeout
+        while following:
+            updated = False
+
+            for log_file in list(following):
+                matching_lines, expected_lines = res[log_file]
+
+                for line in followers[log_file].read_lines():
+                    updated = True
+
+                    if in_analysis_range[log_file] and line.find(end_marker) != -1:
+                        self.print_diagnostic_message('found end marker: %s in %s' % (end_marker, log_file))
+                        following.remove(log_file)
+                        break
+
+                    if line.find(start_marker) != -1 and 'nsible' not in line:
+                        self.print_diagnostic_message('found start marker: %s in %s' % (start_marker, log_file))
+                        #-- The latest start marker opens the analysis range
+                        in_analysis_range[log_file] = True
+                        del matching_lines[:]
+                        del expected_lines[:]
+                        continue
+
+                    if in_analysis_range[log_file]:
+                        line_type = matcher.classify(line)
+                        if line_type == LogMessageMatcher.EXPECT:
+                            expected_lines.append(line)
+
+                        elif line_type == LogMessageMatcher.MATCH:
+                            self.print_diagnostic_message('matching line: %s' % line)
+                            matching_lines.append(line)
+
+            if updated:
+                status_callback(res, 'running')
+
+            if following:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    status_callback(res, 'timeout')
+                    print 'ERROR: end marker was not found within %d seconds in: %s' % (timeout, ', '.join(following))
+                    sys.exit(err_follow_timeout)
+                time.sleep(min(follow_poll_interval, remaining))
+
+        status_callback(res, 'finished')
+
+        return res
+    #---------------------------------------------------------------------
+
+def init_analysis_worker(run_id, verbose, marker_index, match_messages_regex, ignore_messages_regex, expect_messages_regex):
+    '''
+    @summary: Initialize worker process of LogAnalyzer.analyze_file_list_in_parallel().
+    '''
+
+    global worker_context
+
+    analyzer = LogAnalyzer(run_id, verbose)
+    analyzer.marker_index = marker_index
+    worker_context = (analyzer, match_messages_regex, ignore_messages_regex, expect_messages_regex)
+#---------------------------------------------------------------------
+
+def analyze_file_in_worker(log_file):
+    '''
+    @summary: Analyze a log file in a worker process.
+
+    @return: Tuple of exit code, set if the analysis was aborted, and
+        analyze_file() result.
+    '''
+
+    analyzer, match_messages_regex, ignore_messages_regex, expect_messages_regex = worker_context
+
+    try:
+        return None, analyzer.analyze_file(log_file, match_messages_regex, ignore_messages_regex, expect_messages_regex)
+    except SystemExit as e:
+        #-- Let the parent process exit, a worker exiting would hang the pool
+        return e.code, None
+#---------------------------------------------------------------------
+
 def usage():
     print 'loganalyzer input parameters:'
     print '--help                           Print usage'
     print '--verbose                        Print verbose output during the run'
-    print '--action                         init|analyze - action to perform.'
+    print '--action                         init|analyze|follow - action to perform.'
     print '                                 init - initialize analysis by placing start-marker'
     print '                                 to all log files specified in --logs parameter.'
     print '                                 analyze - perform log analysis of files specified in --logs parameter.'
+    print '                                 follow - analyze files specified in --logs parameter while they are'
+    print '                                 being written, until end-marker is placed into them. Running counts'
+    print '                                 are written to follow.loganalysis.<run_id>.log in --out_dir.'
+    print '                                 Exits with an error when end-marker is not placed within --timeout.'
     print '--out_dir path                   Directory path where to place output files, '
     print '                                 must be present when --action == analyze'
     print '--logs path{,path}               List of full paths to log files to be analyzed.'
@@ -411,6 +1098,8 @@ def usage():
     print '                                 All the strings from these files will be expected to present'
     print '                                 in one of specified log files during the analysis. Must be present'
     print '                                 when action == analyze.'
+    print '--jobs number                    Number of log files to analyze concurrently. Default is 1.'
+    print '--timeout seconds                Maximum duration of the follow action. Default is %d.' % follow_default_timeout
 
 #---------------------------------------------------------------------
 
@@ -426,15 +1115,18 @@ def check_action(action, log_files_in, out_dir, match_files_in, ignore_files_in,
 
     if (action == 'init'):
         ret_code = True
-    elif (action == 'analyze'):
+    elif (action == 'analyze' or action == 'follow'):
         if out_dir is None or len(out_dir) == 0:
-            print 'ERROR: missing required out_dir for analyze action'
+            print 'ERROR: missing required out_dir for %s action' % action
             ret_code = False
 
         elif match_files_in is None or len(match_files_in) == 0:
-            print 'ERROR: missing required match_files_in for analyze action'
+            print 'ERROR: missing required match_files_in for %s action' % action
             ret_code = False
 
+        elif action == 'follow' and '-' in log_files_in.split(tokenizer):
+            print 'ERROR: stdin can not be followed, log files must be specified for %s action' % action
+            ret_code = False
 
     else:
         ret_code = False
@@ -555,6 +1247,49 @@ def write_summary_file(run_id, out_dir, analysis_result_per_file, unused_regex_m
     out_file.close()
 #---------------------------------------------------------------------
 
+def write_follow_status_file(run_id, out_dir, analysis_result_per_file, state):
+    '''
+    @summary: This function writes running counts of the follow action into
+        a file. The file is replaced atomically, so that it can be polled
+        while the analysis is in progress.
+
+    @param run_id: Unique string identifying current run
+
+    @param out_dir: Output directory full path.
+
+    @param analysis_result_per_file: map file_name:[list of matching strings]
+
+    @param state: 'running', 'finished' if end marker was found in all
+        files, or 'timeout' if it was not found in time.
+
+    @return: void
+    '''
+
+    status_file_path = out_dir + "/follow.loganalysis." + run_id + ".log"
+    tmp_file_path = status_file_path + ".tmp"
+
+    with open(tmp_file_path, 'w') as out_file:
+        out_file.write("\nLOG ANALYSIS FOLLOW STATUS\n")
+        total_match_cnt = 0
+        total_expect_cnt = 0
+        for key, val in analysis_result_per_file.iteritems():
+            matching_lines, expecting_lines = val
+
+            out_file.write("FILE:    %s    MATCHES    %d\n" % (key, len(matching_lines)))
+            out_file.write("FILE:    %s    EXPECTED MATCHES    %d\n" % (key, len(expecting_lines)))
+            total_match_cnt += len(matching_lines)
+            total_expect_cnt += len(expecting_lines)
+
+        out_file.write("-----------------------------------\n")
+        out_file.write("TOTAL MATCHES:                  %d\n" % total_match_cnt)
+        out_file.write("TOTAL EXPECTED MATCHES:         %d\n" % total_expect_cnt)
+        out_file.write("STATE:                          %s\n" % state)
+        out_file.write("-----------------------------------\n")
+        out_file.flush()
+
+    os.rename(tmp_file_path, status_file_path)
+#---------------------------------------------------------------------
+
 def main(argv):
 
     action = None
@@ -565,9 +1300,11 @@ def main(argv):
     ignore_files_in = None
     expect_files_in = None
     verbose = False
+    jobs = 1
+    timeout = follow_default_timeout
 
     try:
-        opts, args = getopt.getopt(argv, "a:r:l:o:m:i:e:vh", ["action=", "run_id=", "logs=", "out_dir=", "match_files_in=", "ignore_files_in=", "expect_files_in=", "verbose", "help"])
+        opts, args = getopt.getopt(argv, "a:r:l:o:m:i:e:j:t:vh", ["action=", "run_id=", "logs=", "out_dir=", "match_files_in=", "ignore_files_in=", "expect_files_in=", "jobs=", "timeout=", "verbose", "help"])
 
     except getopt.GetoptError:
         print "Invalid option specified"
@@ -600,6 +1337,22 @@ def main(argv):
         elif (opt in ("-e", "--expect_files_in")):
             expect_files_in = arg
 
+        elif (opt in ("-j", "--jobs")):
+            try:
+                jobs = int(arg)
+            except ValueError:
+                print 'ERROR: invalid number of jobs:%s specified' % arg
+                usage()
+                sys.exit(err_invalid_input)
+
+        elif (opt in ("-t", "--timeout")):
+            try:
+                timeout = int(arg)
+            except ValueError:
+                print 'ERROR: invalid timeout:%s specified' % arg
+                usage()
+                sys.exit(err_invalid_input)
+
         elif (opt in ("-v", "--verbose")):
             verbose = True
 
@@ -613,6 +1366,7 @@ def main(argv):
 
     result = {}
     if (action == "init"):
+        analyzer.save_marker_index(log_file_list or [system_log_file])
         analyzer.place_marker(log_file_list, analyzer.create_start_marker())
         return 0
     elif (action == "analyze"):
@@ -621,6 +1375,7 @@ def main(argv):
         expect_file_list = expect_files_in.split(tokenizer)
 
         analyzer.place_marker(log_file_list, analyzer.create_end_marker())
+        analyzer.load_marker_index()
 
         match_messages_regex, messages_regex_m = analyzer.create_msg_regex(match_file_list)
         ignore_messages_regex, messages_regex_i = analyzer.create_msg_regex(ignore_file_list)
@@ -631,10 +1386,31 @@ def main(argv):
             log_file_list.append(system_log_file)
 
         result = analyzer.analyze_file_list(log_file_list, match_messages_regex,
-                                            ignore_messages_regex, expect_messages_regex)
+                                            ignore_messages_regex, expect_messages_regex, jobs)
         unused_regex_messages = []
         write_result_file(run_id, out_dir, result, messages_regex_e, unused_regex_messages)
         write_summary_file(run_id, out_dir, result, unused_regex_messages)
+        analyzer.remove_marker_index()
+
+    elif (action == "follow"):
+        match_file_list = match_files_in.split(tokenizer)
+        ignore_file_list = ignore_files_in.split(tokenizer)
+        expect_file_list = expect_files_in.split(tokenizer)
+
+        analyzer.load_marker_index()
+
+        match_messages_regex, messages_regex_m = analyzer.create_msg_regex(match_file_list)
+        ignore_messages_regex, messages_regex_i = analyzer.create_msg_regex(ignore_file_list)
+        expect_messages_regex, messages_regex_e = analyzer.create_msg_regex(expect_file_list)
+
+        # if no log file specified - follow system log
+        if not log_file_list:
+            log_file_list.append(system_log_file)
+
+        result = analyzer.follow_file_list(log_file_list, match_messages_regex,
+                                           ignore_messages_regex, expect_messages_regex,
+                                           lambda res, state: write_follow_status_file(run_id, out_dir, res, state),
+                                           timeout)
 
     else:
         print 'Unknown action:%s specified' % action
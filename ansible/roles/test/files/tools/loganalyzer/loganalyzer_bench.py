@@ -0,0 +1,325 @@
+"""
+Benchmarks of loganalyzer.py.
+
+By default synthetic syslog lines are classified against the stock
+loganalyzer_common_*.txt rule files, once with the findall() checks loganalyzer
+used before LogMessageMatcher was added and once with LogMessageMatcher. The
+classification of every line must be the same on both paths:
+
+python loganalyzer_bench.py [--lines 200000] [--rules 0] [--match match.txt,...]
+
+--rules N adds a generated match file with N 's' rules, --match replaces the
+stock match file with the given ones.
+
+With --reverse a synthetic syslog with the marker pair near its end is analyzed,
+once by reading the whole file with readlines(), as analyze_file did before
+reverse_readlines() was added, and once by analyze_file. Each path runs in its
+own process, so that its peak memory can be reported:
+
+python loganalyzer_bench.py --reverse [--size 1024] [--window 2] [--log syslog]
+
+--size is the size of the generated syslog in MB, --window is the part of it
+between the markers in percent. --log analyzes an existing file instead, it
+must contain the start and end markers of run id 'bench'.
+
+With --startup the time loganalyzer needs from start until its matcher is built
+is measured for the stock match file plus --rules generated rules (500 by
+default), with an empty rule cache and with the cache left by the previous run.
+Every run is a new process, so nothing is reused from memory:
+
+python loganalyzer_bench.py --startup [--rules 500] [--repeat 5]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import loganalyzer
+
+
+RULES_DIR = os.path.dirname(os.path.abspath(__file__))
+COMMON_MATCH = os.path.join(RULES_DIR, 'loganalyzer_common_match.txt')
+COMMON_IGNORE = os.path.join(RULES_DIR, 'loganalyzer_common_ignore.txt')
+COMMON_EXPECT = os.path.join(RULES_DIR, 'loganalyzer_common_expect.txt')
+RUN_ID = 'bench'
+STARTUP_RULES = 500
+
+#-- Messages of the synthetic syslog and how often they appear
+MESSAGES = [
+    (900, 'INFO swss#orchagent: :- doTask: Set port Ethernet%(n)d admin status to up'),
+    (900, 'NOTICE syncd#syncd: :- processEvent: port Ethernet%(n)d oper status changed'),
+    (500, 'INFO bgp#bgpd[%(n)d]: %%ADJCHANGE: neighbor 10.0.0.%(n)d Up'),
+    (300, 'INFO kernel: [%(n)d.000000] Bridge: port %(n)d(Ethernet%(n)d) entered forwarding state'),
+    (100, 'INFO lldp#lldpd[%(n)d]: MSAP has changed for port Ethernet%(n)d'),
+    (10, 'ERR swss#orchagent: :- addNeighbor: Failed to create neighbor 10.0.0.%(n)d on Vlan1000'),
+    (10, 'WARNING syncd#syncd: :- meta_sai_validate: object 0x%(n)x does not exist'),
+    (5, 'ERR ntpd[%(n)d]: routing socket reports: No buffer space available'),
+    (2, 'WARNING kernel: [%(n)d.000000] bnxt: kmemleak: 1 new suspected memory leaks'),
+]
+
+
+def old_classify(line, match_messages_regex, ignore_messages_regex, expect_messages_regex):
+    if (expect_messages_regex is not None) and expect_messages_regex.findall(line):
+        return loganalyzer.LogMessageMatcher.EXPECT
+
+    if (match_messages_regex is not None) and match_messages_regex.findall(line):
+        if (ignore_messages_regex is None) or (not ignore_messages_regex.findall(line)):
+            return loganalyzer.LogMessageMatcher.MATCH
+
+    return None
+
+
+def generate_lines(count):
+    rnd = random.Random(0)
+    choices = []
+    for weight, message in MESSAGES:
+        choices += [message] * weight
+
+    lines = []
+    for i in xrange(count):
+        line = 'Oct 18 05:%02d:%02d.%06d sonic %s\n' % (i // 3600 % 60, i // 60 % 60, i % 1000000, rnd.choice(choices) % {'n': rnd.randint(0, 255)})
+        lines.append(line)
+
+    return lines
+
+
+def generate_log(path, size, window):
+    """writes a syslog of size bytes, with the start marker window percent from its end and the end marker last"""
+    block = ''.join(generate_lines(100000))
+    analyzer = loganalyzer.LogAnalyzer(RUN_ID, False)
+    start_offset = size - size * window // 100
+
+    with open(path, 'wb') as log_file:
+        written = 0
+        marked = False
+        while written < size:
+            data = block[:size - written]
+            if not marked and written + len(data) >= start_offset:
+                data = data[:data.rfind('\n', 0, max(start_offset - written, 1)) + 1]
+                data += 'Oct 18 05:00:00.000000 sonic INFO LogAnalyzer: %s\n' % analyzer.create_start_marker()
+                marked = True
+            log_file.write(data)
+            written += len(data)
+        log_file.write('Oct 18 06:00:00.000000 sonic INFO LogAnalyzer: %s\n' % analyzer.create_end_marker())
+
+
+def generate_rules(path, count):
+    with open(path, 'w') as rule_file:
+        for i in xrange(count):
+            rule_file.write('s, "Failed to program route entry %d for prefix 192.168.%d.0/24 with status -%d"\n' % (i, i % 256, i % 17 + 1))
+
+
+def time_classify(lines, classify):
+    start = time.time()
+    result = [classify(line) for line in lines]
+    return time.time() - start, result
+
+
+def create_regexes(match, rules):
+    """returns match, ignore and expect regexes built from the rule files"""
+    #-- Expressions are built from the rule files every time, not loaded from the user's cache
+    work_dir = tempfile.mkdtemp()
+    loganalyzer.rule_cache_dir = os.path.join(work_dir, 'cache')
+    try:
+        match_files = match.split(',')
+        if rules:
+            match_files.append(os.path.join(work_dir, 'generated_match.txt'))
+            generate_rules(match_files[-1], rules)
+
+        analyzer = loganalyzer.LogAnalyzer(RUN_ID, False)
+        return (analyzer.create_msg_regex(match_files)[0],
+                analyzer.create_msg_regex([COMMON_IGNORE])[0],
+                analyzer.create_msg_regex([COMMON_EXPECT])[0])
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def readlines_analyze(analyzer, log_file_path, match_messages_regex, ignore_messages_regex, expect_messages_regex):
+    """analyze_file() as it was before reverse_readlines(), lines are classified the same way"""
+    matcher = loganalyzer.LogMessageMatcher(match_messages_regex, ignore_messages_regex, expect_messages_regex)
+    start_marker = analyzer.create_start_marker()
+    end_marker = analyzer.create_end_marker()
+    matching_lines = []
+    expected_lines = []
+    in_analysis_range = False
+
+    with open(log_file_path, 'r') as log_file:
+        for rev_line in reversed(log_file.readlines()):
+            if rev_line.find(end_marker) != -1:
+                in_analysis_range = True
+                continue
+
+            if rev_line.find(start_marker) != -1 and 'nsible' not in rev_line:
+                break
+
+            if in_analysis_range:
+                line_type = matcher.classify(rev_line)
+                if line_type == loganalyzer.LogMessageMatcher.EXPECT:
+                    expected_lines.append(rev_line)
+                elif line_type == loganalyzer.LogMessageMatcher.MATCH:
+                    matching_lines.append(rev_line)
+
+    return matching_lines, expected_lines
+
+
+def reverse_worker(method, log_file_path, match):
+    """analyzes the log with one of the methods and prints the results of the process as json"""
+    regexes = create_regexes(match, 0)
+    analyzer = loganalyzer.LogAnalyzer(RUN_ID, False)
+    analyze = readlines_analyze if method == 'readlines' else loganalyzer.LogAnalyzer.analyze_file
+
+    start = time.time()
+    matching_lines, expected_lines = analyze(analyzer, log_file_path, *regexes)
+    elapsed = time.time() - start
+
+    print json.dumps({'time': elapsed,
+                      'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      'matching': len(matching_lines),
+                      'expected': len(expected_lines),
+                      'digest': hashlib.sha1(''.join(matching_lines + ['\0'] + expected_lines)).hexdigest()})
+
+    return 0
+
+
+def startup_worker(match, cache_dir):
+    """builds the expressions and the matcher from the rule files and prints the time and a digest of the result as json"""
+    loganalyzer.rule_cache_dir = cache_dir
+    analyzer = loganalyzer.LogAnalyzer(RUN_ID, False)
+
+    start = time.time()
+    regexes = (analyzer.create_msg_regex(match.split(','))[0],
+               analyzer.create_msg_regex([COMMON_IGNORE])[0],
+               analyzer.create_msg_regex([COMMON_EXPECT])[0])
+    matcher = loganalyzer.LogMessageMatcher(*regexes)
+    elapsed = time.time() - start
+
+    digest = hashlib.sha1(repr([regex and regex.pattern for regex in regexes] + sorted(matcher.literals)))
+    print json.dumps({'time': elapsed, 'digest': digest.hexdigest()})
+
+    return 0
+
+
+def startup_bench(args):
+    rules = STARTUP_RULES if args.rules is None else args.rules
+    work_dir = tempfile.mkdtemp()
+    try:
+        match = args.match
+        if rules:
+            match += ',' + os.path.join(work_dir, 'generated_match.txt')
+            generate_rules(match.split(',')[-1], rules)
+
+        cache_dir = os.path.join(work_dir, 'cache')
+        results = {}
+        for cache in ('cold', 'warm'):
+            results[cache] = []
+            for _ in xrange(args.repeat):
+                if cache == 'cold':
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                start = time.time()
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--startup-worker', cache_dir,
+                                                  '--match', match])
+                process_time = time.time() - start
+                result = json.loads(output)
+                results[cache].append((process_time, result['time'], result['digest']))
+    finally:
+        shutil.rmtree(work_dir)
+
+    print "Match files: %s%s, best of %d runs" % (args.match, ' (+%d generated)' % rules if rules else '', args.repeat)
+    for cache in ('cold', 'warm'):
+        process_time, build_time, _ = min(results[cache])
+        print "%s cache: %.1fms process, %.1fms to build the matcher" % (cache, process_time * 1000, build_time * 1000)
+
+    if len(set(digest for cache in results for _, _, digest in results[cache])) != 1:
+        print "ERROR: the expressions built with the cache differ"
+        return 1
+
+    return 0
+
+
+def reverse_bench(args):
+    work_dir = None
+    log_file_path = args.log
+    try:
+        if log_file_path is None:
+            work_dir = tempfile.mkdtemp()
+            log_file_path = os.path.join(work_dir, 'syslog')
+            start = time.time()
+            generate_log(log_file_path, args.size << 20, args.window)
+            print "Generated %dMB syslog in %.1f seconds" % (args.size, time.time() - start)
+
+        results = {}
+        for method in ('readlines', 'reverse_readlines'):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--reverse-worker', method,
+                                              '--log', log_file_path, '--match', args.match])
+            results[method] = json.loads(output)
+            print "%-20s %.3f seconds, max RSS %dMB, %d matching and %d expected lines" % \
+                (method + '():', results[method]['time'], results[method]['max_rss'] // 1024,
+                 results[method]['matching'], results[method]['expected'])
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+
+    if results['readlines']['digest'] != results['reverse_readlines']['digest']:
+        print "ERROR: the analysis results differ"
+        return 1
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='loganalyzer benchmarks')
+    parser.add_argument('--lines', type=int, default=200000, help='number of synthetic syslog lines')
+    parser.add_argument('--rules', type=int, help='number of generated rules added to the match set, 0 by default, %d with --startup' % STARTUP_RULES)
+    parser.add_argument('--match', default=COMMON_MATCH, help='comma separated match files')
+    parser.add_argument('--reverse', action='store_true', help='benchmark reading the log backwards to the start marker')
+    parser.add_argument('--size', type=int, default=1024, help='size of the generated syslog in MB')
+    parser.add_argument('--window', type=int, default=2, help='part of the syslog between the markers in percent')
+    parser.add_argument('--log', help='analyze this syslog instead of a generated one')
+    parser.add_argument('--startup', action='store_true', help='benchmark building the matcher with and without the rule cache')
+    parser.add_argument('--repeat', type=int, default=5, help='number of processes started for each --startup case')
+    parser.add_argument('--reverse-worker', choices=['readlines', 'reverse_readlines'], help=argparse.SUPPRESS)
+    parser.add_argument('--startup-worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.reverse_worker:
+        return reverse_worker(args.reverse_worker, args.log, args.match)
+    if args.reverse:
+        return reverse_bench(args)
+    if args.startup_worker:
+        return startup_worker(args.match, args.startup_worker)
+    if args.startup:
+        return startup_bench(args)
+
+    rules = args.rules or 0
+    match_messages_regex, ignore_messages_regex, expect_messages_regex = create_regexes(args.match, rules)
+    lines = generate_lines(args.lines)
+
+    old_time, old_result = time_classify(lines, lambda line: old_classify(line, match_messages_regex,
+                                                                          ignore_messages_regex, expect_messages_regex))
+    matcher = loganalyzer.LogMessageMatcher(match_messages_regex, ignore_messages_regex, expect_messages_regex)
+    new_time, new_result = time_classify(lines, matcher.classify)
+
+    print "Match files: %s%s" % (args.match, ' (+%d generated)' % rules if rules else '')
+    print "Matching lines: %d, expected lines: %d" % (new_result.count(loganalyzer.LogMessageMatcher.MATCH),
+                                                     new_result.count(loganalyzer.LogMessageMatcher.EXPECT))
+    print "findall():         %.3f seconds (%.0f lines/s)" % (old_time, len(lines) / old_time)
+    print "LogMessageMatcher: %.3f seconds (%.0f lines/s)" % (new_time, len(lines) / new_time)
+
+    if old_result != new_result:
+        diff = sum(1 for old, new in zip(old_result, new_result) if old != new)
+        print "ERROR: %d lines are classified differently" % diff
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
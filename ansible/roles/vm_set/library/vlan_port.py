@@ -1,9 +1,9 @@
 #!/usr/bin/python
 
-import re
-import sys
-import time
-import subprocess
+import contextlib
+import os
+import socket
+import struct
 from pprint import pprint
 from ansible.module_utils.basic import *
 
@@ -30,92 +30,216 @@ DOCUMENTATION = '''
 CMD_DEBUG_FNAME = '/tmp/vlan_port.cmds.txt'
 EXCEPTION_DEBUG_FNAME = '/tmp/vlan_port.exception.txt'
 
+
+class Netlink(object):
+    """
+    Minimal rtnetlink client for the host network namespace, a trimmed copy of
+    the one in vm_topology.py: it lists, creates, deletes and brings up links
+    without forking ip/ifconfig/vconfig. Ansible 2.0 only ships its own
+    module_utils with a module, so the class can't live in a shared file.
+    Requests issued inside 'with nl.batch():' are sent together in one message
+    and their acknowledgements are checked at the end of the block.
+    """
+    NLMSGHDR = struct.Struct('=IHHII')
+    IFINFOMSG = struct.Struct('=BxHiII')
+    RTATTR = struct.Struct('=HH')
+    NLMSGERR = struct.Struct('=i')
+
+    NETLINK_ROUTE = 0
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_ACK = 0x4
+    NLM_F_DUMP = 0x300
+    NLM_F_EXCL = 0x200
+    NLM_F_CREATE = 0x400
+    RTM_NEWLINK = 16
+    RTM_DELLINK = 17
+    RTM_GETLINK = 18
+    RTM_SETLINK = 19
+    IFLA_IFNAME = 3
+    IFLA_LINK = 5
+    IFLA_LINKINFO = 18
+    IFLA_INFO_KIND = 1
+    IFLA_INFO_DATA = 2
+    IFLA_VLAN_ID = 1
+    IFF_UP = 0x1
+    MAX_BATCH_SIZE = 1 << 15
+    RCV_SIZE = 1 << 16
+
+    def __init__(self):
+        self.seq = 0
+        self.pending = None
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, Netlink.NETLINK_ROUTE)
+        self.socket.bind((0, 0))
+
+    def close(self):
+        self.socket.close()
+
+    @staticmethod
+    def attr(attr_type, data):
+        length = Netlink.RTATTR.size + len(data)
+        return Netlink.RTATTR.pack(length, attr_type) + data + '\0' * ((4 - length % 4) % 4)
+
+    @staticmethod
+    def parse_attrs(data, offset=0):
+        attrs = {}
+        while offset + Netlink.RTATTR.size <= len(data):
+            length, attr_type = Netlink.RTATTR.unpack_from(data, offset)
+            if length < Netlink.RTATTR.size:
+                break
+            attrs[attr_type & 0x3fff] = data[offset + Netlink.RTATTR.size:offset + length]
+            offset += (length + 3) & ~3
+        return attrs
+
+    @staticmethod
+    def ifinfo(index=0, flags=0, change=0):
+        return Netlink.IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, flags, change)
+
+    def message(self, msg_type, flags, payload):
+        self.seq += 1
+        return self.seq, Netlink.NLMSGHDR.pack(Netlink.NLMSGHDR.size + len(payload), msg_type, flags | Netlink.NLM_F_REQUEST, self.seq, 0) + payload
+
+    def recv_messages(self):
+        data = self.socket.recv(self.RCV_SIZE)
+        offset = 0
+        while offset + Netlink.NLMSGHDR.size <= len(data):
+            length, msg_type, _, seq, _ = Netlink.NLMSGHDR.unpack_from(data, offset)
+            yield msg_type, seq, data[offset + Netlink.NLMSGHDR.size:offset + length]
+            offset += (length + 3) & ~3
+
+    def request(self, msg_type, payload, flags=0, description=None):
+        with open(CMD_DEBUG_FNAME, 'a') as fp:
+            pprint("NETLINK: %s" % description, fp)
+        message = self.message(msg_type, flags | Netlink.NLM_F_ACK, payload)
+        if self.pending is not None:
+            self.pending.append((message, description))
+        else:
+            self.send([(message, description)])
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.pending = []
+        try:
+            yield self
+            pending = self.pending
+        finally:
+            self.pending = None
+        self.send(pending)
+
+    def send(self, requests):
+        """sends the requests, as few messages as possible, and checks all acknowledgements"""
+        descriptions = {}
+        chunk = ''
+        for (seq, data), description in requests:
+            descriptions[seq] = description
+            if len(chunk) + len(data) > Netlink.MAX_BATCH_SIZE:
+                self.socket.send(chunk)
+                chunk = ''
+            chunk += data
+        if chunk:
+            self.socket.send(chunk)
+
+        errors = []
+        while descriptions:
+            for msg_type, seq, payload in self.recv_messages():
+                if msg_type != Netlink.NLMSG_ERROR or seq not in descriptions:
+                    continue
+                error, = Netlink.NLMSGERR.unpack_from(payload)
+                description = descriptions.pop(seq)
+                if error != 0:
+                    errors.append("%s: %s" % (description, os.strerror(-error)))
+        if errors:
+            raise Exception("netlink request failed: %s" % '; '.join(errors))
+
+    def dump(self, msg_type, payload):
+        seq, data = self.message(msg_type, Netlink.NLM_F_DUMP, payload)
+        self.socket.send(data)
+        result = []
+        while True:
+            for reply_type, reply_seq, reply in self.recv_messages():
+                if reply_seq != seq:
+                    continue
+                if reply_type == Netlink.NLMSG_DONE:
+                    return result
+                if reply_type == Netlink.NLMSG_ERROR:
+                    error, = Netlink.NLMSGERR.unpack_from(reply)
+                    raise Exception("netlink dump failed: %s" % os.strerror(-error))
+                result.append(reply)
+
+    def links(self):
+        """returns name:{'index', 'flags'} for all links"""
+        links = {}
+        for reply in self.dump(Netlink.RTM_GETLINK, Netlink.ifinfo()):
+            _, _, index, flags, _ = Netlink.IFINFOMSG.unpack_from(reply)
+            attrs = Netlink.parse_attrs(reply, Netlink.IFINFOMSG.size)
+            if Netlink.IFLA_IFNAME in attrs:
+                links[attrs[Netlink.IFLA_IFNAME].rstrip('\0')] = {'index': index, 'flags': flags}
+        return links
+
+    def index(self, name):
+        links = self.links()
+        if name not in links:
+            raise Exception("Can't find interface %s" % name)
+        return links[name]['index']
+
+    def add_vlan(self, name, link, vlan_id):
+        linkinfo = Netlink.attr(Netlink.IFLA_INFO_KIND, 'vlan\0') + \
+                   Netlink.attr(Netlink.IFLA_INFO_DATA, Netlink.attr(Netlink.IFLA_VLAN_ID, struct.pack('=H', vlan_id)))
+        self.request(Netlink.RTM_NEWLINK,
+                     Netlink.ifinfo() + Netlink.attr(Netlink.IFLA_IFNAME, name + '\0') +
+                     Netlink.attr(Netlink.IFLA_LINK, struct.pack('=I', self.index(link))) + Netlink.attr(Netlink.IFLA_LINKINFO, linkinfo),
+                     Netlink.NLM_F_CREATE | Netlink.NLM_F_EXCL, "add vlan %s link %s id %d" % (name, link, vlan_id))
+
+    def del_link(self, name):
+        self.request(Netlink.RTM_DELLINK, Netlink.ifinfo() + Netlink.attr(Netlink.IFLA_IFNAME, name + '\0'), 0, "delete %s" % name)
+
+    def set_link(self, name, up):
+        self.request(Netlink.RTM_SETLINK, Netlink.ifinfo(0, Netlink.IFF_UP if up else 0, Netlink.IFF_UP) +
+                     Netlink.attr(Netlink.IFLA_IFNAME, name + '\0'), 0, "set %s %s" % (name, 'up' if up else 'down'))
+
+
 class VlanPort(object):
     def __init__(self, external_port, vlan_ids):
         self.external_port = external_port
         self.vlan_ids = vlan_ids
-        self.host_ifaces = VlanPort.ifconfig('ifconfig -a')
+        self.netlink = Netlink()
+        self.host_ifaces = set(self.netlink.links())
 
         return
 
     def up_external_port(self):
         if self.external_port in self.host_ifaces:
-            VlanPort.iface_up(self.external_port)
+            self.netlink.set_link(self.external_port, up=True)
 
         return
 
     def create_vlan_port(self, port, vlan_id):
         vlan_port = "%s.%d" % (port, vlan_id)
         if vlan_port not in self.host_ifaces:
-            VlanPort.cmd('vconfig add %s %d' % (port, vlan_id))
+            self.netlink.add_vlan(vlan_port, port, vlan_id)
 
-        VlanPort.iface_up(vlan_port)
+        self.netlink.set_link(vlan_port, up=True)
 
         return
 
     def destroy_vlan_port(self, vlan_port):
         if vlan_port in self.host_ifaces:
-            VlanPort.iface_down(vlan_port)
-            VlanPort.cmd('vconfig rem %s' % vlan_port)
+            self.netlink.set_link(vlan_port, up=False)
+            self.netlink.del_link(vlan_port)
 
         return
 
     def create_vlan_ports(self):
-        for vlan_id in self.vlan_ids:
-            self.create_vlan_port(self.external_port, vlan_id)
+        with self.netlink.batch():
+            for vlan_id in self.vlan_ids:
+                self.create_vlan_port(self.external_port, vlan_id)
 
     def remove_vlan_ports(self):
-        for vlan_id in self.vlan_ids:
-            vlan_port = "%s.%d" % (self.external_port, vlan_id)
-            self.destroy_vlan_port(vlan_port)
-
-    @staticmethod
-    def ifconfig(cmdline):
-        out = VlanPort.cmd(cmdline)
-
-        ifaces = set()
-
-        rows = out.split('\n')
-        for row in rows:
-            if len(row) == 0:
-                continue
-            terms = row.split()
-            if not row[0].isspace():
-                ifaces.add(terms[0].rstrip(':'))
-
-        return ifaces
-
-    @staticmethod
-    def iface_up(iface_name, pid=None):
-        return VlanPort.iface_updown(iface_name, 'up', pid)
-
-    @staticmethod
-    def iface_down(iface_name, pid=None):
-        return VlanPort.iface_updown(iface_name, 'down', pid)
-
-    @staticmethod
-    def iface_updown(iface_name, state, pid):
-        if pid is None:
-            return VlanPort.cmd('ip link set %s %s' % (iface_name, state))
-        else:
-            return VlanPort.cmd('nsenter -t %s -n ip link set %s %s' % (pid, iface_name, state))
-
-    @staticmethod
-    def cmd(cmdline):
-        with open(CMD_DEBUG_FNAME, 'a') as fp:
-            pprint("CMD: %s" % cmdline, fp)
-        cmd = cmdline.split(' ')
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        ret_code = process.returncode
-
-        if ret_code != 0:
-            raise Exception("ret_code=%d, error message=%s. cmd=%s" % (ret_code, stderr, cmdline))
-
-        with open(CMD_DEBUG_FNAME, 'a') as fp:
-            pprint("OUTPUT: %s" % stdout, fp)
-
-        return stdout
+        with self.netlink.batch():
+            for vlan_id in self.vlan_ids:
+                vlan_port = "%s.%d" % (self.external_port, vlan_id)
+                self.destroy_vlan_port(vlan_port)
 
 def main():
 
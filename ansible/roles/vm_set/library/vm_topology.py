@@ -1,10 +1,20 @@
 #!/usr/bin/python
 
+import contextlib
+import ctypes
+import ctypes.util
+import functools
+import json
+import socket
+import struct
 import subprocess
 import re
 import os
 import os.path
 import re
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 from docker import Client
 from ansible.module_utils.basic import *
 import traceback
@@ -56,6 +66,8 @@ Parameters:
     - dut_fp_ports: dut ports
     - dut_mgmt_port: dut mgmt port
     - fp_mtu: MTU for FP ports
+    - workers: number of threads which program independent ovs bridges in parallel, 1 runs everything serially.
+      Wall clock time of every phase is returned in 'timings'
 '''
 
 EXAMPLES = '''
@@ -100,20 +112,539 @@ ROOT_BACK_BR_TEMPLATE = 'br-b-%s'
 PTF_FP_IFACE_TEMPLATE = 'eth%d'
 BACK_ROOT_END_IF_TEMPLATE = 'veth-bb-%s'
 BACK_VM_END_IF_TEMPLATE = 'veth-bv-%s'
-RETRIES = 3
+DEFAULT_WORKERS = 8
+
+
+def parallel_map(func, items, workers):
+    """map() over a pool of at most workers threads. func must not share state with other calls"""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def timed_phase(func):
+    """records wall clock time of a VMTopology phase in self.timings"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            self.timings.append((func.__name__, round(elapsed, 3)))
+            with open(CMD_DEBUG_FNAME, 'a') as fp:
+                pprint("TIME: %s %.3f" % (func.__name__, elapsed), fp)
+
+    return wrapper
+
+
+class OvsBatch(object):
+    """
+    Collects ovs changes and applies only the ones which the HostState model
+    says are missing, with as few processes as possible: all ovsdb changes go to
+    one ovs-vsctl transaction, and the flows of every bridge are installed by
+    one ovs-ofctl replace-flows from a generated file. Flows refer to ports by
+    name, the names are resolved to OpenFlow port numbers after the ports are
+    added. Bridges are independent of each other, so up to workers
+    replace-flows run at the same time.
+
+    Flows are not compared with the model: the flows of a bridge can be changed
+    behind the module's back (vm_resumer.py, ovs-ofctl by hand, a restarted
+    ovs-vswitchd). replace-flows compares them with the flows installed on the
+    bridge and only changes the ones which differ.
+    """
+
+    def __init__(self, state, workers=1):
+        self.state = state
+        self.workers = workers
+        self.vsctl_cmds = []
+        self.changes = []   # (command, bridge, port) applied to the model
+        self.flows = {}     # bridge -> [(flow template, port names)]
+
+    def vsctl(self, cmd):
+        self.vsctl_cmds.append(cmd)
+
+    def add_bridge(self, bridge):
+        if bridge in self.state.br_ports:
+            return
+        self.vsctl('--may-exist add-br %s' % bridge)
+        self.changes.append(('add-br', bridge, None))
+
+    def del_bridge(self, bridge):
+        if bridge not in self.state.br_ports:
+            return
+        self.vsctl('--if-exists del-br %s' % bridge)
+        self.changes.append(('del-br', bridge, None))
+
+    def add_port(self, bridge, port):
+        if port in self.state.br_ports.get(bridge, set()):
+            if port in self.state.ofports and port not in self.state.new_links:
+                return
+            # the interface was recreated by this run or lost by ovs-vswitchd, the port is added again
+            self.del_port(bridge, port)
+        self.vsctl('--may-exist add-port %s %s' % (bridge, port))
+        self.changes.append(('add-port', bridge, port))
+
+    def del_port(self, bridge, port):
+        if port not in self.state.br_ports.get(bridge, set()):
+            return
+        self.vsctl('--if-exists del-port %s %s' % (bridge, port))
+        self.changes.append(('del-port', bridge, port))
+
+    def set_flows(self, bridge, flows):
+        """replace all flows of the bridge. flows is a list of (template, port names),
+        every template is formatted with the port numbers"""
+        self.flows[bridge] = flows
+
+    def commit(self):
+        if self.vsctl_cmds:
+            VMTopology.cmd('ovs-vsctl -- %s' % ' -- '.join(self.vsctl_cmds))
+            self.vsctl_cmds = []
+            for change in self.changes:
+                self.state.apply_ovs_change(*change)
+            self.changes = []
+
+        if self.flows:
+            ports = set()
+            for flows in self.flows.itervalues():
+                for _, names in flows:
+                    ports.update(names)
+            ofports = self.state.ofports
+            missing = ports - set(ofports)
+            if missing:
+                ofports.update(VMTopology.get_ovs_ofports(missing))
+            bridge_flows = [(bridge, [template % tuple(ofports[name] for name in names) for template, names in flows])
+                            for bridge, flows in sorted(self.flows.iteritems())]
+            parallel_map(lambda args: VMTopology.replace_ovs_flows(*args), bridge_flows, self.workers)
+            self.flows = {}
+
+        return
+
+
+class Netlink(object):
+    """
+    Minimal rtnetlink client, which manages links, addresses and routes in-process
+    instead of forking ip/ifconfig/brctl/nsenter. Netlink(pid) works in the network
+    namespace of the process pid: the socket is created after setns() into it.
+    Requests issued inside 'with nl.batch():' are sent together in one message
+    and their acknowledgements are checked at the end of the block.
+    """
+    NLMSGHDR = struct.Struct('=IHHII')
+    IFINFOMSG = struct.Struct('=BxHiII')
+    IFADDRMSG = struct.Struct('=BBBBI')
+    RTMSG = struct.Struct('=BBBBBBBBI')
+    RTATTR = struct.Struct('=HH')
+    NLMSGERR = struct.Struct('=i')
+
+    NETLINK_ROUTE = 0
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_ACK = 0x4
+    NLM_F_DUMP = 0x300
+    NLM_F_EXCL = 0x200
+    NLM_F_CREATE = 0x400
+    RTM_NEWLINK = 16
+    RTM_DELLINK = 17
+    RTM_GETLINK = 18
+    RTM_SETLINK = 19
+    RTM_NEWADDR = 20
+    RTM_DELADDR = 21
+    RTM_GETADDR = 22
+    RTM_NEWROUTE = 24
+    IFLA_IFNAME = 3
+    IFLA_MTU = 4
+    IFLA_LINK = 5
+    IFLA_MASTER = 10
+    IFLA_LINKINFO = 18
+    IFLA_NET_NS_PID = 19
+    IFLA_LINK_NETNSID = 37
+    IFLA_INFO_KIND = 1
+    IFLA_INFO_DATA = 2
+    VETH_INFO_PEER = 1
+    IFA_ADDRESS = 1
+    IFA_LOCAL = 2
+    RTA_OIF = 4
+    RTA_GATEWAY = 5
+    IFF_UP = 0x1
+    RT_TABLE_MAIN = 254
+    RTPROT_BOOT = 3
+    RT_SCOPE_UNIVERSE = 0
+    RTN_UNICAST = 1
+    CLONE_NEWNET = 0x40000000
+    MAX_BATCH_SIZE = 1 << 15
+    RCV_SIZE = 1 << 16
+
+    def __init__(self, pid=None):
+        self.seq = 0
+        self.pending = None
+        if pid is None:
+            self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, Netlink.NETLINK_ROUTE)
+        else:
+            self.socket = Netlink.socket_in_netns(pid)
+        self.socket.bind((0, 0))
+
+    @staticmethod
+    def socket_in_netns(pid):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        with open('/proc/self/ns/net') as own_ns, open('/proc/%s/ns/net' % pid) as target_ns:
+            if libc.setns(target_ns.fileno(), Netlink.CLONE_NEWNET) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, "setns to the network namespace of %s: %s" % (pid, os.strerror(err)))
+            try:
+                return socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, Netlink.NETLINK_ROUTE)
+            finally:
+                libc.setns(own_ns.fileno(), Netlink.CLONE_NEWNET)
+
+    def close(self):
+        self.socket.close()
+
+    @staticmethod
+    def attr(attr_type, data):
+        length = Netlink.RTATTR.size + len(data)
+        return Netlink.RTATTR.pack(length, attr_type) + data + '\0' * ((4 - length % 4) % 4)
+
+    @staticmethod
+    def parse_attrs(data, offset=0):
+        attrs = {}
+        while offset + Netlink.RTATTR.size <= len(data):
+            length, attr_type = Netlink.RTATTR.unpack_from(data, offset)
+            if length < Netlink.RTATTR.size:
+                break
+            attrs[attr_type & 0x3fff] = data[offset + Netlink.RTATTR.size:offset + length]
+            offset += (length + 3) & ~3
+        return attrs
+
+    @staticmethod
+    def ifinfo(index=0, flags=0, change=0):
+        return Netlink.IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, flags, change)
+
+    def message(self, msg_type, flags, payload):
+        self.seq += 1
+        return self.seq, Netlink.NLMSGHDR.pack(Netlink.NLMSGHDR.size + len(payload), msg_type, flags | Netlink.NLM_F_REQUEST, self.seq, 0) + payload
+
+    def recv_messages(self):
+        data = self.socket.recv(self.RCV_SIZE)
+        offset = 0
+        while offset + Netlink.NLMSGHDR.size <= len(data):
+            length, msg_type, _, seq, _ = Netlink.NLMSGHDR.unpack_from(data, offset)
+            yield msg_type, seq, data[offset + Netlink.NLMSGHDR.size:offset + length]
+            offset += (length + 3) & ~3
+
+    def request(self, msg_type, payload, flags=0, description=None):
+        with open(CMD_DEBUG_FNAME, 'a') as fp:
+            pprint("NETLINK: %s" % description, fp)
+        message = self.message(msg_type, flags | Netlink.NLM_F_ACK, payload)
+        if self.pending is not None:
+            self.pending.append((message, description))
+        else:
+            self.send([(message, description)])
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.pending = []
+        try:
+            yield self
+            pending = self.pending
+        finally:
+            self.pending = None
+        self.send(pending)
+
+    def send(self, requests):
+        """sends the requests, as few messages as possible, and checks all acknowledgements"""
+        descriptions = {}
+        chunk = ''
+        for (seq, data), description in requests:
+            descriptions[seq] = description
+            if len(chunk) + len(data) > Netlink.MAX_BATCH_SIZE:
+                self.socket.send(chunk)
+                chunk = ''
+            chunk += data
+        if chunk:
+            self.socket.send(chunk)
+
+        errors = []
+        while descriptions:
+            for msg_type, seq, payload in self.recv_messages():
+                if msg_type != Netlink.NLMSG_ERROR or seq not in descriptions:
+                    continue
+                error, = Netlink.NLMSGERR.unpack_from(payload)
+                description = descriptions.pop(seq)
+                if error != 0:
+                    errors.append("%s: %s" % (description, os.strerror(-error)))
+        if errors:
+            raise Exception("netlink request failed: %s" % '; '.join(errors))
+
+    def dump(self, msg_type, payload):
+        seq, data = self.message(msg_type, Netlink.NLM_F_DUMP, payload)
+        self.socket.send(data)
+        result = []
+        while True:
+            for reply_type, reply_seq, reply in self.recv_messages():
+                if reply_seq != seq:
+                    continue
+                if reply_type == Netlink.NLMSG_DONE:
+                    return result
+                if reply_type == Netlink.NLMSG_ERROR:
+                    error, = Netlink.NLMSGERR.unpack_from(reply)
+                    raise Exception("netlink dump failed: %s" % os.strerror(-error))
+                result.append(reply)
+
+    def links(self):
+        """returns name:{'index', 'flags', 'master', 'link', 'kind'} for all links.
+        link is the index of the veth peer, 0 when the peer is in another namespace"""
+        links = {}
+        for reply in self.dump(Netlink.RTM_GETLINK, Netlink.ifinfo()):
+            _, _, index, flags, _ = Netlink.IFINFOMSG.unpack_from(reply)
+            attrs = Netlink.parse_attrs(reply, Netlink.IFINFOMSG.size)
+            if Netlink.IFLA_IFNAME not in attrs:
+                continue
+            master = struct.unpack('=I', attrs[Netlink.IFLA_MASTER])[0] if Netlink.IFLA_MASTER in attrs else 0
+            link = 0
+            if Netlink.IFLA_LINK in attrs and Netlink.IFLA_LINK_NETNSID not in attrs:
+                link = struct.unpack('=i', attrs[Netlink.IFLA_LINK])[0]
+            kind = Netlink.parse_attrs(attrs.get(Netlink.IFLA_LINKINFO, '')).get(Netlink.IFLA_INFO_KIND, '').rstrip('\0')
+            links[attrs[Netlink.IFLA_IFNAME].rstrip('\0')] = {'index': index, 'flags': flags, 'master': master, 'link': link, 'kind': kind}
+        return links
+
+    def index(self, name):
+        links = self.links()
+        if name not in links:
+            raise Exception("Can't find interface %s" % name)
+        return links[name]['index']
+
+    def add_veth(self, name, peer):
+        peer_info = Netlink.ifinfo() + Netlink.attr(Netlink.IFLA_IFNAME, peer + '\0')
+        linkinfo = Netlink.attr(Netlink.IFLA_INFO_KIND, 'veth\0') + \
+                   Netlink.attr(Netlink.IFLA_INFO_DATA, Netlink.attr(Netlink.VETH_INFO_PEER, peer_info))
+        self.request(Netlink.RTM_NEWLINK,
+                     Netlink.ifinfo() + Netlink.attr(Netlink.IFLA_IFNAME, name + '\0') + Netlink.attr(Netlink.IFLA_LINKINFO, linkinfo),
+                     Netlink.NLM_F_CREATE | Netlink.NLM_F_EXCL, "add veth %s peer %s" % (name, peer))
+
+    def del_link(self, name):
+        self.request(Netlink.RTM_DELLINK, Netlink.ifinfo() + Netlink.attr(Netlink.IFLA_IFNAME, name + '\0'), 0, "delete %s" % name)
+
+    def set_link(self, name, up=None, mtu=None, master=None, netns_pid=None, new_name=None):
+        """changes the link. master is the bridge name, or '' to release the link from its bridge"""
+        flags = change = 0
+        if up is not None:
+            flags = Netlink.IFF_UP if up else 0
+            change = Netlink.IFF_UP
+        attrs = ''
+        if new_name is not None:
+            # the name attribute is the new name, so the link is found by index
+            info = Netlink.ifinfo(self.index(name), flags, change)
+            attrs += Netlink.attr(Netlink.IFLA_IFNAME, new_name + '\0')
+        else:
+            info = Netlink.ifinfo(0, flags, change)
+            attrs += Netlink.attr(Netlink.IFLA_IFNAME, name + '\0')
+        if mtu is not None:
+            attrs += Netlink.attr(Netlink.IFLA_MTU, struct.pack('=I', mtu))
+        if master is not None:
+            attrs += Netlink.attr(Netlink.IFLA_MASTER, struct.pack('=I', self.index(master) if master else 0))
+        if netns_pid is not None:
+            attrs += Netlink.attr(Netlink.IFLA_NET_NS_PID, struct.pack('=I', int(netns_pid)))
+        description = "set %s" % name + ''.join(" %s %s" % (key, value) for key, value in
+            (('up', up), ('mtu', mtu), ('master', master), ('netns', netns_pid), ('name', new_name)) if value is not None)
+        self.request(Netlink.RTM_SETLINK, info + attrs, 0, description)
+
+    @staticmethod
+    def parse_prefix(prefix):
+        family = socket.AF_INET6 if ':' in prefix else socket.AF_INET
+        if '/' in prefix:
+            address, prefixlen = prefix.split('/')
+        else:
+            address, prefixlen = prefix, 128 if family == socket.AF_INET6 else 32
+        return family, socket.inet_pton(family, address), int(prefixlen)
+
+    def flush_addresses(self, name):
+        index = self.index(name)
+        for reply in self.dump(Netlink.RTM_GETADDR, Netlink.IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+            family, prefixlen, flags, scope, addr_index = Netlink.IFADDRMSG.unpack_from(reply)
+            if addr_index != index:
+                continue
+            attrs = Netlink.parse_attrs(reply, Netlink.IFADDRMSG.size)
+            payload = Netlink.IFADDRMSG.pack(family, prefixlen, flags, scope, index)
+            for attr_type in (Netlink.IFA_LOCAL, Netlink.IFA_ADDRESS):
+                if attr_type in attrs:
+                    payload += Netlink.attr(attr_type, attrs[attr_type])
+            self.request(Netlink.RTM_DELADDR, payload, 0, "delete address from %s" % name)
+
+    def add_address(self, name, prefix):
+        family, address, prefixlen = Netlink.parse_prefix(prefix)
+        payload = Netlink.IFADDRMSG.pack(family, prefixlen, 0, Netlink.RT_SCOPE_UNIVERSE, self.index(name)) + \
+                  Netlink.attr(Netlink.IFA_LOCAL, address) + Netlink.attr(Netlink.IFA_ADDRESS, address)
+        self.request(Netlink.RTM_NEWADDR, payload, Netlink.NLM_F_CREATE | Netlink.NLM_F_EXCL, "add address %s to %s" % (prefix, name))
+
+    def add_default_route(self, gateway, name):
+        family, address, _ = Netlink.parse_prefix(gateway)
+        payload = Netlink.RTMSG.pack(family, 0, 0, 0, Netlink.RT_TABLE_MAIN, Netlink.RTPROT_BOOT, Netlink.RT_SCOPE_UNIVERSE, Netlink.RTN_UNICAST, 0) + \
+                  Netlink.attr(Netlink.RTA_GATEWAY, address) + Netlink.attr(Netlink.RTA_OIF, struct.pack('=I', self.index(name)))
+        self.request(Netlink.RTM_NEWROUTE, payload, Netlink.NLM_F_CREATE | Netlink.NLM_F_EXCL, "add default route via %s dev %s" % (gateway, name))
+
+
+class HostState(object):
+    """
+    In-memory model of the host network the module works on: interfaces of the
+    host and of the ptf container, linux bridge membership and veth peers of the
+    host interfaces, ovs bridges with their ports, and OpenFlow port numbers of
+    the ovs interfaces. It is loaded once, by one netlink dump per namespace and
+    one ovsdb-client dump, and afterwards kept current by the module's own
+    changes: the link changes go through add_veth/del_link/set_link, the ovs
+    changes through OvsBatch.commit().
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.host_ifaces = set()
+        self.host_if_to_br = {}     # host interface -> linux bridge
+        self.peers = {}             # host veth -> its peer, when both ends are on the host
+        self.cntr_ifaces = set()
+        self.br_ports = {}          # ovs bridge -> set of ports
+        self.ofports = {}           # ovs interface -> OpenFlow port number
+        self.new_links = set()      # host interfaces created by this run
+
+        self.load_host()
+        self.load_ovs()
+
+    def load_host(self):
+        links = VMTopology.netlink().links()
+        index_to_name = dict((attrs['index'], name) for name, attrs in links.iteritems())
+
+        self.host_ifaces = set(links)
+        self.host_if_to_br = {}
+        self.peers = {}
+        for name, attrs in links.iteritems():
+            master = index_to_name.get(attrs['master'])
+            if master is not None and links[master]['kind'] == 'bridge':
+                self.host_if_to_br[name] = master
+            if attrs['kind'] == 'veth' and attrs['link'] in index_to_name:
+                self.peers[name] = index_to_name[attrs['link']]
+
+        return
+
+    def load_container(self, pid):
+        self.pid = pid
+        if pid is not None:
+            self.cntr_ifaces = set(VMTopology.netlink(pid).links())
+        else:
+            self.cntr_ifaces = set()
+
+        return
+
+    def load_ovs(self):
+        tables = VMTopology.ovsdb_dump()
+
+        port_names = dict((row['_uuid'][1], row['name']) for row in tables.get('Port', []))
+        self.br_ports = {}
+        for row in tables.get('Bridge', []):
+            # like 'ovs-vsctl list-ports', without the local port of the bridge
+            ports = set(port_names[uuid] for _, uuid in HostState.ovsdb_set(row['ports']))
+            self.br_ports[row['name']] = ports - set([row['name']])
+
+        self.ofports = {}
+        for row in tables.get('Interface', []):
+            ofport = HostState.ovsdb_set(row['ofport'])
+            # empty while ovs-vswitchd hasn't assigned it, -1 when the interface couldn't be added
+            if ofport and ofport[0] > 0:
+                self.ofports[row['name']] = str(ofport[0])
+
+        return
+
+    @staticmethod
+    def ovsdb_set(value):
+        """returns elements of an ovsdb JSON set. A set with a single element is the element itself"""
+        if isinstance(value, list) and value[0] == 'set':
+            return value[1]
+
+        return [value]
+
+    def add_veth(self, name, peer):
+        VMTopology.netlink().add_veth(name, peer)
+        self.host_ifaces.update([name, peer])
+        self.new_links.update([name, peer])
+        self.peers[name] = peer
+        self.peers[peer] = name
+
+        return
+
+    def del_link(self, name):
+        """deletes a host interface, and the peer of a veth with it"""
+        VMTopology.netlink().del_link(name)
+        for iface in (name, self.peers.get(name)):
+            self.host_ifaces.discard(iface)
+            self.host_if_to_br.pop(iface, None)
+            self.peers.pop(iface, None)
+
+        return
+
+    def set_link(self, name, pid=None, **attrs):
+        """changes a host interface, or a container interface if pid is given. See Netlink.set_link()"""
+        VMTopology.netlink(pid).set_link(name, **attrs)
+
+        ifaces = self.host_ifaces if pid is None else self.cntr_ifaces
+        master = attrs.get('master')
+        if master:
+            self.host_if_to_br[name] = master
+        elif master is not None:
+            self.host_if_to_br.pop(name, None)
+
+        if attrs.get('netns_pid') is not None:
+            ifaces.discard(name)
+            self.host_if_to_br.pop(name, None)
+            self.peers.pop(self.peers.pop(name, None), None)
+            ifaces = self.host_ifaces if attrs['netns_pid'] == 1 else self.cntr_ifaces
+            ifaces.add(name)
+            if attrs['netns_pid'] == 1:
+                # only the kernel knows the peer of a veth which comes back from the container
+                self.load_host()
+
+        if attrs.get('new_name') is not None:
+            ifaces.discard(name)
+            ifaces.add(attrs['new_name'])
+
+        return
+
+    def apply_ovs_change(self, change, bridge, port):
+        if change == 'add-br':
+            self.br_ports.setdefault(bridge, set())
+            self.host_ifaces.add(bridge)
+        elif change == 'del-br':
+            for removed in self.br_ports.pop(bridge, set()) | set([bridge]):
+                self.ofports.pop(removed, None)
+            self.host_ifaces.discard(bridge)
+        elif change == 'add-port':
+            self.br_ports.setdefault(bridge, set()).add(port)
+            self.new_links.discard(port)
+        elif change == 'del-port':
+            self.br_ports.get(bridge, set()).discard(port)
+            self.ofports.pop(port, None)
+
+        return
 
 
 class VMTopology(object):
+    netlinks = {}   # pid -> Netlink socket in the network namespace of the pid, None for the host
 
-    def __init__(self, vm_names, fp_mtu, max_fp_num):
+    def __init__(self, vm_names, fp_mtu, max_fp_num, workers=1):
         self.vm_names = vm_names
         self.fp_mtu = fp_mtu
         self.max_fp_num = max_fp_num
+        self.workers = workers
+        self.timings = []
 
-        self.host_ifaces = VMTopology.ifconfig('ifconfig -a')
+        self.state = HostState()
 
         return
 
+    @timed_phase
     def init(self, vm_set_name, topo, vm_base, dut_fp_ports, ptf_exists=True):
         self.vm_set_name = vm_set_name
         if 'VMs' in topo:
@@ -144,17 +675,7 @@ class VMTopology(object):
         else:
             self.pid = None
 
-        self.update()
-
-        return
-
-    def update(self):
-        self.host_br_to_ifs, self.host_if_to_br = VMTopology.brctl('brctl show')
-        self.host_ifaces = VMTopology.ifconfig('ifconfig -a')
-        if self.pid is not None:
-            self.cntr_ifaces = VMTopology.ifconfig('nsenter -t %s -n ifconfig -a' % self.pid)
-        else:
-            self.cntr_ifaces = []
+        self.state.load_container(self.pid)
 
         return
 
@@ -165,52 +686,79 @@ class VMTopology(object):
 
         return vlans
 
+    @timed_phase
     def create_bridges(self):
+        batch = OvsBatch(self.state, self.workers)
+        bridges = []
         for vm in self.vm_names:
             for fp_num in xrange(self.max_fp_num):
-                fp_br_name = OVS_FP_BRIDGE_TEMPLATE % (vm, fp_num)
-                self.create_bridge(fp_br_name, self.fp_mtu)
-            bport_br_name = OVS_BRIDGE_BACK_TEMPLATE = 'br-%s-back' % vm
-            self.create_bridge(bport_br_name, self.fp_mtu)
+                bridges.append(OVS_FP_BRIDGE_TEMPLATE % (vm, fp_num))
+            bridges.append(OVS_BRIDGE_BACK_TEMPLATE % vm)
+
+        for bridge_name in bridges:
+            if bridge_name not in self.state.host_ifaces:
+                batch.add_bridge(bridge_name)
+        batch.commit()
+
+        with VMTopology.netlink().batch():
+            for bridge_name in bridges:
+                self.set_bridge_up(bridge_name, self.fp_mtu)
 
         return
 
     def create_bridge(self, bridge_name, mtu):
-        if bridge_name not in self.host_ifaces:
-            VMTopology.cmd('ovs-vsctl add-br %s' % bridge_name)
+        if bridge_name not in self.state.host_ifaces:
+            batch = OvsBatch(self.state)
+            batch.add_bridge(bridge_name)
+            batch.commit()
 
-        if mtu != DEFAULT_MTU:
-            VMTopology.cmd('ifconfig %s mtu %d' % (bridge_name, mtu))
+        self.set_bridge_up(bridge_name, mtu)
 
-        VMTopology.cmd('ifconfig %s up' % bridge_name)
+        return
+
+    def set_bridge_up(self, bridge_name, mtu):
+        if mtu != DEFAULT_MTU:
+            VMTopology.netlink().set_link(bridge_name, mtu=mtu, up=True)
+        else:
+            VMTopology.iface_up(bridge_name)
 
         return
 
+    @timed_phase
     def destroy_bridges(self):
-        for vm in self.vm_names:
-            for ifname in self.host_ifaces:
-                if re.compile(OVS_FP_BRIDGE_REGEX % vm).match(ifname):
-                    self.destroy_bridge(ifname)
-            bport_br_name = OVS_BRIDGE_BACK_TEMPLATE = 'br-%s-back' % vm
-            self.destroy_bridge(bport_br_name)
+        batch = OvsBatch(self.state, self.workers)
+        with VMTopology.netlink().batch():
+            for vm in self.vm_names:
+                for ifname in self.state.host_ifaces:
+                    if re.compile(OVS_FP_BRIDGE_REGEX % vm).match(ifname):
+                        self.destroy_bridge(ifname, batch)
+                bport_br_name = OVS_BRIDGE_BACK_TEMPLATE % vm
+                self.destroy_bridge(bport_br_name, batch)
+        batch.commit()
 
         return
 
-    def destroy_bridge(self, bridge_name):
-        if bridge_name in self.host_ifaces:
-            VMTopology.cmd('ifconfig %s down' % bridge_name)
-            VMTopology.cmd('ovs-vsctl del-br %s' % bridge_name)
+    def destroy_bridge(self, bridge_name, batch=None):
+        if bridge_name in self.state.host_ifaces:
+            VMTopology.iface_down(bridge_name)
+            if batch is None:
+                batch = OvsBatch(self.state)
+                batch.del_bridge(bridge_name)
+                batch.commit()
+            else:
+                batch.del_bridge(bridge_name)
 
         return
 
     def get_bridges(self, vmname):
         brs = []
-        for ifname in self.host_ifaces:
+        for ifname in self.state.host_ifaces:
             if re.compile(OVS_FP_BRIDGE_REGEX % vmname).match(ifname):
                 brs.append(ifname)
 
         return brs
 
+    @timed_phase
     def add_veth_ports_to_docker(self):
         for vlan in self.injected_fp_ports:
             ext_if = INJECTED_INTERFACES_TEMPLATE % (self.vm_set_name, vlan)
@@ -219,6 +767,7 @@ class VMTopology(object):
 
         return
 
+    @timed_phase
     def add_mgmt_port_to_docker(self, mgmt_bridge, mgmt_ip, mgmt_gw):
         self.add_br_if_to_docker(mgmt_bridge, PTF_MGMT_IF_TEMPLATE % self.vm_set_name, MGMT_BR_NAME)
         self.add_ip_to_docker_if(MGMT_BR_NAME, mgmt_ip, mgmt_gw)
@@ -226,42 +775,37 @@ class VMTopology(object):
         return
 
     def add_br_if_to_docker(self, bridge, ext_if, int_if):
-        self.update()
-
-        if ext_if not in self.host_ifaces:
-            VMTopology.cmd("ip link add %s type veth peer name %s" % (ext_if, int_if))
-
-        if ext_if not in self.host_if_to_br:
-            VMTopology.cmd("brctl addif %s %s" % (bridge, ext_if))
+        if ext_if not in self.state.host_ifaces:
+            self.state.add_veth(ext_if, int_if)
 
-        VMTopology.iface_up(ext_if)
+        if ext_if not in self.state.host_if_to_br:
+            self.state.set_link(ext_if, master=bridge, up=True)
+        else:
+            VMTopology.iface_up(ext_if)
 
-        self.update()
-        if int_if in self.host_ifaces and int_if not in self.cntr_ifaces:
-            VMTopology.cmd("ip link set netns %s dev %s" % (self.pid, int_if))
+        if int_if in self.state.host_ifaces and int_if not in self.state.cntr_ifaces:
+            self.state.set_link(int_if, netns_pid=self.pid)
 
         VMTopology.iface_up(int_if, self.pid)
 
         return
 
     def add_ip_to_docker_if(self, int_if, mgmt_ip_addr, mgmt_gw):
-        self.update()
-        if int_if in self.cntr_ifaces:
-            VMTopology.cmd("nsenter -t %s -n ip addr flush dev %s" % (self.pid, int_if))
-            VMTopology.cmd("nsenter -t %s -n ip addr add %s dev %s" % (self.pid, mgmt_ip_addr, int_if))
-            VMTopology.cmd("nsenter -t %s -n ip route add default via %s dev %s" % (self.pid, mgmt_gw, int_if))
+        if int_if in self.state.cntr_ifaces:
+            nl = VMTopology.netlink(self.pid)
+            nl.flush_addresses(int_if)
+            nl.add_address(int_if, mgmt_ip_addr)
+            nl.add_default_route(mgmt_gw, int_if)
 
         return
 
     def add_dut_if_to_docker(self, iface_name, dut_iface):
 
-        self.update()
-        if dut_iface in self.host_ifaces and dut_iface not in self.cntr_ifaces and iface_name not in self.cntr_ifaces:
-            VMTopology.cmd("ip link set netns %s dev %s" % (self.pid, dut_iface))
+        if dut_iface in self.state.host_ifaces and dut_iface not in self.state.cntr_ifaces and iface_name not in self.state.cntr_ifaces:
+            self.state.set_link(dut_iface, netns_pid=self.pid)
 
-        self.update()
-        if dut_iface in self.cntr_ifaces and iface_name not in self.cntr_ifaces:
-            VMTopology.cmd("nsenter -t %s -n ip link set dev %s name %s" % (self.pid, dut_iface, iface_name))
+        if dut_iface in self.state.cntr_ifaces and iface_name not in self.state.cntr_ifaces:
+            self.state.set_link(dut_iface, self.pid, new_name=iface_name)
 
         VMTopology.iface_up(iface_name, self.pid)
 
@@ -272,120 +816,148 @@ class VMTopology(object):
         if self.pid is None:
             return
 
-        self.update()
-        if iface_name in self.cntr_ifaces:
+        if iface_name in self.state.cntr_ifaces:
             VMTopology.iface_down(iface_name, self.pid)
 
-        if iface_name in self.cntr_ifaces and dut_iface not in self.cntr_ifaces:
-            VMTopology.cmd("nsenter -t %s -n ip link set dev %s name %s" % (self.pid, iface_name, dut_iface))
+        if iface_name in self.state.cntr_ifaces and dut_iface not in self.state.cntr_ifaces:
+            self.state.set_link(iface_name, self.pid, new_name=dut_iface)
 
-        self.update()
-        if dut_iface not in self.host_ifaces and dut_iface in self.cntr_ifaces:
-            VMTopology.cmd("nsenter -t %s -n ip link set netns 1 dev %s" % (self.pid, dut_iface))
+        if dut_iface not in self.state.host_ifaces and dut_iface in self.state.cntr_ifaces:
+            self.state.set_link(dut_iface, self.pid, netns_pid=1)
 
         return
 
     def add_veth_if_to_docker(self, ext_if, int_if):
-        self.update()
-
         t_int_if = int_if + '_t'
-        if ext_if not in self.host_ifaces:
-            VMTopology.cmd("ip link add %s type veth peer name %s" % (ext_if, t_int_if))
-
-        self.update()
-
-        if self.fp_mtu != DEFAULT_MTU:
-            VMTopology.cmd("ip link set dev %s mtu %d" % (ext_if, self.fp_mtu))
-            if t_int_if in self.host_ifaces:
-                VMTopology.cmd("ip link set dev %s mtu %d" % (t_int_if, self.fp_mtu))
-            elif t_int_if in self.cntr_ifaces:
-                VMTopology.cmd("nsenter -t %s -n ip link set dev %s mtu %d" % (self.pid, t_int_if, self.fp_mtu))
-            elif int_if in self.cntr_ifaces:
-                VMTopology.cmd("nsenter -t %s -n ip link set dev %s mtu %d" % (self.pid, int_if, self.fp_mtu))
-
-        VMTopology.iface_up(ext_if)
-
-        self.update()
-
-        if t_int_if in self.host_ifaces and t_int_if not in self.cntr_ifaces and int_if not in self.cntr_ifaces:
-            VMTopology.cmd("ip link set netns %s dev %s" % (self.pid, t_int_if))
-
-        self.update()
-
-        if t_int_if in self.cntr_ifaces and int_if not in self.cntr_ifaces:
-            VMTopology.cmd("nsenter -t %s -n ip link set dev %s name %s" % (self.pid, t_int_if, int_if))
-
-        VMTopology.iface_up(int_if, self.pid)
+        if ext_if not in self.state.host_ifaces:
+            self.state.add_veth(ext_if, t_int_if)
+
+        mtu = self.fp_mtu if self.fp_mtu != DEFAULT_MTU else None
+        with VMTopology.netlink().batch():
+            self.state.set_link(ext_if, mtu=mtu, up=True)
+            if t_int_if in self.state.host_ifaces:
+                # the mtu is set and the peer moved to the container by the same request
+                if int_if not in self.state.cntr_ifaces and t_int_if not in self.state.cntr_ifaces:
+                    self.state.set_link(t_int_if, mtu=mtu, netns_pid=self.pid)
+                elif mtu is not None:
+                    self.state.set_link(t_int_if, mtu=mtu)
+            elif mtu is not None:
+                if t_int_if in self.state.cntr_ifaces:
+                    VMTopology.netlink(self.pid).set_link(t_int_if, mtu=mtu)
+                elif int_if in self.state.cntr_ifaces:
+                    VMTopology.netlink(self.pid).set_link(int_if, mtu=mtu)
+
+        if t_int_if in self.state.cntr_ifaces and int_if not in self.state.cntr_ifaces:
+            self.state.set_link(t_int_if, self.pid, new_name=int_if, up=True)
+        else:
+            VMTopology.iface_up(int_if, self.pid)
 
         return
 
+    @timed_phase
     def bind_mgmt_port(self, br_name, mgmt_port):
-        if mgmt_port not in self.host_if_to_br:
-            VMTopology.cmd("brctl addif %s %s" % (br_name, mgmt_port))
+        if mgmt_port not in self.state.host_if_to_br:
+            self.state.set_link(mgmt_port, master=br_name)
 
         return
 
+    @timed_phase
     def unbind_mgmt_port(self, mgmt_port):
-        if mgmt_port in self.host_if_to_br:
-            VMTopology.cmd("brctl delif %s %s" % (self.host_if_to_br[mgmt_port], mgmt_port))
+        if mgmt_port in self.state.host_if_to_br:
+            self.state.set_link(mgmt_port, master='')
 
         return
 
-    def bind_fp_ports(self, disconnect_vm=False):
+    def plan_fp_ports(self):
+        """returns the desired fp bridges of the topology: [(bridge, dut port, injected port, vm port)]"""
+        plan = []
         for attr in self.VMs.itervalues():
+            vm_name = self.vm_names[self.vm_base_index + attr['vm_offset']]
             for vlan_num, vlan in enumerate(attr['vlans']):
-               injected_iface = INJECTED_INTERFACES_TEMPLATE % (self.vm_set_name, vlan)
-               br_name = OVS_FP_BRIDGE_TEMPLATE % (self.vm_names[self.vm_base_index + attr['vm_offset']], vlan_num)
-               vm_iface = OVS_FP_TAP_TEMPLATE % (self.vm_names[self.vm_base_index + attr['vm_offset']], vlan_num)
-               self.bind_ovs_ports(br_name, self.dut_fp_ports[vlan], injected_iface, vm_iface, disconnect_vm)
+                plan.append((OVS_FP_BRIDGE_TEMPLATE % (vm_name, vlan_num),
+                             self.dut_fp_ports[vlan],
+                             INJECTED_INTERFACES_TEMPLATE % (self.vm_set_name, vlan),
+                             OVS_FP_TAP_TEMPLATE % (vm_name, vlan_num)))
+
+        return sorted(plan)
+
+    @timed_phase
+    def bind_fp_ports(self, disconnect_vm=False, prune=False):
+        """brings the fp bridges to the planned state. Only the ports missing from the bridges are added,
+        and only the flows which differ from the installed ones are replaced. With prune, the planned ports
+        are removed from other bridges and the ports which aren't planned are removed from the bridges"""
+        plan = self.plan_fp_ports()
+        batch = OvsBatch(self.state, self.workers)
+
+        if prune:
+            planned = {}    # port -> bridge
+            for br_name, dut_iface, injected_iface, vm_iface in plan:
+                for port in (dut_iface, injected_iface, vm_iface):
+                    planned[port] = br_name
+            planned_bridges = set(planned.itervalues())
+            for br_name, ports in sorted(self.state.br_ports.iteritems()):
+                for port in sorted(ports):
+                    if planned.get(port, br_name) != br_name or (port not in planned and br_name in planned_bridges):
+                        batch.del_port(br_name, port)
+
+        for br_name, dut_iface, injected_iface, vm_iface in plan:
+            self.bind_ovs_ports(br_name, dut_iface, injected_iface, vm_iface, disconnect_vm, batch)
+        batch.commit()
 
         return
 
+    @timed_phase
     def unbind_fp_ports(self):
-        for attr in self.VMs.itervalues():
-            for vlan_num, vlan in enumerate(attr['vlans']):
-               br_name = OVS_FP_BRIDGE_TEMPLATE % (self.vm_names[self.vm_base_index + attr['vm_offset']], vlan_num)
-               vm_iface = OVS_FP_TAP_TEMPLATE % (self.vm_names[self.vm_base_index + attr['vm_offset']], vlan_num)
-               self.unbind_ovs_ports(br_name, vm_iface)
+        batch = OvsBatch(self.state, self.workers)
+        for br_name, _, _, vm_iface in self.plan_fp_ports():
+            self.unbind_ovs_ports(br_name, vm_iface, batch)
+        batch.commit()
 
         return
 
+    @timed_phase
     def bind_vm_backplane(self):
         root_back_bridge = ROOT_BACK_BR_TEMPLATE % self.vm_set_name
+        batch = OvsBatch(self.state, self.workers)
 
-        if root_back_bridge not in self.host_ifaces:
-            VMTopology.cmd('ovs-vsctl add-br %s' % root_back_bridge)
+        batch.add_bridge(root_back_bridge)
 
-        VMTopology.iface_up(root_back_bridge)
+        with VMTopology.netlink().batch():
+            for attr in self.VMs.itervalues():
+                vm_name = self.vm_names[self.vm_base_index + attr['vm_offset']]
+                br_name = OVS_BRIDGE_BACK_TEMPLATE % vm_name
 
-        for attr in self.VMs.itervalues():
-            vm_name = self.vm_names[self.vm_base_index + attr['vm_offset']]
-            br_name = OVS_BRIDGE_BACK_TEMPLATE % vm_name
+                back_int_name = BACK_ROOT_END_IF_TEMPLATE % vm_name
+                vm_int_name = BACK_VM_END_IF_TEMPLATE % vm_name
 
-            back_int_name = BACK_ROOT_END_IF_TEMPLATE % vm_name
-            vm_int_name = BACK_VM_END_IF_TEMPLATE % vm_name
+                if back_int_name not in self.state.host_ifaces:
+                    self.state.add_veth(back_int_name, vm_int_name)
 
-            if back_int_name not in self.host_ifaces:
-                VMTopology.cmd("ip link add %s type veth peer name %s" % (back_int_name, vm_int_name))
+                batch.add_port(br_name, vm_int_name)
+                batch.add_port(root_back_bridge, back_int_name)
 
-            if vm_int_name not in VMTopology.get_ovs_br_ports(br_name):
-                VMTopology.cmd("ovs-vsctl add-port %s %s" % (br_name, vm_int_name))
+        batch.commit()
 
-            if back_int_name not in VMTopology.get_ovs_br_ports(root_back_bridge):
-                VMTopology.cmd("ovs-vsctl add-port %s %s" % (root_back_bridge, back_int_name))
+        with VMTopology.netlink().batch():
+            VMTopology.iface_up(root_back_bridge)
 
-            VMTopology.iface_up(vm_int_name)
-            VMTopology.iface_up(back_int_name)
+            for attr in self.VMs.itervalues():
+                vm_name = self.vm_names[self.vm_base_index + attr['vm_offset']]
+                VMTopology.iface_up(BACK_VM_END_IF_TEMPLATE % vm_name)
+                VMTopology.iface_up(BACK_ROOT_END_IF_TEMPLATE % vm_name)
 
         return
 
+    @timed_phase
     def unbind_vm_backplane(self):
         root_back_bridge = ROOT_BACK_BR_TEMPLATE % self.vm_set_name
 
-        if root_back_bridge in self.host_ifaces:
+        batch = OvsBatch(self.state, self.workers)
+        if root_back_bridge in self.state.host_ifaces:
             VMTopology.iface_down(root_back_bridge)
-            VMTopology.cmd('ovs-vsctl del-br %s' % root_back_bridge)
+            batch.del_bridge(root_back_bridge)
 
+        back_int_names = []
         for attr in self.VMs.itervalues():
             vm_name = self.vm_names[self.vm_base_index + attr['vm_offset']]
             br_name = OVS_BRIDGE_BACK_TEMPLATE % vm_name
@@ -393,81 +965,94 @@ class VMTopology(object):
             back_int_name = BACK_ROOT_END_IF_TEMPLATE % vm_name
             vm_int_name = BACK_VM_END_IF_TEMPLATE % vm_name
 
-            self.unbind_ovs_port(br_name, vm_int_name)
+            self.unbind_ovs_port(br_name, vm_int_name, batch)
 
-            if back_int_name in self.host_ifaces:
-                VMTopology.iface_down(back_int_name)
-                VMTopology.cmd("ip link delete dev %s" % back_int_name)
-
-        return
+            if back_int_name in self.state.host_ifaces:
+                back_int_names.append(back_int_name)
 
-    def bind_ovs_ports(self, br_name, dut_iface, injected_iface, vm_iface, disconnect_vm=False):
-        """bind dut/injected/vm ports under an ovs bridge"""
-        ports = VMTopology.get_ovs_br_ports(br_name)
+        batch.commit()
 
-        if injected_iface not in ports:
-            VMTopology.cmd('ovs-vsctl add-port %s %s' % (br_name, injected_iface))
+        with VMTopology.netlink().batch():
+            for back_int_name in back_int_names:
+                VMTopology.iface_down(back_int_name)
+                self.state.del_link(back_int_name)
 
-        if dut_iface not in ports:
-            VMTopology.cmd('ovs-vsctl add-port %s %s' % (br_name, dut_iface))
+        return
 
-        bindings = VMTopology.get_ovs_port_bindings(br_name, dut_iface)
-        dut_iface_id = bindings[dut_iface]
-        injected_iface_id = bindings[injected_iface]
-        vm_iface_id = bindings[vm_iface]
+    def bind_ovs_ports(self, br_name, dut_iface, injected_iface, vm_iface, disconnect_vm=False, batch=None):
+        """bind dut/injected/vm ports under an ovs bridge. The changes are applied by batch.commit(),
+        or right away if batch is None"""
+        commit = batch is None
+        if commit:
+            batch = OvsBatch(self.state, self.workers)
 
-        # clear old bindings
-        VMTopology.cmd('ovs-ofctl del-flows %s' % br_name)
+        batch.add_port(br_name, injected_iface)
+        batch.add_port(br_name, dut_iface)
 
+        # old bindings are replaced
+        flows = []
         if disconnect_vm:
             # Drop packets from VM
-            VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=drop" % (br_name, vm_iface_id))
+            flows.append(("table=0,in_port=%s,action=drop", (vm_iface,)))
         else:
             # Add flow from a VM to an external iface
-            VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=output:%s" % (br_name, vm_iface_id, dut_iface_id))
+            flows.append(("table=0,in_port=%s,action=output:%s", (vm_iface, dut_iface)))
 
         if disconnect_vm:
             # Add flow from external iface to ptf container
-            VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=output:%s" % (br_name, dut_iface_id, injected_iface_id))
+            flows.append(("table=0,in_port=%s,action=output:%s", (dut_iface, injected_iface)))
         else:
             # Add flow from external iface to a VM and a ptf container
-            VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=output:%s,%s" % (br_name, dut_iface_id, vm_iface_id, injected_iface_id))
+            flows.append(("table=0,in_port=%s,action=output:%s,%s", (dut_iface, vm_iface, injected_iface)))
 
         # Add flow from a ptf container to an external iface
-        VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=output:%s" % (br_name, injected_iface_id, dut_iface_id))
+        flows.append(("table=0,in_port=%s,action=output:%s", (injected_iface, dut_iface)))
+
+        batch.set_flows(br_name, flows)
+
+        if commit:
+            batch.commit()
 
         return
 
-    def unbind_ovs_ports(self, br_name, vm_port):
+    def unbind_ovs_ports(self, br_name, vm_port, batch=None):
         """unbind all ports except the vm port from an ovs bridge"""
-        ports = VMTopology.get_ovs_br_ports(br_name)
+        commit = batch is None
+        if commit:
+            batch = OvsBatch(self.state)
 
-        for port in ports:
+        for port in sorted(self.state.br_ports.get(br_name, set())):
             if port != vm_port:
-                VMTopology.cmd('ovs-vsctl del-port %s %s' % (br_name, port))
+                batch.del_port(br_name, port)
+
+        if commit:
+            batch.commit()
 
         return
 
-    def unbind_ovs_port(self, br_name, port):
+    def unbind_ovs_port(self, br_name, port, batch=None):
         """unbind a port from an ovs bridge"""
-        ports = VMTopology.get_ovs_br_ports(br_name)
-
-        if port in ports:
-            VMTopology.cmd('ovs-vsctl del-port %s %s' % (br_name, port))
+        if port in self.state.br_ports.get(br_name, set()):
+            if batch is None:
+                batch = OvsBatch(self.state)
+                batch.del_port(br_name, port)
+                batch.commit()
+            else:
+                batch.del_port(br_name, port)
 
         return
 
+    @timed_phase
     def inject_host_ports(self):
         """inject dut port into the ptf docker"""
-        self.update()
         for vlan in self.host_interfaces:
             self.add_dut_if_to_docker(PTF_FP_IFACE_TEMPLATE % vlan, self.dut_fp_ports[vlan])
 
         return
 
+    @timed_phase
     def deject_host_ports(self):
         """deject dut port from the ptf docker"""
-        self.update()
         for vlan in self.host_interfaces:
             self.remove_dut_if_from_docker(PTF_FP_IFACE_TEMPLATE % vlan, self.dut_fp_ports[vlan])
 
@@ -481,10 +1066,15 @@ class VMTopology(object):
 
     @staticmethod
     def iface_updown(iface_name, state, pid):
-        if pid is None:
-            return VMTopology.cmd('ip link set %s %s' % (iface_name, state))
-        else:
-            return VMTopology.cmd('nsenter -t %s -n ip link set %s %s' % (pid, iface_name, state))
+        return VMTopology.netlink(pid).set_link(iface_name, up=(state == 'up'))
+
+    @staticmethod
+    def netlink(pid=None):
+        """returns the netlink socket for the host, or for the network namespace of the pid"""
+        if pid not in VMTopology.netlinks:
+            VMTopology.netlinks[pid] = Netlink(pid)
+
+        return VMTopology.netlinks[pid]
 
     @staticmethod
     def cmd(cmdline):
@@ -503,50 +1093,50 @@ class VMTopology(object):
         return stdout
 
     @staticmethod
-    def get_ovs_br_ports(bridge):
-        out = VMTopology.cmd('ovs-vsctl list-ports %s' % bridge)
-        ports = set()
-        for port in out.split('\n'):
-            if port != "":
-                ports.add(port)
-        return ports
+    def ovsdb_dump():
+        """returns table name -> rows of the Open_vSwitch database, every row is a dict column -> value in ovsdb JSON notation"""
+        out = VMTopology.cmd('ovsdb-client --format=json dump Open_vSwitch')
+        tables = {}
+        for line in out.split('\n'):
+            if line.strip() == '':
+                continue
+            table = json.loads(line)
+            tables[table['caption'].split()[0]] = [dict(zip(table['headings'], row)) for row in table['data']]
 
-    @staticmethod
-    def get_ovs_port_bindings(bridge, vlan_iface = None):
-        # Vlan interface addition may take few secs to reflect in OVS Command,
-        # Let`s retry few times in that case.
-        for retries in range(RETRIES):
-            out = VMTopology.cmd('ovs-ofctl show %s' % bridge)
-            lines = out.split('\n')
-            result = {}
-            for line in lines:
-                matched = re.match(r'^\s+(\S+)\((\S+)\):\s+addr:.+$', line)
-                if matched:
-                    port_id = matched.group(1)
-                    iface_name = matched.group(2)
-                    result[iface_name] = port_id
-            # Check if we have vlan_iface populated
-            if vlan_iface is None or vlan_iface in result:
-                return result
-            time.sleep(2*retries+1)
-        # Flow reaches here when vlan_iface not present in result 
-        raise Exception("Can't find vlan_iface_id")
+        return tables
 
     @staticmethod
-    def ifconfig(cmdline):
-        out = VMTopology.cmd(cmdline)
+    def get_ovs_ofports(ifaces):
+        """returns name:OpenFlow port number of the ovs interfaces"""
+        # ovs-vsctl waits until ovs-vswitchd has applied its changes, which assigns
+        # the OpenFlow port numbers, so there is nothing to wait for here
+        out = VMTopology.cmd('ovs-vsctl --format=csv --data=bare --no-headings --columns=name,ofport list Interface %s' % ' '.join(sorted(ifaces)))
+        result = {}
+        for line in out.split('\n'):
+            if ',' not in line:
+                continue
+            iface_name, port_id = line.strip().split(',', 1)
+            if port_id not in ('', '-1'):
+                result[iface_name] = port_id
+        missing = set(ifaces) - set(result)
+        if missing:
+            raise Exception("Can't find OpenFlow port of %s" % ', '.join(sorted(missing)))
 
-        ifaces = set()
+        return result
 
-        rows = out.split('\n')
-        for row in rows:
-            if len(row) == 0:
-                continue
-            terms = row.split()
-            if not row[0].isspace():
-                ifaces.add(terms[0].rstrip(':'))
+    @staticmethod
+    def replace_ovs_flows(bridge, flows):
+        """replaces all flows of the bridge with one ovs-ofctl call"""
+        with tempfile.NamedTemporaryFile(prefix='vmtopology.flows.', delete=False) as flows_fp:
+            flows_fp.write('\n'.join(flows) + '\n')
+        with open(CMD_DEBUG_FNAME, 'a') as fp:
+            pprint("FLOWS: %s" % flows, fp)
+        try:
+            VMTopology.cmd('ovs-ofctl replace-flows %s %s' % (bridge, flows_fp.name))
+        finally:
+            os.remove(flows_fp.name)
 
-        return ifaces
+        return
 
     @staticmethod
     def get_pid(ptf_name):
@@ -558,31 +1148,6 @@ class VMTopology(object):
 
         return result['State']['Pid']
 
-    @staticmethod
-    def brctl(cmdline):
-        out = VMTopology.cmd(cmdline)
-
-        br_to_ifs = {}
-        if_to_br = {}
-
-        rows = out.split('\n')[1:]
-        cur_br = None
-        for row in rows:
-            if len(row) == 0:
-                continue
-            terms = row.split()
-            if not row[0].isspace():
-                cur_br = terms[0]
-                br_to_ifs[cur_br] = []
-                if len(terms) > 3:
-                    br_to_ifs[cur_br].append(terms[3])
-                    if_to_br[terms[3]] = cur_br
-            else:
-                br_to_ifs[cur_br].append(terms[0])
-                if_to_br[terms[0]] = cur_br
-
-        return br_to_ifs, if_to_br
-
 def check_topo(topo):
     hostif_exists = False
     vms_exists = False
@@ -651,6 +1216,7 @@ def main():
             dut_mgmt_port=dict(required=False, type='str'),
             fp_mtu=dict(required=False, type='int', default=DEFAULT_MTU),
             max_fp_num=dict(required=False, type='int', default=NUM_FP_VLANS_PER_FP),
+            workers=dict(required=False, type='int', default=DEFAULT_WORKERS),
         ),
         supports_check_mode=False)
 
@@ -658,13 +1224,14 @@ def main():
     vm_names = module.params['vm_names']
     fp_mtu = module.params['fp_mtu']
     max_fp_num = module.params['max_fp_num']
+    workers = module.params['workers']
     dut_mgmt_port = None
 
     try:
         if os.path.exists(CMD_DEBUG_FNAME) and os.path.isfile(CMD_DEBUG_FNAME):
             os.remove(CMD_DEBUG_FNAME)
 
-        net = VMTopology(vm_names, fp_mtu, max_fp_num)
+        net = VMTopology(vm_names, fp_mtu, max_fp_num, workers)
 
         if cmd == 'create':
             net.create_bridges()
@@ -772,9 +1339,8 @@ def main():
             net.add_mgmt_port_to_docker(mgmt_bridge, ptf_mgmt_ip_addr, ptf_mgmt_ip_gw)
 
             if vms_exists:
-                net.unbind_fp_ports()
                 net.add_veth_ports_to_docker()
-                net.bind_fp_ports()
+                net.bind_fp_ports(prune=True)
             if hostif_exists:
                 net.inject_host_ports()
         elif cmd == 'connect-vms' or cmd == 'disconnect-vms':
@@ -812,7 +1378,7 @@ def main():
             traceback.print_exc(file=fp)
         module.fail_json(msg=str(error))
 
-    module.exit_json(changed=True)
+    module.exit_json(changed=True, timings=net.timings)
 
 if __name__ == "__main__":
     main()